@@ -16,7 +16,30 @@ def api_factory(**kwargs):
         storage_account_container=kwargs['storage_account_container'],
         group_name=kwargs['group_name'],
         location=kwargs['location'],
-        debug=kwargs['debug'])
+        debug=kwargs['debug'],
+        premium_storage_account_name=kwargs.get(
+            'premium_storage_account_name'),
+        premium_storage_account_key=kwargs.get(
+            'premium_storage_account_key'),
+        storage_accounts=kwargs.get('storage_accounts'),
+        profiles=kwargs.get('profiles'),
+        reconcile_interval=kwargs.get('reconcile_interval'),
+        reclaim_interval=kwargs.get('reclaim_interval'),
+        reclaim_rate=kwargs.get('reclaim_rate'),
+        token_cache_path=kwargs.get('token_cache_path'),
+        node_names=kwargs.get('node_names'),
+        node_tag=kwargs.get('node_tag'),
+        vm_full_scan_interval=kwargs.get('vm_full_scan_interval'),
+        operation_limits=kwargs.get('operation_limits'),
+        circuit_breaker=kwargs.get('circuit_breaker'),
+        operation_timeout=kwargs.get('operation_timeout'),
+        state_dir=kwargs.get('state_dir'),
+        record_trace=kwargs.get('record_trace'),
+        replay_trace=kwargs.get('replay_trace'),
+        replay_speed=kwargs.get('replay_speed'),
+        transport=kwargs.get('transport'),
+        node_cache=kwargs.get('node_cache'),
+        resource_groups=kwargs.get('resource_groups'))
 
 FLOCKER_BACKEND = BackendDescription(
     name=u"azure_flocker_driver",
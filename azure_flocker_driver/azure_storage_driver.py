@@ -1,25 +1,43 @@
 from uuid import UUID
+import os
 import socket
+import sys
 from bitmath import Byte, GiB
 from zope.interface import implementer
 import eliot
 import threading
-
-from azure.storage.blob import PageBlobService
-from azure.common.credentials import ServicePrincipalCredentials
-from azure.mgmt.resource.resources import ResourceManagementClient
-from azure.mgmt.compute import ComputeManagementClient
-from azure_utils.arm_disk_manager import DiskManager
+import time
+
+from azure_utils.arm_disk_manager import DiskManager, AzureDiskClaimed, \
+    ResourceGroup
+from azure_utils.breaker import BreakerProxy, CircuitBreaker
+from azure_utils.garbage import OrphanCollector
+from azure_utils.node_cache import NodeCache, CACHE_FILE
+from azure_utils.recording import RecordingProxy, TraceRecorder, \
+    TraceReplayer
+from azure_utils.migration import VolumeMigrator
+from azure_utils.reclaim import DEFAULT_MIN_RUN, VolumeReclaimer
+from azure_utils.reconciler import DiskReconciler
+from azure_utils.tracing import phase
+from azure_utils.transport import PooledTransport, DEFAULT_MAX_AGE, \
+    DEFAULT_MAX_REQUESTS
+from inventory import VolumeInventory
 from lun import Lun
+from profiles import profiles_from_configuration, UnknownStorageProfile
+from profiling import DriverProfiler, parse_bool, DEFAULT_STATE_DIR
+from scheduler import OperationScheduler, scheduled, CRITICAL, CREATE, \
+    LIST, BULK
 
 from flocker.node.agents.blockdevice import IBlockDeviceAPI, \
-    BlockDeviceVolume, UnknownVolume, UnattachedVolume, \
-    AlreadyAttachedVolume
+    IProfiledBlockDeviceAPI, MandatoryProfiles, BlockDeviceVolume, \
+    UnknownVolume, UnattachedVolume, AlreadyAttachedVolume
 
 _logger = eliot.Logger()
 
 _vmstate_lock = threading.Lock()
 
+DEFAULT_TOKEN_CACHE_PATH = '/var/lib/flocker/azure_token_cache.json'
+
 
 # Logging Helpers
 def log_info(message):
@@ -54,6 +72,7 @@ class AsynchronousTimeout(Exception):
 
 
 @implementer(IBlockDeviceAPI)
+@implementer(IProfiledBlockDeviceAPI)
 class AzureStorageBlockDeviceAPI(object):
     """
     An ``IBlockDeviceAsyncAPI`` which uses Azure Storage Backed Block Devices
@@ -70,29 +89,266 @@ class AzureStorageBlockDeviceAPI(object):
         :returns: A ``BlockDeviceVolume``.
         """
         self._instance_id = self.compute_instance_id()
-        creds = ServicePrincipalCredentials(
-            client_id=azure_config['client_id'],
-            secret=azure_config['client_secret'],
-            tenant=azure_config['tenant_id'])
-        self._resource_client = ResourceManagementClient(
-            creds,
-            azure_config['subscription_id'])
-        self._compute_client = ComputeManagementClient(
-            creds,
-            azure_config['subscription_id'])
-        self._azure_storage_client = PageBlobService(
-            account_name=azure_config['storage_account_name'],
-            account_key=azure_config['storage_account_key'])
-        self._manager = DiskManager(self._resource_client,
-                                    self._compute_client,
-                                    self._azure_storage_client,
-                                    azure_config['storage_account_container'],
-                                    azure_config['group_name'],
-                                    azure_config['location'])
+        self._azure_config = azure_config
+        self._profiles = profiles_from_configuration(
+            azure_config.get('profiles'))
+        self._reconcile_interval = float(
+            azure_config.get('reconcile_interval') or 0)
+        self._reconciler = None
+        self._reclaim_interval = float(
+            azure_config.get('reclaim_interval') or 0)
+        self._reclaimer = None
         self._storage_account_name = azure_config['storage_account_name']
         self._disk_container_name = azure_config['storage_account_container']
         self._resource_group = azure_config['group_name']
 
+        # Operations are admitted by priority, so attaches and detaches
+        # are not held up behind listing, destroying or backups.
+        self._scheduler = OperationScheduler(
+            azure_config.get('operation_limits'))
+
+        # Requests to ARM and to each storage account go through a circuit
+        # breaker, so a degraded endpoint fails calls fast instead of
+        # holding them for the whole timeout.  A per-call timeout bounds
+        # the total time of an operation, polling and retries included.
+        self._breaker_config = azure_config.get('circuit_breaker') or {}
+        self._breakers = {}
+        operation_timeout = azure_config.get('operation_timeout')
+        self._operation_timeout = None
+        if operation_timeout is not None:
+            self._operation_timeout = float(operation_timeout)
+
+        # Every client of an endpoint shares one pool of keep-alive
+        # connections, so requests don't each pay for a TLS handshake.
+        transport_config = azure_config.get('transport') or {}
+        self._transport = PooledTransport(
+            pool_sizes=transport_config.get('pool_sizes'),
+            max_requests=int(transport_config.get(
+                'max_requests', DEFAULT_MAX_REQUESTS)),
+            max_age=float(transport_config.get('max_age', DEFAULT_MAX_AGE)))
+
+        # With debug on, driver calls can be profiled at runtime by
+        # signal or control file without restarting the agent.
+        self._profiler = None
+        if parse_bool(azure_config.get('debug')):
+            self._profiler = DriverProfiler(
+                azure_config.get('state_dir') or DEFAULT_STATE_DIR)
+            self._profiler.start()
+
+        # Requests to Azure can be recorded to a trace, or answered from
+        # one so the driver runs offline against a production workload.
+        self._recorder = None
+        self._replayer = None
+        if azure_config.get('replay_trace'):
+            self._replayer = TraceReplayer(
+                azure_config['replay_trace'],
+                speed=float(azure_config.get('replay_speed') or 1))
+        elif azure_config.get('record_trace'):
+            self._recorder = TraceRecorder(azure_config['record_trace'])
+
+        # Credentials, SDK clients and the disk manager all talk to Azure
+        # or import large parts of the SDK when built, so they are built
+        # on first use rather than while the agent starts.
+        self._lazy_lock = threading.RLock()
+        self._lazy_values = {}
+
+    def _lazy(self, name, factory):
+        if name not in self._lazy_values:
+            with self._lazy_lock:
+                if name not in self._lazy_values:
+                    self._lazy_values[name] = factory()
+        return self._lazy_values[name]
+
+    def _breaker(self, endpoint):
+        with self._lazy_lock:
+            if endpoint not in self._breakers:
+                self._breakers[endpoint] = CircuitBreaker(
+                    endpoint,
+                    failure_threshold=int(self._breaker_config.get(
+                        'failure_threshold', 5)),
+                    reset_timeout=float(self._breaker_config.get(
+                        'reset_timeout', 30)))
+            return self._breakers[endpoint]
+
+    def _deadline(self):
+        if self._operation_timeout is None:
+            return None
+        return time.time() + self._operation_timeout
+
+    def _create_credentials(self):
+        from azure_utils.credentials import CachedServicePrincipalCredentials
+        return CachedServicePrincipalCredentials(
+            client_id=self._azure_config['client_id'],
+            secret=self._azure_config['client_secret'],
+            cache_path=self._azure_config.get('token_cache_path') or
+            DEFAULT_TOKEN_CACHE_PATH,
+            tenant=self._azure_config['tenant_id'])
+
+    def _wrap_client(self, name, create, endpoint, operations=(),
+                     local=None):
+        # Builds an SDK client, or its stand in when replaying a trace,
+        # behind the endpoint's breaker
+        if self._replayer is not None:
+            client = self._replayer.client(name, local=local)
+        else:
+            client = create()
+            if self._recorder is not None:
+                client = RecordingProxy(client, self._recorder, name,
+                                        operations=operations)
+        return BreakerProxy(client, self._breaker(endpoint),
+                            operations=operations)
+
+    def _create_resource_client(self):
+        from azure.mgmt.resource.resources import ResourceManagementClient
+        return self._wrap_client(
+            'resource',
+            lambda: self._transport.configure_management_client(
+                ResourceManagementClient(
+                    self._credentials,
+                    self._azure_config['subscription_id']),
+                'arm'),
+            'arm',
+            operations=('resource_groups', 'resources', 'providers'))
+
+    def _create_compute_client(self, subscription_id=None):
+        from azure.mgmt.compute import ComputeManagementClient
+        name = 'compute'
+        if subscription_id is None:
+            subscription_id = self._azure_config['subscription_id']
+        else:
+            name = 'compute:' + subscription_id
+        return self._wrap_client(
+            name,
+            lambda: self._transport.configure_management_client(
+                ComputeManagementClient(
+                    self._credentials, subscription_id),
+                'arm'),
+            'arm',
+            operations=('virtual_machines', 'virtual_machine_sizes'))
+
+    def _create_storage_client(self, account_name, account_key):
+        from azure.storage.blob import PageBlobService
+
+        def create():
+            return PageBlobService(
+                account_name=account_name,
+                account_key=account_key,
+                request_session=self._transport.session(
+                    'storage:' + account_name))
+        # URLs and signatures are built locally when replaying
+        return self._wrap_client(
+            'storage:' + account_name, create, 'storage:' + account_name,
+            local=create() if self._replayer is not None else None)
+
+    def _create_node_cache(self):
+        # The dataset agent and the Docker plugin share listings through
+        # a cache in the state directory.  It is off unless configured,
+        # and never used while replaying a trace.
+        cache_config = self._azure_config.get('node_cache')
+        if self._replayer is not None or not (
+                isinstance(cache_config, dict) or parse_bool(cache_config)):
+            return None, None
+        state_dir = self._azure_config.get('state_dir') or DEFAULT_STATE_DIR
+        cache_ttls = None
+        if isinstance(cache_config, dict):
+            cache_ttls = dict((kind, float(ttl))
+                              for (kind, ttl) in cache_config.items())
+        return NodeCache(os.path.join(state_dir, CACHE_FILE)), cache_ttls
+
+    def _compute_client_for(self, subscription_id):
+        if subscription_id is None:
+            return self._compute_client
+        return self._lazy('compute_client:' + subscription_id,
+                          lambda: self._create_compute_client(
+                              subscription_id))
+
+    def _resource_groups(self):
+        # Further groups of flocker nodes, each named alone or as a
+        # ``group_name`` and ``subscription_id`` mapping
+        groups = []
+        for entry in self._azure_config.get('resource_groups') or []:
+            if not isinstance(entry, dict):
+                entry = {'group_name': entry}
+            subscription_id = entry.get('subscription_id')
+            if subscription_id == self._azure_config['subscription_id']:
+                subscription_id = None
+            groups.append(ResourceGroup(
+                entry['group_name'],
+                self._compute_client_for(subscription_id),
+                subscription_id))
+        return groups
+
+    def _create_manager(self):
+        node_cache, cache_ttls = self._create_node_cache()
+        premium_storage_client = None
+        if self._azure_config.get('premium_storage_account_name') is not None:
+            premium_storage_client = self._create_storage_client(
+                self._azure_config['premium_storage_account_name'],
+                self._azure_config['premium_storage_account_key'])
+        # further accounts disks can be migrated to, named by account
+        extra_storage_clients = [
+            (account['name'],
+             self._create_storage_client(account['name'], account['key']))
+            for account in self._azure_config.get('storage_accounts') or []]
+        manager = DiskManager(
+            self._resource_client,
+            self._compute_client,
+            self._azure_storage_client,
+            self._azure_config['storage_account_container'],
+            self._azure_config['group_name'],
+            self._azure_config['location'],
+            premium_storage_client=premium_storage_client,
+            node_names=self._azure_config.get('node_names'),
+            node_tag=self._azure_config.get('node_tag') or
+            DiskManager.DEFAULT_NODE_TAG,
+            full_scan_interval=float(
+                self._azure_config.get('vm_full_scan_interval') or 3600),
+            node_cache=node_cache,
+            cache_ttls=cache_ttls,
+            resource_groups=self._resource_groups(),
+            extra_storage_clients=extra_storage_clients)
+
+        if self._reconcile_interval > 0:
+            self._reconciler = DiskReconciler(manager,
+                                              self._reconcile_interval,
+                                              str(self._instance_id),
+                                              _vmstate_lock)
+            self._reconciler.start()
+        if self._reclaim_interval > 0:
+            self._reclaimer = VolumeReclaimer(
+                manager, self._reclaim_interval,
+                rate=float(self._azure_config.get('reclaim_rate') or 20))
+            self._reclaimer.start()
+        return manager
+
+    @property
+    def _credentials(self):
+        return self._lazy('credentials', self._create_credentials)
+
+    @property
+    def _resource_client(self):
+        return self._lazy('resource_client', self._create_resource_client)
+
+    @property
+    def _compute_client(self):
+        return self._lazy('compute_client', self._create_compute_client)
+
+    @property
+    def _azure_storage_client(self):
+        return self._lazy('storage_client', lambda: (
+            self._create_storage_client(
+                self._azure_config['storage_account_name'],
+                self._azure_config['storage_account_key'])))
+
+    @property
+    def _manager(self):
+        return self._lazy('manager', self._create_manager)
+
+    @property
+    def _inventory(self):
+        return self._lazy('inventory', lambda: VolumeInventory(
+            self._manager, self._blockdevicevolume_from_azure_volume))
+
     def allocation_unit(self):
         """
         1GiB is the minimum allocation unit for azure disks
@@ -119,20 +375,127 @@ class AzureStorageBlockDeviceAPI(object):
         :returns: A ``Deferred`` that fires with a ``BlockDeviceVolume`` when
             the volume has been created.
         """
+        return self.create_volume_with_profile(
+            dataset_id, size, MandatoryProfiles.DEFAULT.value)
+
+    @scheduled(CREATE)
+    def create_volume_with_profile(self, dataset_id, size, profile_name):
+        """
+        Create a new volume using the storage account and host caching
+        mode of the named profile.  The profile is recorded in the blob
+        metadata so every attach of the volume uses the same caching.
+        :param UUID dataset_id: The Flocker dataset ID of the dataset on this
+            volume.
+        :param int size: The size of the new volume in bytes.
+        :param unicode profile_name: The name of the storage profile.
+        :raises UnknownStorageProfile: If the profile is not configured.
+        :returns: A ``BlockDeviceVolume``.
+        """
+        size_in_gb, profile = self._size_and_profile(dataset_id, size,
+                                                     profile_name)
+        disk_label = self._disk_label_for_dataset_id(dataset_id)
+        log_info('Creating block device ' + disk_label + ' with profile '
+                 + profile.name)
+        self._manager.create_disk(disk_label, size_in_gb,
+                                  storage=profile.storage,
+                                  profile_name=profile.name,
+                                  caching=profile.caching)
+
+        return BlockDeviceVolume(
+            blockdevice_id=unicode(disk_label),
+            size=size,
+            attached_to=None,
+            dataset_id=dataset_id)
+
+    def _size_and_profile(self, dataset_id, size, profile_name):
         size_in_gb = Byte(size).to_GiB().value
 
         if size_in_gb % 1 != 0:
             raise UnsupportedVolumeSize(dataset_id)
 
+        profile = self._profiles.get(unicode(profile_name).lower())
+        if profile is None:
+            raise UnknownStorageProfile(profile_name)
+        return (int(size_in_gb), profile)
+
+    @scheduled(CREATE)
+    def create_and_attach_volume(self, dataset_id, size, attach_to,
+                                 profile_name=None):
+        """
+        Create a new volume and attach it to a node as one operation.  The
+        blob is created while the node's VM is fetched and its LUN picked,
+        so a new dataset is mounted sooner than with ``create_volume``
+        followed by ``attach_volume``.
+        :param UUID dataset_id: The Flocker dataset ID of the dataset on this
+            volume.
+        :param int size: The size of the new volume in bytes.
+        :param unicode attach_to: An identifier like the one returned by the
+            ``compute_instance_id`` method.
+        :param unicode profile_name: The name of the storage profile, or
+            ``None`` for the default profile.
+        :raises UnknownStorageProfile: If the profile is not configured.
+        :returns: The attached ``BlockDeviceVolume``.
+        """
+        if profile_name is None:
+            profile_name = MandatoryProfiles.DEFAULT.value
+        size_in_gb, profile = self._size_and_profile(dataset_id, size,
+                                                     profile_name)
         disk_label = self._disk_label_for_dataset_id(dataset_id)
-        self._manager.create_disk(disk_label, size_in_gb)
+        log_info('Creating block device ' + disk_label + ' with profile '
+                 + profile.name + ' attached to ' + attach_to)
+        try:
+            self._manager.create_and_attach_disk(
+                disk_label, size_in_gb, str(attach_to),
+                storage=profile.storage,
+                profile_name=profile.name,
+                caching=profile.caching,
+                lock=_vmstate_lock,
+                deadline=self._deadline())
+        except AzureDiskClaimed:
+            raise AlreadyAttachedVolume(disk_label)
 
         return BlockDeviceVolume(
             blockdevice_id=unicode(disk_label),
             size=size,
-            attached_to=None,
+            attached_to=attach_to,
             dataset_id=dataset_id)
 
+    @scheduled(CREATE)
+    def create_volume_from_source(self, dataset_id, source_disk_name):
+        """
+        Create a new volume seeded with the contents of an existing disk in
+        the storage container, such as a golden image or another volume.
+        The data is copied by the storage service from a snapshot of the
+        source, so the driver only waits on the copy to complete.
+        :param UUID dataset_id: The Flocker dataset ID of the dataset on this
+            volume.
+        :param unicode source_disk_name: The name of the source disk, without
+            the ``.vhd`` suffix.
+        :raises UnknownVolume: If the source disk does not exist.
+        :returns: A ``BlockDeviceVolume`` the size of the source disk.
+        """
+        disks = self._manager.list_disks()
+        source_disk = None
+        for disk in disks:
+            if disk.name == source_disk_name:
+                source_disk = disk
+                break
+
+        if source_disk is None:
+            raise UnknownVolume(source_disk_name)
+
+        disk_label = self._disk_label_for_dataset_id(dataset_id)
+        log_info('Cloning block device ' + disk_label + ' from '
+                 + source_disk_name)
+        self._manager.clone_disk(source_disk_name, disk_label,
+                                 deadline=self._deadline())
+
+        return self._blockdevicevolume_from_azure_volume(
+            disk_label,
+            source_disk.properties.content_length,
+            None)
+
+    @scheduled(BULK)
     def destroy_volume(self, blockdevice_id):
         """
         Destroy an existing volume.
@@ -155,6 +518,7 @@ class AzureStorageBlockDeviceAPI(object):
 
         self._manager.destroy_disk(target_disk.name)
 
+    @scheduled(CRITICAL)
     def attach_volume(self, blockdevice_id, attach_to):
         """
         Attach ``blockdevice_id`` to ``host``.
@@ -177,7 +541,8 @@ class AzureStorageBlockDeviceAPI(object):
         _vmstate_lock.acquire()
         try:
             # Make sure disk is present.  Also, need the disk size is needed.
-            disks = self._manager.list_disks()
+            with phase(u'list_disks'):
+                disks = self._manager.list_disks()
             target_disk = None
             for disk in disks:
                 if disk.name == blockdevice_id:
@@ -186,7 +551,9 @@ class AzureStorageBlockDeviceAPI(object):
             if target_disk is None:
                 raise UnknownVolume(blockdevice_id)
 
-            (disk, vmname, lun) = self._get_disk_vmname_lun(blockdevice_id)
+            with phase(u'lookup_owner'):
+                (disk, vmname, lun) = \
+                    self._get_disk_vmname_lun(blockdevice_id)
             if vmname is not None:
                 if unicode(vmname) != self.compute_instance_id():
                     raise AlreadyAttachedVolume(blockdevice_id)
@@ -196,10 +563,17 @@ class AzureStorageBlockDeviceAPI(object):
                         target_disk.properties.content_length,
                         attach_to)
 
-            self._manager.attach_disk(
-                str(attach_to),
-                target_disk.name,
-                int(GiB(bytes=target_disk.properties.content_length)))
+            try:
+                self._manager.attach_disk(
+                    str(attach_to),
+                    target_disk.name,
+                    int(GiB(bytes=target_disk.properties.content_length)),
+                    caching=self._manager.get_disk_caching(target_disk),
+                    storage=target_disk.storage,
+                    deadline=self._deadline())
+            except AzureDiskClaimed:
+                # another node holds or is attaching the disk
+                raise AlreadyAttachedVolume(blockdevice_id)
         finally:
             _vmstate_lock.release()
 
@@ -210,6 +584,7 @@ class AzureStorageBlockDeviceAPI(object):
             target_disk.properties.content_length,
             attach_to)
 
+    @scheduled(CRITICAL)
     def detach_volume(self, blockdevice_id):
         """
         Detach ``blockdevice_id`` from whatever host it is attached to.
@@ -224,8 +599,9 @@ class AzureStorageBlockDeviceAPI(object):
 
         _vmstate_lock.acquire()
         try:
-            (target_disk, vm_name, lun) = \
-                self._get_disk_vmname_lun(blockdevice_id)
+            with phase(u'lookup_owner'):
+                (target_disk, vm_name, lun) = \
+                    self._get_disk_vmname_lun(blockdevice_id)
 
             if target_disk is None:
                 raise UnknownVolume(blockdevice_id)
@@ -233,10 +609,132 @@ class AzureStorageBlockDeviceAPI(object):
             if lun is None:
                 raise UnattachedVolume(blockdevice_id)
 
-            self._manager.detach_disk(vm_name, target_disk)
+            self._manager.detach_disk(vm_name, target_disk,
+                                      deadline=self._deadline())
         finally:
             _vmstate_lock.release()
 
+    @scheduled(CREATE)
+    def resize_volume(self, blockdevice_id, size):
+        """
+        Grow a volume in place, without copying its data.  A volume
+        attached to a node is detached, resized and attached to the same
+        node again.
+        :param unicode blockdevice_id: The unique identifier for the block
+            device being resized.
+        :param int size: The new size of the volume in bytes.
+        :raises UnknownVolume: If the supplied ``blockdevice_id`` does not
+            exist.
+        :raises UnsupportedVolumeSize: If the size is not a whole number
+            of GiB.
+        :returns: A ``BlockDeviceVolume``.
+        """
+        size_in_gb = Byte(size).to_GiB().value
+        if size_in_gb % 1 != 0:
+            raise UnsupportedVolumeSize(
+                self._dataset_id_for_disk_label(blockdevice_id))
+        size_in_gb = int(size_in_gb)
+
+        _vmstate_lock.acquire()
+        try:
+            with phase(u'lookup_owner'):
+                (disk_name, vm_name, lun) = \
+                    self._get_disk_vmname_lun(blockdevice_id)
+            if disk_name is None:
+                raise UnknownVolume(blockdevice_id)
+            target_disk = None
+            for disk in self._manager.list_disks():
+                if disk.name == disk_name:
+                    target_disk = disk
+                    break
+            if target_disk is None:
+                raise UnknownVolume(blockdevice_id)
+
+            deadline = self._deadline()
+            if vm_name is not None:
+                log_info('Detaching ' + disk_name + ' from ' + vm_name
+                         + ' to resize it')
+                self._manager.detach_disk(vm_name, disk_name,
+                                          deadline=deadline)
+            try:
+                self._manager.resize_disk(disk_name, size_in_gb,
+                                          deadline=deadline)
+            except Exception:
+                # The volume goes back to its node even if the resize
+                # failed, with a deadline of its own as the resize may
+                # have used up the operation's.  The resize error is the
+                # one raised.
+                error = sys.exc_info()
+                if vm_name is not None:
+                    try:
+                        self._reattach_volume(
+                            vm_name, target_disk,
+                            int(GiB(bytes=target_disk.properties
+                                    .content_length)))
+                    except Exception as e:
+                        log_error('Unable to attach ' + disk_name
+                                  + ' to ' + vm_name + ' again: '
+                                  + repr(e))
+                raise error[0], error[1], error[2]
+            if vm_name is not None:
+                self._reattach_volume(vm_name, target_disk, size_in_gb)
+        finally:
+            _vmstate_lock.release()
+
+        log_info('Resized ' + disk_name + ' to ' + str(size_in_gb) + ' GiB')
+        return self._blockdevicevolume_from_azure_volume(
+            disk_name, self._gibytes_to_bytes(size_in_gb),
+            vm_name and unicode(vm_name))
+
+    def _reattach_volume(self, vm_name, target_disk, size_in_gb):
+        self._manager.attach_disk(
+            str(vm_name), target_disk.name, size_in_gb,
+            caching=self._manager.get_disk_caching(target_disk),
+            storage=target_disk.storage,
+            deadline=self._deadline())
+
+    @scheduled(CRITICAL)
+    def evacuate_volumes(self, source_instance_id, target_instance_id,
+                         progress=None):
+        """
+        Move every volume attached to one node to another node, with one
+        update of each VM instead of a detach and attach per volume.
+        :param unicode source_instance_id: The node to move volumes from.
+        :param unicode target_instance_id: The node to move volumes to.
+        :param progress: An optional callable called with
+            ``(blockdevice_id, state, lun)`` as each volume moves.
+        :returns: A ``list`` of ``BlockDeviceVolume``s now attached to
+            ``target_instance_id``.
+        """
+        def report(disk_name, state, lun):
+            log_info('Evacuating ' + disk_name + ' from '
+                     + str(source_instance_id) + ' to '
+                     + str(target_instance_id) + ': ' + state)
+            if progress is not None:
+                progress(unicode(disk_name), state, lun)
+
+        _vmstate_lock.acquire()
+        try:
+            moved = self._manager.evacuate_disks(str(source_instance_id),
+                                                 str(target_instance_id),
+                                                 report,
+                                                 deadline=self._deadline())
+        finally:
+            _vmstate_lock.release()
+
+        # a cached listing can miss a disk, whose blob is read instead
+        sizes = dict((d.name, d.properties.content_length)
+                     for d in self._manager.list_disks())
+        volumes = []
+        for disk_name, lun in moved:
+            size = sizes.get(disk_name)
+            if size is None:
+                size = self._manager.read_disk_size(disk_name)
+            volumes.append(self._blockdevicevolume_from_azure_volume(
+                disk_name, size, target_instance_id))
+        return volumes
+
+    @scheduled(CRITICAL)
     def get_device_path(self, blockdevice_id):
         """
         Return the device path that has been allocated to the block device on
@@ -250,8 +748,9 @@ class AzureStorageBlockDeviceAPI(object):
         :returns: A ``FilePath`` for the device.
         """
 
-        (target_disk, vm_name, lun) = \
-            self._get_disk_vmname_lun(blockdevice_id)
+        with phase(u'lookup_owner'):
+            (target_disk, vm_name, lun) = \
+                self._get_disk_vmname_lun(blockdevice_id)
 
         if target_disk is None:
             raise UnknownVolume(blockdevice_id)
@@ -261,74 +760,132 @@ class AzureStorageBlockDeviceAPI(object):
 
         return Lun.get_device_path_for_lun(lun)
 
-    def _get_details_for_disks(self, disks_in):
+    @scheduled(LIST)
+    def list_volumes(self):
+        """
+        List all the block devices available via the back end API.
+        :returns: A ``list`` of ``BlockDeviceVolume``s.
+        """
+        return self._inventory.list_volumes()
+
+    @scheduled(BULK)
+    def list_volume_usage(self):
         """
-        Give a list of disks, returns a ''list'' of ''BlockDeviceVolume''s
+        Report how many bytes of each volume hold data.
+        :returns: A ``list`` of ``(blockdevice_id, size, allocated_bytes)``
+            tuples, where ``size`` is the provisioned size in bytes.
+        """
+        usage = []
+        for disk in self._manager.list_disks():
+            if 'flocker-' not in disk.name:
+                continue
+            usage.append((unicode(disk.name),
+                          disk.properties.content_length,
+                          self._manager.get_allocated_bytes(disk.name)))
+        return usage
+
+    @scheduled(BULK)
+    def backup_volume(self, blockdevice_id, path=None,
+                      target_container_name=None):
         """
-        disk_info = []
-        disks = dict((d.name, d) for d in disks_in)
+        Back up the populated pages of a volume to a local file or to a
+        second container.  Only pages changed since the previous backup to
+        the same target are copied.
+        :param unicode blockdevice_id: The unique identifier for the volume.
+        :param str path: The local file to back up to.
+        :param str target_container_name: The container to back up to when
+            ``path`` is not given.
+        :raises UnknownVolume: If the supplied ``blockdevice_id`` does not
+            exist.
+        :returns: A ``BackupResult``.
+        """
+        if blockdevice_id not in [d.name for d in self._manager.list_disks()]:
+            raise UnknownVolume(blockdevice_id)
 
-        # first handle disks attached to vms
-        vms_info = {}
-        vms = self._compute_client.virtual_machines.list(self._resource_group)
-        for vm in vms:
-            vm_info = self._compute_client.virtual_machines.get(
-                self._resource_group,
-                vm.name,
-                expand="instanceView")
-            vms_info[vm.name] = vm_info
-            for data_disk in vm.storage_profile.data_disks:
-                if 'flocker-' in data_disk.name:
-                    disk_name = data_disk.name.replace('.vhd', '')
-                    if disk_name in disks:
-                        disk_info.append(
-                            self._blockdevicevolume_from_azure_volume(
-                                disk_name,
-                                self._gibytes_to_bytes(data_disk.disk_size_gb),
-                                vm.name))
-                        del disks[disk_name]
-                    else:
-                        # We have a data disk mounted that isn't in the known
-                        # list of blobs.
-                        log_info(
-                            "Disk attached, but not known in container: " +
-                            disk_name)
-        for vm_info in vms_info:
-            vm = vms_info[vm_info]
-            if vm.instance_view is not None:
-                for disk in vm.instance_view.disks:
-                    if 'flocker-' in disk.name:
-                        disk_name = disk.name.replace('.vhd', '')
-                        if disk_name in disks:
-                            disk_size = disks[disk_name].properties.\
-                                content_length
-                            disk_size = disk_size - (disk_size %
-                                                     (1024 * 1024 * 1024))
-                            disk_info.append(
-                                self._blockdevicevolume_from_azure_volume(
-                                    disk_name,
-                                    disk_size,
-                                    vm.name))
-                            del disks[disk_name]
-
-        # each remaining disk should be added as not attached
-        for disk in disks:
-            if 'flocker-' in disk:
-                disk_info.append(self._blockdevicevolume_from_azure_volume(
-                                 disk.replace('.vhd', ''),
-                                 disks[disk].properties.content_length,
-                                 None))
+        return self._manager.backup_disk(
+            blockdevice_id, path=path,
+            target_container_name=target_container_name)
 
-        return disk_info
+    @scheduled(BULK)
+    def collect_orphans(self, known_blockdevice_ids=None, dry_run=True,
+                        grace_period=86400, max_workers=8, rate=10,
+                        audit_log_path=None):
+        """
+        Find, and unless ``dry_run`` delete, blobs in the container which
+        no VM refers to: LUN-0 reservations of deleted VMs and, when
+        ``known_blockdevice_ids`` is given, volumes Flocker does not know.
+        :param known_blockdevice_ids: The blockdevice ids Flocker reports,
+            or ``None`` to keep every volume.
+        :param bool dry_run: Only report what would be deleted.
+        :param float grace_period: Seconds a blob must have been left
+            unmodified to be collected.
+        :param int max_workers: Deletes to run at once.
+        :param float rate: Most deletes to start per second.
+        :param str audit_log_path: A file to append a JSON line to for
+            every orphan.
+        :returns: A ``CollectionReport``.
+        """
+        if known_blockdevice_ids is not None:
+            known_blockdevice_ids = set(known_blockdevice_ids)
+        collector = OrphanCollector(self._manager,
+                                    grace_period=grace_period,
+                                    max_workers=max_workers,
+                                    rate=rate,
+                                    audit_log_path=audit_log_path)
+        return collector.collect(known_blockdevice_ids, dry_run=dry_run)
+
+    @scheduled(BULK)
+    def reclaim_volumes(self, blockdevice_ids=None, max_workers=8, rate=20,
+                        min_run=DEFAULT_MIN_RUN):
+        """
+        Clear the pages of detached volumes which hold only zeros, so
+        they are no longer billed or backed up.
+        :param blockdevice_ids: The volumes to reclaim, or ``None`` for
+            every detached volume.
+        :param int max_workers: Ranged reads of a volume to run at once.
+        :param float rate: Most requests to start per second.
+        :param int min_run: Bytes of consecutive zero pages worth
+            clearing.
+        :returns: A ``ReclaimReport``.
+        """
+        if blockdevice_ids is not None:
+            blockdevice_ids = set(blockdevice_ids)
+        reclaimer = VolumeReclaimer(self._manager, None,
+                                    max_workers=max_workers, rate=rate,
+                                    min_run=min_run)
+        return reclaimer.reclaim_once(blockdevice_ids)
+
+    @scheduled(BULK)
+    def migrate_volumes(self, blockdevice_ids, target_storage, max_workers=4,
+                        max_bytes_in_flight=None, copy_timeout=21600):
+        """
+        Move detached volumes to another storage account with server side
+        copies, several at once.
+        :param blockdevice_ids: The volumes to move.
+        :param str target_storage: ``standard``, ``premium`` or the name
+            of an account in ``storage_accounts``.
+        :param int max_workers: Volumes to move at once.
+        :param int max_bytes_in_flight: Most provisioned bytes to copy at
+            once, or ``None`` for no limit.
+        :param float copy_timeout: Seconds the copies of a volume may take.
+        :raises UnknownVolume: If a ``blockdevice_id`` does not exist.
+        :returns: A ``MigrationReport``.
+        """
+        disk_names = set(d.name for d in self._manager.list_disks())
+        for blockdevice_id in blockdevice_ids:
+            if blockdevice_id not in disk_names:
+                raise UnknownVolume(blockdevice_id)
+        migrator = VolumeMigrator(self._manager, max_workers=max_workers,
+                                  max_bytes_in_flight=max_bytes_in_flight,
+                                  copy_timeout=copy_timeout)
+        return migrator.migrate(list(blockdevice_ids), target_storage)
 
-    def list_volumes(self):
+    def transport_stats(self):
         """
-        List all the block devices available via the back end API.
-        :returns: A ``list`` of ``BlockDeviceVolume``s.
+        :returns: The connection pool use of each endpoint, see
+            ``PooledTransport.stats``.
         """
-        disks = self._manager.list_disks()
-        disk_list = self._get_details_for_disks(disks)
-        return disk_list
+        return self._transport.stats()
 
     def _disk_label_for_dataset_id(self, dataset_id):
         """
@@ -363,9 +920,22 @@ class AzureStorageBlockDeviceAPI(object):
         if target_disk is None:
             return (None, None, None)
 
+        # The attachment record in the blob metadata names the VM, which
+        # is checked with one request.  Without a record, a disk whose
+        # blob has no lease is attached nowhere.  Only disks attached
+        # before records were kept, or whose record is wrong, need a
+        # search of every VM.
+        (owner, lun) = self._manager.get_disk_owner(target_disk)
+        if owner is not None:
+            lun = self._manager.get_disk_lun(owner, target_disk.name)
+            if lun is not None:
+                return (target_disk.name, owner, lun)
+        elif target_disk.properties.lease.state != 'leased':
+            return (target_disk.name, None, None)
+
         vm_info = None
         vm_disk_info = None
-        vms = self._compute_client.virtual_machines.list(self._resource_group)
+        vms = self._manager.list_vms()
         for vm in vms:
             for disk in vm.storage_profile.data_disks:
                 if disk.name == target_disk.name:
@@ -410,7 +980,28 @@ def azure_driver_from_configuration(client_id,
                                     storage_account_container,
                                     group_name,
                                     location,
-                                    debug):
+                                    debug,
+                                    premium_storage_account_name=None,
+                                    premium_storage_account_key=None,
+                                    storage_accounts=None,
+                                    profiles=None,
+                                    reconcile_interval=None,
+                                    reclaim_interval=None,
+                                    reclaim_rate=None,
+                                    token_cache_path=None,
+                                    node_names=None,
+                                    node_tag=None,
+                                    vm_full_scan_interval=None,
+                                    operation_limits=None,
+                                    circuit_breaker=None,
+                                    operation_timeout=None,
+                                    state_dir=None,
+                                    record_trace=None,
+                                    replay_trace=None,
+                                    replay_speed=None,
+                                    transport=None,
+                                    node_cache=None,
+                                    resource_groups=None):
     """
     Returns Flocker Azure BlockDeviceAPI from plugin config yml.
         :param dictonary config: The Dictonary representing
@@ -426,4 +1017,25 @@ def azure_driver_from_configuration(client_id,
         storage_account_container=storage_account_container,
         group_name=group_name,
         location=location,
-        debug=debug)
+        debug=debug,
+        premium_storage_account_name=premium_storage_account_name,
+        premium_storage_account_key=premium_storage_account_key,
+        storage_accounts=storage_accounts,
+        profiles=profiles,
+        reconcile_interval=reconcile_interval,
+        reclaim_interval=reclaim_interval,
+        reclaim_rate=reclaim_rate,
+        token_cache_path=token_cache_path,
+        node_names=node_names,
+        node_tag=node_tag,
+        vm_full_scan_interval=vm_full_scan_interval,
+        operation_limits=operation_limits,
+        circuit_breaker=circuit_breaker,
+        operation_timeout=operation_timeout,
+        state_dir=state_dir,
+        record_trace=record_trace,
+        replay_trace=replay_trace,
+        replay_speed=replay_speed,
+        transport=transport,
+        node_cache=node_cache,
+        resource_groups=resource_groups)
@@ -1,7 +1,12 @@
-from azure.mgmt.compute.models import DataDisk
-from azure.mgmt.compute.models import VirtualHardDisk
 from bitmath import GiB
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from backup import PageRangeBackup, allocated_bytes
+from reclaim import DEFAULT_MIN_RUN, ZeroPageReclaimer
+from tracing import phase
 from vhd import Vhd
+import datetime
+import threading
 import uuid
 import time
 
@@ -36,6 +41,126 @@ class AzureOperationNotAllowed(Exception):
         pass
 
 
+class AzureStorageNotConfigured(Exception):
+
+    def __init__(self):
+        pass
+
+
+class AzureCopyFailed(Exception):
+
+    def __init__(self):
+        pass
+
+
+class AzureProvisioningFailed(Exception):
+
+    def __init__(self):
+        pass
+
+
+class AzureDiskClaimed(Exception):
+
+    def __init__(self):
+        pass
+
+
+class DiskRecord(object):
+    """
+    The parts of a flocker disk's blob an inventory is built from.
+    :ivar str name: The disk name, without the ``.vhd`` suffix.
+    :ivar str etag: The blob ETag, which changes whenever the blob does.
+    :ivar int size: The blob length, including the VHD footer.
+    """
+    __slots__ = ('name', 'etag', 'size')
+
+    def __init__(self, name, etag, size):
+        self.name = name
+        self.etag = etag
+        self.size = size
+
+
+class ResourceGroup(object):
+    """
+    A resource group holding flocker nodes.
+    :ivar str name: The group name.
+    :ivar compute_client: The compute client of the group's subscription.
+    :ivar str subscription_id: The subscription, or ``None`` for the
+        subscription of the driver's own group.
+    """
+    __slots__ = ('name', 'compute_client', 'subscription_id')
+
+    def __init__(self, name, compute_client, subscription_id=None):
+        self.name = name
+        self.compute_client = compute_client
+        self.subscription_id = subscription_id
+
+    @property
+    def key(self):
+        if self.subscription_id is None:
+            return self.name
+        return '%s/%s' % (self.subscription_id, self.name)
+
+
+class LunAllocator(object):
+    """
+    Picks free LUNs of VMs for attaches, over the whole range the VM size
+    allows.  A picked LUN is reserved until the attach that picked it
+    finishes, so attaches in flight at the same time never pick the same
+    LUN of a VM, even before either shows in the VM model.  LUN 0 holds
+    the reservation disk and is never picked.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # vm name -> set of reserved LUNs
+        self._reserved = {}
+
+    def reserve(self, vm_name, data_disks, lun_count, count=1):
+        """
+        :param data_disks: The data disks of the VM model.
+        :param int lun_count: The LUNs the VM size allows, numbered from 0.
+        :param int count: The LUNs to reserve.
+        :returns: A ``list`` of the reserved LUNs, lowest first.
+        :raises AzureInsufficientLuns: If there are not enough free LUNs.
+        """
+        used = set(disk.lun for disk in data_disks)
+        with self._lock:
+            reserved = self._reserved.setdefault(vm_name, set())
+            free = []
+            for lun in xrange(1, lun_count):
+                if lun not in used and lun not in reserved:
+                    free.append(lun)
+                    if len(free) == count:
+                        break
+            if len(free) < count:
+                if not reserved:
+                    del self._reserved[vm_name]
+                raise AzureInsufficientLuns()
+            reserved.update(free)
+        return free
+
+    def release(self, vm_name, luns):
+        with self._lock:
+            reserved = self._reserved.get(vm_name, set())
+            reserved.difference_update(luns)
+            if not reserved:
+                self._reserved.pop(vm_name, None)
+
+    @contextmanager
+    def reservation(self, vm_name, data_disks, lun_count, count=1):
+        """
+        Reserves LUNs for the duration of a ``with`` block, and releases
+        them whether or not the block succeeds.  Once an attach succeeds
+        its LUN is in the VM model instead.
+        """
+        luns = self.reserve(vm_name, data_disks, lun_count, count)
+        try:
+            yield luns
+        finally:
+            self.release(vm_name, luns)
+
+
 class DiskManager(object):
 
     # Resource provider constants
@@ -43,6 +168,41 @@ class DiskManager(object):
     STORAGE_RESORUCE_PROVIDER_VERSION = "2016-01-01"
     LUN0_RESERVED_VHD_NAME_SUFFIX = "lun0_reserved"
 
+    # Storage account tiers a disk can live in
+    STANDARD_STORAGE = "standard"
+    PREMIUM_STORAGE = "premium"
+
+    # Blob metadata recorded for every flocker disk
+    PROFILE_METADATA_KEY = "flocker_profile"
+    CACHING_METADATA_KEY = "flocker_caching"
+
+    # Blob metadata recording the VM and LUN a disk is attached to
+    OWNER_METADATA_KEY = "flocker_owner"
+    LUN_METADATA_KEY = "flocker_lun"
+    CLAIMED_AT_METADATA_KEY = "flocker_claimed_at"
+
+    # Seconds of the blob lease held while an attachment record is written
+    CLAIM_LEASE_DURATION = 60
+
+    # Seconds of the blob lease held on a disk while it is migrated,
+    # renewed as the copy is polled
+    MIGRATION_LEASE_DURATION = 60
+
+    # Copies of migrating disks are staged under this prefix in place of
+    # ``flocker-``, so listings never find a partial copy
+    MIGRATION_STAGING_PREFIX = "migrating-"
+
+    # Blob metadata naming the storage a disk is being migrated from, on
+    # its copy in the target until the source is deleted
+    MIGRATED_FROM_METADATA_KEY = "flocker_migrated_from"
+
+    # Tag set on every VM the driver attaches disks to
+    DEFAULT_NODE_TAG = "flocker-node"
+
+    # Seconds the blob listing, VM listing and VM sizes are kept in the
+    # node cache
+    DEFAULT_CACHE_TTLS = {'disks': 10, 'vms': 10, 'vm_sizes': 86400}
+
     def __init__(self,
                  resource_client,
                  compute_client,
@@ -50,7 +210,15 @@ class DiskManager(object):
                  disk_container_name,
                  group_name,
                  location,
-                 async_timeout=600):
+                 async_timeout=600,
+                 premium_storage_client=None,
+                 node_names=None,
+                 node_tag=DEFAULT_NODE_TAG,
+                 full_scan_interval=3600,
+                 node_cache=None,
+                 cache_ttls=None,
+                 resource_groups=None,
+                 extra_storage_clients=None):
         self._resource_client = resource_client
         self._compute_client = compute_client
         self._resource_group = group_name
@@ -59,8 +227,112 @@ class DiskManager(object):
         self._disk_container = disk_container_name
         self._async_timeout = async_timeout
 
-        # ensure the container exists.
-        self._storage_client.create_container(disk_container_name)
+        # VM discovery is restricted to flocker nodes, named in the
+        # configuration or tagged by this driver.  A scan of every VM in
+        # the group on a long interval catches nodes with flocker disks
+        # attached before they were tagged.
+        self._node_names = set(node_names or [])
+        self._node_tag = node_tag
+        self._full_scan_interval = full_scan_interval
+        self._last_full_scan = 0
+        self._untagged_nodes = set()
+
+        # Nodes can be spread over further resource groups, in this or
+        # other subscriptions.  The groups are listed concurrently, and
+        # an index of the listings finds the group of a VM by name.  A
+        # name in several groups belongs to the first.
+        self._groups = [ResourceGroup(group_name, compute_client)]
+        for group in resource_groups or []:
+            if group.key not in [g.key for g in self._groups]:
+                self._groups.append(group)
+        self._vm_groups = {}
+        self._vm_groups_lock = threading.Lock()
+
+        # Listings can be shared with the other driver processes of the
+        # node through a ``NodeCache``.  Changes made through this manager
+        # invalidate the listings they affect.
+        self._node_cache = node_cache
+        self._cache_ttls = dict(self.DEFAULT_CACHE_TTLS)
+        self._cache_ttls.update(cache_ttls or {})
+
+        # LUNs picked by attaches in flight
+        self._luns = LunAllocator()
+
+        # standard storage is always searched first
+        self._storage_clients = [(self.STANDARD_STORAGE, storage_client)]
+        if premium_storage_client is not None:
+            self._storage_clients.append((self.PREMIUM_STORAGE,
+                                          premium_storage_client))
+        # further accounts, named by label, hold disks migrated to them
+        # and are otherwise only searched
+        self._storage_clients.extend(extra_storage_clients or [])
+
+        # the containers are checked on first use, so constructing a
+        # manager makes no requests
+        self._containers_checked = False
+        self._containers_lock = threading.Lock()
+
+    def _cache_key(self, kind, name=None, scope=None):
+        if scope is None:
+            scope = {'disks': self._disk_container,
+                     'vms': self._resource_group,
+                     'vm_sizes': self._location}[kind]
+        return '%s:%s' % (name or kind, scope)
+
+    def _cached(self, kind, fetch, name=None, scope=None):
+        # ``name`` tells apart entries of the same kind of state, which
+        # are invalidated together, and ``scope`` the resource group of
+        # a VM listing
+        if self._node_cache is None:
+            return fetch()
+        return self._node_cache.get(self._cache_key(kind, name, scope),
+                                    self._cache_ttls[kind], fetch)
+
+    def _invalidate(self, *kinds):
+        if self._node_cache is not None:
+            keys = [self._cache_key(kind) for kind in kinds]
+            if 'disks' in kinds:
+                keys.append(self._cache_key('disks', 'disk_records'))
+            self._node_cache.invalidate(*keys)
+
+    def _invalidate_vms(self, vm_name):
+        if self._node_cache is not None:
+            self._node_cache.invalidate(self._cache_key(
+                'vms', scope=self._group_for_vm(vm_name).key))
+
+    def _ensure_containers(self):
+        if self._containers_checked:
+            return
+        with self._containers_lock:
+            if not self._containers_checked:
+                for storage, client in self._storage_clients:
+                    client.create_container(self._disk_container)
+                self._containers_checked = True
+
+    def _storage_client_for_tier(self, storage):
+        for tier, client in self._storage_clients:
+            if tier == storage:
+                return client
+        raise AzureStorageNotConfigured()
+
+    def _storage_client_for_disk(self, disk_name):
+        return self._storage_for_disk(disk_name)[1]
+
+    def _storage_for_disk(self, disk_name):
+        # Returns the ``(storage, client)`` holding a disk
+        if len(self._storage_clients) == 1:
+            return self._storage_clients[0]
+        for storage, client in self._storage_clients:
+            if client.exists(self._disk_container, disk_name + '.vhd'):
+                return (storage, client)
+        raise AzureElementNotFound()
+
+    def list_storage(self):
+        """
+        Returns the names of the storage a disk can be in: the tiers,
+        then the labels of further accounts.
+        """
+        return [storage for (storage, client) in self._storage_clients]
 
     def _str_array_to_lower(self, str_arry):
         array = []
@@ -68,15 +340,13 @@ class DiskManager(object):
             array.append(s.lower().replace(' ', ''))
         return array
 
+    def _list_vm_sizes(self):
+        return dict((size.name, size.max_data_disk_count)
+                    for size in self._compute_client.virtual_machine_sizes
+                    .list(self._location))
+
     def _get_max_luns_for_vm_size(self, vm_size):
-        max_luns = 0
-        vmSizes = self._compute_client.virtual_machine_sizes.list(
-            self._location)
-        for vm in vmSizes:
-            if vm.name == vm_size:
-                max_luns = vm.max_data_disk_count
-                break
-        return max_luns
+        return self._cached('vm_sizes', self._list_vm_sizes).get(vm_size, 0)
 
     def _is_lun_0_empty(self, diskInfo):
         lun0Empty = True
@@ -86,34 +356,45 @@ class DiskManager(object):
                 break
         return lun0Empty
 
-    def _compute_next_lun(self, total_luns, data_disks):
-        nextLun = -1
-        usedLuns = []
-        for i in range(0, len(data_disks)):
-            usedLuns.append(data_disks[i].lun)
-        for lun in range(1, total_luns):
-            if lun not in usedLuns:
-                nextLun = lun
-                break
-        if nextLun == -1:
-            raise AzureInsufficientLuns()
-        return nextLun
-
-    def _attach_disk(self, vm_name, vhd_name, vhd_size_in_gibs, lun):
-        self._attach_or_detach_disk(vm_name, vhd_name, vhd_size_in_gibs, lun)
-
-        timeout_count = 0
-        while self.is_disk_attached(vm_name, vhd_name) is False:
-            time.sleep(1)
-            timeout_count += 1
-            if timeout_count > self._async_timeout:
-                raise AzureAsynchronousTimeout()
+    def _deadline(self, deadline=None):
+        # Every wait is bounded by async_timeout, and by the caller's
+        # deadline when one is given, so retries can't extend past it.
+        timeout_at = time.time() + self._async_timeout
+        if deadline is None:
+            return timeout_at
+        return min(deadline, timeout_at)
+
+    def _sleep(self, seconds, deadline):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise AzureAsynchronousTimeout()
+        time.sleep(min(seconds, remaining))
+
+    def _attach_disk(self, vm_name, vhd_name, vhd_size_in_gibs, lun,
+                     caching="None", storage=STANDARD_STORAGE,
+                     deadline=None):
+        deadline = self._deadline(deadline)
+        with phase(u'update_vm', disk=vhd_name, lun=lun) as action:
+            attempts = self._attach_or_detach_disk(
+                vm_name, vhd_name, vhd_size_in_gibs, lun,
+                caching=caching, storage=storage, deadline=deadline)
+            action.addSuccessFields(attempts=attempts)
+
+        with phase(u'attach_confirm_poll', disk=vhd_name) as action:
+            polls = 1
+            while self.is_disk_attached(vm_name, vhd_name) is False:
+                self._sleep(1, deadline)
+                polls += 1
+            action.addSuccessFields(polls=polls)
 
-    def attach_disk(self, vm_name, vhd_name, vhd_size_in_gibs):
-        # get VM information
-        vm = self.get_vm(vm_name)
+    def _prepare_vm_for_attach(self, vm_name, deadline):
+        # Returns the VM model and the LUNs its size allows, once LUN 0
+        # holds a reservation disk
+        with phase(u'get_vm'):
+            vm = self.get_vm(vm_name)
         vm_size = vm.hardware_profile.vm_size
-        vm_luns = self._get_max_luns_for_vm_size(vm_size)
+        with phase(u'lun_size_lookup', vm_size=vm_size):
+            vm_luns = self._get_max_luns_for_vm_size(vm_size)
 
         # first check and see if we need to add a special place holder
         # on lun-0
@@ -121,50 +402,925 @@ class DiskManager(object):
             lun0_disk_name = vm_name + "-" + self.LUN0_RESERVED_VHD_NAME_SUFFIX
             print("Need to attach reserved disk named '%s' to lun 0" %
                   lun0_disk_name)
-            self.create_disk(lun0_disk_name, 1)
-            self._attach_disk(vm_name, lun0_disk_name, 1, 0)
-            vm = self.get_vm(vm_name)
+            with phase(u'lun0_reservation'):
+                self.create_disk(lun0_disk_name, 1)
+                self._attach_disk(vm_name, lun0_disk_name, 1, 0,
+                                  deadline=deadline)
+                vm = self.get_vm(vm_name)
+        return (vm, vm_luns)
 
-        lun = self._compute_next_lun(vm_luns, vm.storage_profile.data_disks)
-        self._attach_disk(vm_name, vhd_name, vhd_size_in_gibs, lun)
+    def _claim_and_attach(self, vm_name, vhd_name, vhd_size_in_gibs, lun,
+                          caching, storage, deadline):
+        # the record is written before the VM update, so an agent on
+        # another node attaching the same disk fails here rather than in
+        # ARM
+        with phase(u'claim', lun=lun):
+            self._write_attachment_record(vhd_name, vm_name, lun,
+                                          deadline)
+        try:
+            self._attach_disk(vm_name, vhd_name, vhd_size_in_gibs, lun,
+                              caching, storage, deadline)
+        except Exception:
+            self._clear_attachment_record(vhd_name, deadline)
+            raise
+
+    def attach_disk(self, vm_name, vhd_name, vhd_size_in_gibs,
+                    caching="None", storage=STANDARD_STORAGE, deadline=None):
+        deadline = self._deadline(deadline)
+        vm, vm_luns = self._prepare_vm_for_attach(vm_name, deadline)
+        with self._luns.reservation(vm_name, vm.storage_profile.data_disks,
+                                    vm_luns) as (lun,):
+            self._claim_and_attach(vm_name, vhd_name, vhd_size_in_gibs, lun,
+                                   caching, storage, deadline)
         return
 
-    def detach_disk(self, vm_name, vhd_name, allow_lun0_detach=False):
-        self._attach_or_detach_disk(vm_name, vhd_name, 0,
-                                    0, True, allow_lun0_detach)
-        timeout_count = 0
-        while self.is_disk_attached(vm_name, vhd_name) is True:
-            time.sleep(1)
-            timeout_count += 1
+    def create_and_attach_disk(self, disk_name, size_in_gibs, vm_name,
+                               storage=STANDARD_STORAGE, profile_name=None,
+                               caching=None, lock=None, deadline=None):
+        """
+        Creates a disk and attaches it to a VM, creating the blob and
+        writing its footer while the VM model is fetched and its LUN
+        picked, rather than one after the other.  The new blob is not
+        listed again; its size and settings are known.
 
-            if timeout_count > self._async_timeout:
-                raise AzureAsynchronousTimeout()
+        A disk whose attach fails is left created and detached.
+        :returns: The LUN the disk was attached at.
+        :param lock: Held while the VM is planned and updated, to
+            serialize with attaches and detaches in the same process.
+            Creating the blob doesn't wait for it.
+        """
+        deadline = self._deadline(deadline)
+        lock = lock or threading.Lock()
+        pool = ThreadPoolExecutor(max_workers=1)
+        try:
+            created = pool.submit(self.create_disk, disk_name, size_in_gibs,
+                                  storage=storage, profile_name=profile_name,
+                                  caching=caching)
+            with lock:
+                vm, vm_luns = self._prepare_vm_for_attach(vm_name, deadline)
+                with self._luns.reservation(
+                        vm_name, vm.storage_profile.data_disks,
+                        vm_luns) as (lun,):
+                    with phase(u'create_wait', disk=disk_name):
+                        created.result()
+                    self._claim_and_attach(vm_name, disk_name, size_in_gibs,
+                                           lun, caching or "None", storage,
+                                           deadline)
+        finally:
+            # a failed attach still waits for the blob it was overlapped
+            # with
+            pool.shutdown(wait=True)
+        return lun
 
+    def detach_disk(self, vm_name, vhd_name, allow_lun0_detach=False,
+                    deadline=None):
+        deadline = self._deadline(deadline)
+        with phase(u'update_vm', disk=vhd_name, detach=True) as action:
+            attempts = self._attach_or_detach_disk(vm_name, vhd_name, 0,
+                                                   0, True, allow_lun0_detach,
+                                                   deadline=deadline)
+            action.addSuccessFields(attempts=attempts)
+        with phase(u'detach_confirm_poll', disk=vhd_name) as action:
+            polls = 1
+            while self.is_disk_attached(vm_name, vhd_name) is True:
+                self._sleep(1, deadline)
+                polls += 1
+            action.addSuccessFields(polls=polls)
+
+        with phase(u'release'):
+            self._clear_attachment_record(vhd_name, deadline)
         return
 
+    def _owner_from_metadata(self, metadata):
+        metadata = metadata or {}
+        vm_name = metadata.get(self.OWNER_METADATA_KEY)
+        if not vm_name:
+            return (None, None)
+        return (vm_name, int(metadata.get(self.LUN_METADATA_KEY, -1)))
+
+    def get_disk_owner(self, disk):
+        """
+        Returns ``(vm_name, lun)`` from the attachment record of a disk
+        returned from ``list_disks``, or ``(None, None)`` when it has no
+        record.  The record is written by this driver only, so it can be
+        stale after an attach which did not finish or an attach made
+        outside flocker; verify it against the VM model.
+        """
+        return self._owner_from_metadata(disk.metadata)
+
+    def read_disk_owner(self, disk_name):
+        """
+        Returns ``(vm_name, lun)`` from the attachment record of a disk
+        with a single request, or ``(None, None)`` when it has no record.
+        """
+        storage_client = self._storage_client_for_disk(disk_name)
+        blob = storage_client.get_blob_properties(self._disk_container,
+                                                  disk_name + '.vhd')
+        return self._owner_from_metadata(blob.metadata)
+
+    def read_disk_size(self, disk_name):
+        """
+        Returns the length of the blob of a disk, including the VHD
+        footer, with a single request.
+        """
+        storage_client = self._storage_client_for_disk(disk_name)
+        return storage_client.get_blob_properties(
+            self._disk_container,
+            disk_name + '.vhd').properties.content_length
+
+    def get_disk_lun(self, vm_name, disk_name):
+        """
+        Returns the LUN of a disk in the model of a VM, or ``None`` when
+        the VM does not exist or does not have the disk.
+        """
+        from msrestazure.azure_exceptions import CloudError
+
+        try:
+            vm = self.get_vm(vm_name)
+        except CloudError as e:
+            if e.status_code == 404:
+                return None
+            raise
+        for disk in vm.storage_profile.data_disks:
+            if disk.name == disk_name:
+                return disk.lun
+        return None
+
+    def _is_claim_stale(self, disk_name, metadata):
+        # A claim is stale once the VM it names doesn't have the disk.
+        # While that VM is being updated the claim may belong to an attach
+        # in flight, so it's kept until older than an attach can take.  A
+        # claim written moments ago is kept too, as its agent may not
+        # have sent the VM update yet.
+        from msrestazure.azure_exceptions import CloudError
+
+        owner, lun = self._owner_from_metadata(metadata)
+        try:
+            vm = self.get_vm(owner)
+        except CloudError as e:
+            if e.status_code == 404:
+                return True
+            raise
+        if disk_name in [d.name for d in vm.storage_profile.data_disks]:
+            return False
+        age = time.time() - float(
+            metadata.get(self.CLAIMED_AT_METADATA_KEY, 0))
+        if vm.provisioning_state not in ("Succeeded", "Failed"):
+            return age >= self._async_timeout
+        return age >= self.CLAIM_LEASE_DURATION
+
+    def _acquire_claim_lease(self, storage_client, blob_name, deadline,
+                             detached=False):
+        # A short lease is another writer that is about to finish, such as
+        # an agent writing the record or the zero-page reclaimer clearing
+        # a batch, and is waited out within the deadline.  Azure's
+        # infinite lease on an attached disk is not, unless the caller
+        # has just detached the disk, as the platform keeps its lease for
+        # a while after a detach.
+        from azure.common import AzureConflictHttpError
+
+        while True:
+            try:
+                return storage_client.acquire_blob_lease(
+                    self._disk_container, blob_name,
+                    lease_duration=self.CLAIM_LEASE_DURATION)
+            except AzureConflictHttpError:
+                lease = storage_client.get_blob_properties(
+                    self._disk_container, blob_name).properties.lease
+                if lease.duration == 'infinite' and not detached:
+                    return None
+            try:
+                self._sleep(1, deadline)
+            except AzureAsynchronousTimeout:
+                return None
+
+    def _write_attachment_record(self, disk_name, vm_name, lun,
+                                 deadline=None, detached_from=None):
+        # Azure takes its own infinite lease on the blob of an attached
+        # disk, so the record can only be written while the disk is
+        # detached, and the short lease taken here must be released
+        # before the VM update attaches it.  Failing to take the lease
+        # means the disk is attached or another writer held it past the
+        # deadline.  A caller which has just detached the disk from
+        # ``detached_from`` waits out the platform's lease and takes over
+        # that VM's record.
+        deadline = self._deadline(deadline)
+        storage_client = self._storage_client_for_disk(disk_name)
+        blob_name = disk_name + '.vhd'
+        lease_id = self._acquire_claim_lease(
+            storage_client, blob_name, deadline,
+            detached=detached_from is not None)
+        if lease_id is None:
+            print("Disk %s is leased, unable to record it on %s" %
+                  (disk_name, vm_name))
+            raise AzureDiskClaimed()
+
+        try:
+            metadata = storage_client.get_blob_metadata(
+                self._disk_container, blob_name, lease_id=lease_id)
+            owner, owner_lun = self._owner_from_metadata(metadata)
+            if vm_name is not None and \
+                    owner not in (None, vm_name, detached_from) and \
+                    not self._is_claim_stale(disk_name, metadata):
+                print("Disk %s is recorded on %s lun %s" %
+                      (disk_name, owner, owner_lun))
+                raise AzureDiskClaimed()
+
+            metadata = dict((k, v) for (k, v) in metadata.items()
+                            if k not in (self.OWNER_METADATA_KEY,
+                                         self.LUN_METADATA_KEY,
+                                         self.CLAIMED_AT_METADATA_KEY))
+            if vm_name is not None:
+                metadata[self.OWNER_METADATA_KEY] = vm_name
+                metadata[self.LUN_METADATA_KEY] = str(lun)
+                metadata[self.CLAIMED_AT_METADATA_KEY] = str(int(time.time()))
+            storage_client.set_blob_metadata(self._disk_container,
+                                             blob_name,
+                                             metadata,
+                                             lease_id=lease_id)
+        finally:
+            self._invalidate('disks')
+            storage_client.release_blob_lease(self._disk_container,
+                                              blob_name,
+                                              lease_id)
+
+    def _clear_attachment_record(self, disk_name, deadline=None,
+                                 attempts=10):
+        # The platform releases its lease shortly after a detach
+        # finishes, so retry for a while, within the caller's deadline.
+        # A record left behind names a VM without the disk, which readers
+        # verify against.
+        deadline = self._deadline(deadline)
+        for attempt in range(attempts):
+            try:
+                self._write_attachment_record(disk_name, None, None,
+                                              deadline)
+                return
+            except AzureDiskClaimed:
+                pass
+            try:
+                self._sleep(1, deadline)
+            except AzureAsynchronousTimeout:
+                break
+        print("Unable to clear the attachment record of %s" % disk_name)
+
+    def _update_vm_and_wait(self, vm_name, vm, deadline=None):
+        # Recovery from a failed update is to update again, which always
+        # sets a new tag and forces the service to retry.
+        deadline = self._deadline(deadline)
+        for attempt in range(2):
+            result = self._update_vm(vm_name, vm)
+            if self._wait_for_provisioning(vm_name, result,
+                                           deadline) == "Succeeded":
+                return
+            print("Provisioning of %s ended up in failed state." % vm_name)
+        raise AzureProvisioningFailed()
+
+    def _wait_for_disks(self, vm_name, disk_names, attached, deadline=None):
+        # polls the model and instance view until every disk is in the
+        # wanted state, a single GET per poll regardless of disk count
+        deadline = self._deadline(deadline)
+        disk_names = set(disk_names)
+        with phase(u'disks_poll', vm=vm_name, attached=attached) as action:
+            polls = 0
+            while True:
+                polls += 1
+                current = set(d.name for d in
+                              self.list_attached_disks(vm_name))
+                if attached and disk_names.issubset(current) or \
+                        not attached and not (disk_names & current):
+                    action.addSuccessFields(polls=polls)
+                    return
+                self._sleep(1, deadline)
+
+    def evacuate_disks(self, source_vm_name, target_vm_name, progress=None,
+                       deadline=None):
+        """
+        Moves every flocker data disk from one VM to another using a single
+        update of each VM, rather than one update per disk.
+
+        The LUNs on the target are planned before anything is detached, so
+        a target without enough free LUNs fails without touching the
+        source.  The LUN-0 reservation of the source stays in place.
+        :param progress: An optional callable called with
+            ``(disk_name, state, lun)`` as each disk moves through the
+            ``detaching``, ``detached``, ``attaching`` and ``attached``
+            states.  A disk that can't be claimed for the target is
+            reported ``claimed``.  If the target can't take the disks,
+            those detached are attached to the source again and reported
+            ``returned``, or ``detached`` when that fails too, and the
+            error raised.
+        :returns: A list of ``(disk_name, lun)`` for the disks attached to
+            the target.
+        """
+        deadline = self._deadline(deadline)
+
+        def report(disk_name, state, lun):
+            print("Evacuate disk %s %s lun %s" % (disk_name, state, lun))
+            if progress is not None:
+                progress(disk_name, state, lun)
+
+        source = self.get_vm(source_vm_name)
+        moving = []
+        staying = []
+        for disk in source.storage_profile.data_disks:
+            if disk.lun != 0 and 'flocker-' in disk.name:
+                moving.append(disk)
+            else:
+                staying.append(disk)
+        if not moving:
+            return []
+
+        # plan the target LUNs, including the LUN-0 reservation, up front
+        target = self.get_vm(target_vm_name)
+        target_disks = target.storage_profile.data_disks
+        vm_luns = self._get_max_luns_for_vm_size(
+            target.hardware_profile.vm_size)
+        free_luns = self._luns.reserve(target_vm_name, target_disks,
+                                       vm_luns, count=len(moving))
+        try:
+            return self._evacuate(source_vm_name, source, staying, moving,
+                                  target_vm_name, target, free_luns,
+                                  report, deadline)
+        finally:
+            self._luns.release(target_vm_name, free_luns)
+
+    def _evacuate(self, source_vm_name, source, staying, moving,
+                  target_vm_name, target, free_luns, report, deadline):
+        for disk in moving:
+            report(disk.name, 'detaching', disk.lun)
+        source.storage_profile.data_disks = staying
+        self._update_vm_and_wait(source_vm_name, source, deadline)
+        self._wait_for_disks(source_vm_name, [d.name for d in moving], False,
+                             deadline)
+        for disk in moving:
+            report(disk.name, 'detached', disk.lun)
+
+        # Disks detached from the source and not attached to the target
+        # would otherwise be left attached nowhere
+        try:
+            return self._attach_evacuated(moving, source_vm_name,
+                                          target_vm_name, target, free_luns,
+                                          report, deadline)
+        except Exception:
+            self._return_evacuated(source_vm_name, target_vm_name, moving,
+                                   report)
+            raise
+
+    def _attach_evacuated(self, moving, source_vm_name, target_vm_name,
+                          target, free_luns, report, deadline):
+        from azure.mgmt.compute.models import DataDisk, VirtualHardDisk
+
+        target_disks = target.storage_profile.data_disks
+
+        # the records move with the disks while they are detached, and a
+        # disk which can't be claimed goes back to the source with the
+        # rest
+        claimed = []
+        for disk, lun in zip(moving, free_luns):
+            try:
+                self._write_attachment_record(disk.name, target_vm_name,
+                                              lun, deadline,
+                                              detached_from=source_vm_name)
+            except AzureDiskClaimed:
+                report(disk.name, 'claimed', None)
+                raise
+            claimed.append((disk, lun))
+
+        if self._is_lun_0_empty(target_disks):
+            lun0_disk_name = target_vm_name + "-" + \
+                self.LUN0_RESERVED_VHD_NAME_SUFFIX
+            print("Need to attach reserved disk named '%s' to lun 0" %
+                  lun0_disk_name)
+            self.create_disk(lun0_disk_name, 1)
+            target_disks.append(DataDisk(
+                lun=0,
+                name=lun0_disk_name,
+                vhd=VirtualHardDisk(self._storage_client.make_blob_url(
+                    self._disk_container, lun0_disk_name + ".vhd")),
+                caching="None",
+                create_option="attach",
+                disk_size_gb=1))
+
+        attached = []
+        for disk, lun in claimed:
+            target_disks.append(DataDisk(lun=lun,
+                                         name=disk.name,
+                                         vhd=VirtualHardDisk(disk.vhd.uri),
+                                         caching=disk.caching,
+                                         create_option="attach",
+                                         disk_size_gb=disk.disk_size_gb))
+            attached.append((disk.name, lun))
+            report(disk.name, 'attaching', lun)
+        self._update_vm_and_wait(target_vm_name, target, deadline)
+        self._wait_for_disks(target_vm_name, [d.name for d in moving], True,
+                             deadline)
+        for disk_name, lun in attached:
+            report(disk_name, 'attached', lun)
+
+        return attached
+
+    def _return_evacuated(self, source_vm_name, target_vm_name, disks,
+                          report):
+        # Attaches disks the target did not take back to the source, with
+        # a deadline of its own as the evacuation's may have run out.
+        # Disks which can't be returned, or claimed for the source, are
+        # reported ``detached``.
+        from azure.mgmt.compute.models import DataDisk, VirtualHardDisk
+
+        deadline = self._deadline()
+        detached = list(disks)
+        returning = []
+        try:
+            on_target = set(d.name for d in self.get_vm(
+                target_vm_name).storage_profile.data_disks)
+            detached = [d for d in disks if d.name not in on_target]
+            if not detached:
+                return
+            source = self.get_vm(source_vm_name)
+            vm_luns = self._get_max_luns_for_vm_size(
+                source.hardware_profile.vm_size)
+            with self._luns.reservation(source_vm_name,
+                                        source.storage_profile.data_disks,
+                                        vm_luns, count=len(detached)) as luns:
+                for disk, lun in zip(list(detached), luns):
+                    self._clear_attachment_record(disk.name, deadline)
+                    try:
+                        self._write_attachment_record(
+                            disk.name, source_vm_name, lun, deadline,
+                            detached_from=target_vm_name)
+                    except AzureDiskClaimed:
+                        continue
+                    returning.append((disk, lun))
+                    source.storage_profile.data_disks.append(DataDisk(
+                        lun=lun,
+                        name=disk.name,
+                        vhd=VirtualHardDisk(disk.vhd.uri),
+                        caching=disk.caching,
+                        create_option="attach",
+                        disk_size_gb=disk.disk_size_gb))
+                if returning:
+                    self._update_vm_and_wait(source_vm_name, source,
+                                             deadline)
+        except Exception as e:
+            print("Unable to return disks to %s: %r" % (source_vm_name, e))
+            for disk in detached:
+                report(disk.name, 'detached', None)
+            return
+        returned = set(disk.name for (disk, lun) in returning)
+        for disk in detached:
+            if disk.name not in returned:
+                report(disk.name, 'detached', None)
+        for disk, lun in returning:
+            report(disk.name, 'returned', lun)
+
     def list_disks(self):
+        return self._cached('disks', self._list_disks)
+
+    def list_disk_records(self):
+        """
+        Returns a ``DiskRecord`` for the blob of every flocker disk.  The
+        container is listed by prefix and without metadata, and only the
+        record is kept of each blob, so a large container is never held
+        as blob objects.
+        """
+        return self._cached('disks', self._list_disk_records,
+                            name='disk_records')
+
+    def _list_disk_records(self):
+        self._ensure_containers()
+        records = []
+        for storage, client in self._storage_clients:
+            for blob in client.list_blobs(self._disk_container,
+                                          prefix='flocker-'):
+                name = blob.name
+                if name.endswith('.vhd'):
+                    name = name[:-4]
+                records.append(DiskRecord(name, blob.properties.etag,
+                                          blob.properties.content_length))
+        return records
+
+    def _list_disks(self):
         # will list a max of 5000 blobs, but there really shouldn't
-        # be that many
-        disks = self._storage_client.list_blobs(self._disk_container)
+        # be that many.  Each disk is tagged with the storage tier
+        # it was found in.
+        from azure.storage.blob.models import Include
+
+        self._ensure_containers()
         return_disks = []
-        for disk in disks:
-            disk.name = disk.name.replace('.vhd', '')
-            return_disks.append(disk)
-        return return_disks
-
-    def destroy_disk(self, disk_name):
-        self._storage_client.delete_blob(self._disk_container,
-                                         disk_name + '.vhd')
+        for storage, client in self._storage_clients:
+            disks = client.list_blobs(self._disk_container,
+                                      include=Include.METADATA)
+            for disk in disks:
+                disk.name = disk.name.replace('.vhd', '')
+                disk.storage = storage
+                return_disks.append(disk)
+
+        # A migrating disk is in both accounts until its source is
+        # deleted, and the source is the disk until then.
+        listed = set((d.name, d.storage) for d in return_disks)
+        return [disk for disk in return_disks
+                if (disk.name, (disk.metadata or {}).get(
+                    self.MIGRATED_FROM_METADATA_KEY)) not in listed]
+
+    def destroy_disk(self, disk_name, storage=None, etag=None):
+        # backups keep a snapshot of the disk, which would otherwise
+        # prevent the delete.  With an etag the delete fails if the blob
+        # changed since it was listed.
+        if storage is None:
+            client = self._storage_client_for_disk(disk_name)
+        else:
+            client = self._storage_client_for_tier(storage)
+        try:
+            client.delete_blob(self._disk_container, disk_name + '.vhd',
+                               delete_snapshots='include',
+                               if_match=etag)
+        finally:
+            self._invalidate('disks')
         return
 
-    def create_disk(self, disk_name, size_in_gibs):
+    def get_allocated_bytes(self, disk_name):
+        """
+        Returns the number of bytes of a disk that hold data, including
+        the VHD footer.  Page blobs are sparse, so this is usually much
+        smaller than the provisioned size.
+        """
+        client = self._storage_client_for_disk(disk_name)
+        return allocated_bytes(client.get_page_ranges(self._disk_container,
+                                                      disk_name + '.vhd'))
+
+    def backup_disk(self, disk_name, path=None, target_container_name=None,
+                    max_workers=8):
+        """
+        Backs up the populated pages of a disk to a local file or to a
+        page blob of the same name in another container of its storage
+        account.  Successive backups to the same target only copy pages
+        changed since the previous backup.
+        :returns: A ``BackupResult``.
+        """
+        client = self._storage_client_for_disk(disk_name)
+        backup = PageRangeBackup(client, self._disk_container, max_workers)
+        if path is not None:
+            return backup.backup_to_file(disk_name + '.vhd', path)
+        return backup.backup_to_container(disk_name + '.vhd',
+                                          target_container_name)
+
+    def reclaim_disk(self, disk_name, etag, storage=None, max_workers=8,
+                     rate=None, min_run=DEFAULT_MIN_RUN):
+        """
+        Clears the pages of a detached disk which hold only zeros, so they
+        are no longer billed or backed up.
+        :param str etag: The ETag the disk was listed detached at.  Pages
+            are only cleared while the blob still has it.
+        :returns: A ``ReclaimResult``.
+        """
+        if storage is None:
+            client = self._storage_client_for_disk(disk_name)
+        else:
+            client = self._storage_client_for_tier(storage)
+        reclaimer = ZeroPageReclaimer(client, self._disk_container,
+                                      max_workers=max_workers, rate=rate,
+                                      min_run=min_run)
+        try:
+            result = reclaimer.reclaim(disk_name + '.vhd', etag)
+        finally:
+            self._invalidate('disks')
+        print("Reclaimed %s of %s zero bytes of %s" %
+              (result.reclaimed_bytes, result.zero_bytes, disk_name))
+        return result
+
+    def create_disk(self, disk_name, size_in_gibs,
+                    storage=STANDARD_STORAGE, profile_name=None,
+                    caching=None):
+        # the profile and caching mode are recorded with the blob so
+        # later attaches of the disk use the same settings
+        metadata = None
+        if profile_name is not None or caching is not None:
+            metadata = {}
+            if profile_name is not None:
+                metadata[self.PROFILE_METADATA_KEY] = profile_name
+            if caching is not None:
+                metadata[self.CACHING_METADATA_KEY] = caching
         size_in_bytes = int(GiB(size_in_gibs).to_Byte().value)
-        link = Vhd.create_blank_vhd(self._storage_client,
+        link = Vhd.create_blank_vhd(self._storage_client_for_tier(storage),
                                     self._disk_container,
                                     disk_name + '.vhd',
-                                    size_in_bytes)
+                                    size_in_bytes,
+                                    metadata)
+        self._invalidate('disks')
         return link
 
+    def resize_disk(self, disk_name, size_in_gibs, deadline=None):
+        """
+        Grows a detached disk to ``size_in_gibs`` in place, without
+        copying its data.  The disk is leased while it is resized so it
+        can't be attached meanwhile.  The platform releases its own lease
+        shortly after a detach, so taking the lease is retried until the
+        deadline.
+        :returns: The url of the disk.
+        """
+        from azure.common import AzureConflictHttpError
+
+        deadline = self._deadline(deadline)
+        storage_client = self._storage_client_for_disk(disk_name)
+        blob_name = disk_name + '.vhd'
+        size_in_bytes = int(GiB(size_in_gibs).to_Byte().value)
+
+        with phase(u'resize_lease', disk=disk_name) as action:
+            polls = 1
+            while True:
+                try:
+                    lease_id = storage_client.acquire_blob_lease(
+                        self._disk_container, blob_name,
+                        lease_duration=self.CLAIM_LEASE_DURATION)
+                    break
+                except AzureConflictHttpError:
+                    self._sleep(1, deadline)
+                    polls += 1
+            action.addSuccessFields(polls=polls)
+
+        try:
+            size_in_bytes_with_footer = storage_client.get_blob_properties(
+                self._disk_container, blob_name,
+                lease_id=lease_id).properties.content_length
+            if size_in_bytes_with_footer > size_in_bytes + 512:
+                print("Disk %s of %d bytes can't shrink to %d GiB" %
+                      (disk_name, size_in_bytes_with_footer, size_in_gibs))
+                raise AzureOperationNotAllowed()
+            if size_in_bytes_with_footer < size_in_bytes + 512:
+                with phase(u'resize', disk=disk_name,
+                           size=size_in_bytes):
+                    Vhd.resize_vhd(storage_client, self._disk_container,
+                                   blob_name, size_in_bytes_with_footer,
+                                   size_in_bytes, lease_id)
+        finally:
+            self._invalidate('disks')
+            storage_client.release_blob_lease(self._disk_container,
+                                              blob_name, lease_id)
+        return storage_client.make_blob_url(self._disk_container, blob_name)
+
+    def _wait_for_copy(self, storage_client, blob_name, copy, deadline=None):
+        deadline = self._deadline(deadline)
+        with phase(u'copy_poll') as action:
+            polls = self._poll_copy(storage_client, blob_name, copy,
+                                    deadline)
+            action.addSuccessFields(polls=polls)
+
+    def _poll_copy(self, storage_client, blob_name, copy, deadline,
+                   on_poll=None):
+        # Server side copies within an account usually finish in a few
+        # seconds, so poll quickly at first and back off for copies
+        # that take longer.
+        delay = 0.5
+        polls = 0
+        while copy.status == "pending":
+            polls += 1
+            if on_poll is not None:
+                on_poll()
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                storage_client.abort_copy_blob(self._disk_container,
+                                               blob_name, copy.id)
+                raise AzureAsynchronousTimeout()
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 10)
+            copy = storage_client.get_blob_properties(
+                self._disk_container, blob_name).properties.copy
+            print("Copy of %s is %s, progress %s" %
+                  (blob_name, copy.status, copy.progress))
+
+        if copy.status != "success":
+            print("Copy of %s ended with status %s: %s" %
+                  (blob_name, copy.status, copy.status_description))
+            raise AzureCopyFailed()
+        return polls
+
+    def clone_disk(self, source_disk_name, disk_name, deadline=None):
+        """
+        Creates ``disk_name`` as a copy of ``source_disk_name`` using a
+        server side copy of a snapshot of the source, so no data passes
+        through this host.  The copy lives in the same storage account as
+        the source and keeps its profile and caching mode.  A copy which
+        fails or times out is deleted.
+        :returns: The url of the new disk.
+        :raises AzureOperationNotAllowed: If ``disk_name`` already exists.
+        """
+        from azure.common import AzureHttpError
+
+        storage_client = self._storage_client_for_disk(source_disk_name)
+        source_blob_name = source_disk_name + '.vhd'
+        blob_name = disk_name + '.vhd'
+
+        source_metadata = storage_client.get_blob_metadata(
+            self._disk_container, source_blob_name)
+        metadata = dict((k, v) for (k, v) in source_metadata.items()
+                        if k in (self.PROFILE_METADATA_KEY,
+                                 self.CACHING_METADATA_KEY))
+
+        # copy from a snapshot so writes to an attached source can't
+        # leave the copy in an inconsistent state
+        snapshot = storage_client.snapshot_blob(self._disk_container,
+                                                source_blob_name)
+        try:
+            source_url = storage_client.make_blob_url(
+                self._disk_container,
+                source_blob_name) + '?snapshot=' + snapshot.snapshot
+            # the copy never replaces an existing disk, even one created
+            # since it was checked for
+            try:
+                copy = storage_client.copy_blob(
+                    self._disk_container,
+                    blob_name,
+                    source_url,
+                    metadata=metadata or None,
+                    destination_if_none_match='*')
+            except AzureHttpError as e:
+                if e.status_code not in (409, 412):
+                    raise
+                print("Disk %s already exists" % disk_name)
+                raise AzureOperationNotAllowed()
+            try:
+                self._wait_for_copy(storage_client, blob_name, copy,
+                                    deadline)
+            except Exception:
+                self._delete_blob_if_exists(storage_client, blob_name)
+                raise
+        finally:
+            self._invalidate('disks')
+            storage_client.delete_blob(self._disk_container,
+                                       source_blob_name,
+                                       snapshot=snapshot.snapshot)
+
+        size_in_bytes_with_footer = storage_client.get_blob_properties(
+            self._disk_container, blob_name).properties.content_length
+        vhd_footer = Vhd.read_vhd_footer(storage_client,
+                                         self._disk_container,
+                                         blob_name,
+                                         size_in_bytes_with_footer)
+        Vhd.write_vhd_footer(storage_client,
+                             self._disk_container,
+                             blob_name,
+                             size_in_bytes_with_footer,
+                             Vhd.regenerate_unique_id(vhd_footer))
+
+        return storage_client.make_blob_url(self._disk_container, blob_name)
+
+    def migrate_disk(self, disk_name, target_storage, copy_timeout=21600,
+                     deadline=None):
+        """
+        Moves a detached disk to another storage account with a server
+        side copy, so no data passes through this host.
+
+        The disk is leased for the whole migration, which keeps it
+        detached and unchanged.  It is copied from a read-only SAS URL to
+        a staging blob in the target, checked against the source, then
+        copied to its own name within the target, which takes seconds,
+        before the source is deleted.  Until then the source is the disk,
+        and the copy in the target is marked so listings leave it out.
+        Should the delete fail, the copy is kept only if the source is
+        gone.
+        A failed migration removes the copies and leaves the source as it
+        was.  Snapshots of the source, such as backup bases, are deleted
+        with it, so the next backup of the disk is a full one.
+        :param str target_storage: A name from ``list_storage``.
+        :param float copy_timeout: Seconds the copies may take.
+        :returns: The url of the disk in the target.
+        """
+        from azure.common import AzureConflictHttpError, \
+            AzureMissingResourceHttpError
+        from azure.storage.blob import BlobPermissions
+
+        source_storage, source = self._storage_for_disk(disk_name)
+        target = self._storage_client_for_tier(target_storage)
+        if target_storage == source_storage:
+            raise AzureOperationNotAllowed()
+        blob_name = disk_name + '.vhd'
+        staging_name = self.MIGRATION_STAGING_PREFIX + \
+            disk_name.replace('flocker-', '', 1) + '.vhd'
+        self._ensure_containers()
+        if target.exists(self._disk_container, blob_name):
+            print("Disk %s already exists in %s" %
+                  (disk_name, target_storage))
+            raise AzureOperationNotAllowed()
+
+        copy_deadline = time.time() + copy_timeout
+        if deadline is not None:
+            copy_deadline = min(copy_deadline, deadline)
+        try:
+            lease_id = source.acquire_blob_lease(
+                self._disk_container, blob_name,
+                lease_duration=self.MIGRATION_LEASE_DURATION)
+        except AzureConflictHttpError:
+            print("Disk %s is leased, unable to migrate it" % disk_name)
+            raise AzureDiskClaimed()
+
+        def renew():
+            source.renew_blob_lease(self._disk_container, blob_name,
+                                    lease_id)
+
+        deleting = False
+        try:
+            blob = source.get_blob_properties(self._disk_container,
+                                              blob_name, lease_id=lease_id)
+            owner, lun = self._owner_from_metadata(blob.metadata)
+            if owner is not None:
+                print("Disk %s is recorded on %s lun %s" %
+                      (disk_name, owner, lun))
+                raise AzureDiskClaimed()
+            size = blob.properties.content_length
+            metadata = dict((k, v) for (k, v) in
+                            (blob.metadata or {}).items()
+                            if k != self.MIGRATED_FROM_METADATA_KEY)
+
+            sas_token = source.generate_blob_shared_access_signature(
+                self._disk_container, blob_name,
+                permission=BlobPermissions.READ,
+                expiry=datetime.datetime.utcnow() + datetime.timedelta(
+                    seconds=copy_timeout + 3600))
+            with phase(u'migrate_copy', target=target_storage,
+                       size=size) as action:
+                copy = target.copy_blob(
+                    self._disk_container, staging_name,
+                    source.make_blob_url(self._disk_container, blob_name,
+                                         sas_token=sas_token))
+                action.addSuccessFields(polls=self._poll_copy(
+                    target, staging_name, copy, copy_deadline, renew))
+            with phase(u'migrate_verify'):
+                self._verify_copy(source, blob_name, target, staging_name,
+                                  size)
+            with phase(u'migrate_switch'):
+                marked = dict(metadata)
+                marked[self.MIGRATED_FROM_METADATA_KEY] = source_storage
+                copy = target.copy_blob(
+                    self._disk_container, blob_name,
+                    target.make_blob_url(self._disk_container,
+                                         staging_name),
+                    metadata=marked)
+                self._poll_copy(target, blob_name, copy, copy_deadline,
+                                renew)
+                self._verify_copy(source, blob_name, target, blob_name,
+                                  size)
+                # a delete that fails may still have removed the source,
+                # and one retried after it did finds nothing
+                deleting = True
+                try:
+                    source.delete_blob(self._disk_container, blob_name,
+                                       lease_id=lease_id,
+                                       delete_snapshots='include')
+                except AzureMissingResourceHttpError:
+                    pass
+            lease_id = None
+        finally:
+            self._invalidate('disks')
+            if lease_id is not None and \
+                    (not deleting or
+                     source.exists(self._disk_container, blob_name)):
+                self._delete_blob_if_exists(target, blob_name)
+                source.release_blob_lease(self._disk_container, blob_name,
+                                          lease_id)
+            self._delete_blob_if_exists(target, staging_name)
+
+        try:
+            target.set_blob_metadata(self._disk_container, blob_name,
+                                     metadata)
+        except Exception as e:
+            # the mark only hides a copy while its source is listed
+            print("Unable to unmark migrated disk %s: %r" % (disk_name, e))
+
+        print("Migrated disk %s from %s to %s" %
+              (disk_name, source_storage, target_storage))
+        return target.make_blob_url(self._disk_container, blob_name)
+
+    def _verify_copy(self, source, source_name, target, target_name, size):
+        # the footer is the last page, so a copy of the right length with
+        # the source footer was copied to the end
+        copied_size = target.get_blob_properties(
+            self._disk_container, target_name).properties.content_length
+        if copied_size != size or \
+                Vhd.read_vhd_footer(target, self._disk_container,
+                                    target_name, size) != \
+                Vhd.read_vhd_footer(source, self._disk_container,
+                                    source_name, size):
+            print("Copy %s of %s does not match the source" %
+                  (target_name, source_name))
+            raise AzureCopyFailed()
+
+    def _delete_blob_if_exists(self, client, blob_name):
+        from azure.common import AzureMissingResourceHttpError
+
+        try:
+            client.delete_blob(self._disk_container, blob_name)
+        except AzureMissingResourceHttpError:
+            pass
+
+    def get_disk_caching(self, disk):
+        """
+        Returns the caching mode recorded for a disk returned from
+        ``list_disks``, defaulting to no caching.
+        """
+        metadata = disk.metadata or {}
+        return metadata.get(self.CACHING_METADATA_KEY, "None")
+
     def is_disk_attached(self, vm_name, disk_name):
         disks = self.list_attached_disks(vm_name)
         return disk_name in [d.name for d in disks]
@@ -180,25 +1336,174 @@ class DiskManager(object):
         return False
 
     def list_attached_disks(self, vm_name):
+        from azure.mgmt.compute.models import DataDisk
+
         vm = self.get_vm(vm_name=vm_name, expand="instanceView")
 
         disks_in_model = vm.storage_profile.data_disks
-        disk_names = [d.name for d in disks_in_model]
+        for disk in self.list_stuck_disks(vm):
+            disks_in_model.append(DataDisk(lun=-1, name=disk.name))
+
+        return disks_in_model
 
+    def list_stuck_disks(self, vm):
+        """
+        Returns the instance view disks of a VM, fetched with the
+        instanceView expansion, which are not in the VM model.
+        """
         # If there's a disk in the instance view which is not in the model.
-        # This disk is stuck.  Add it to our list since we need to know
-        # about stuck disks
-        for disk_instance in vm.instance_view.disks:
-            if disk_instance.name in disk_names is None:
-                disk = DataDisk(lun=-1,
-                                name=disk_instance.name)
-                disks_in_model.append(disk)
+        # This disk is stuck.  The OS disk is only in the instance view.
+        disk_names = set(d.name for d in vm.storage_profile.data_disks)
+        disk_names.add(vm.storage_profile.os_disk.name)
 
-        return disks_in_model
+        stuck = []
+        if vm.instance_view is not None:
+            for disk_instance in vm.instance_view.disks:
+                if disk_instance.name not in disk_names:
+                    stuck.append(disk_instance)
+        return stuck
+
+    def list_failed_disks(self, vm):
+        """
+        Returns the data disks in the model of a VM, fetched with the
+        instanceView expansion, whose provisioning failed.
+        """
+        disk_names = set(d.name for d in vm.storage_profile.data_disks)
+
+        failed = []
+        if vm.instance_view is not None:
+            for disk_instance in vm.instance_view.disks:
+                if disk_instance.name in disk_names and \
+                        disk_instance.statuses and \
+                        disk_instance.statuses[0].code.startswith(
+                            "ProvisioningState/failed"):
+                    failed.append(disk_instance)
+        return failed
+
+    def is_flocker_node(self, vm):
+        # named nodes add to the tagged ones, and untagged VMs found
+        # hosting flocker disks by a full scan are nodes either way
+        tags = vm.tags or {}
+        return vm.name in self._node_names or \
+            vm.name in self._untagged_nodes or \
+            tags.get(self._node_tag) == 'true'
+
+    def list_vms(self, full_scan=False):
+        """
+        Returns the VM models of the flocker nodes in the resource groups.
+        :param bool full_scan: Return every VM in the groups.  A full scan
+            also happens every ``full_scan_interval`` seconds, and records
+            untagged VMs hosting flocker disks as flocker nodes.
+        """
+        vms = self._list_all_vms(fresh=full_scan)
+
+        if full_scan or \
+                time.time() - self._last_full_scan > self._full_scan_interval:
+            self._last_full_scan = time.time()
+            for vm in vms:
+                if not self.is_flocker_node(vm) and \
+                        self.hosts_flocker_disks(vm):
+                    print("Found untagged VM %s with flocker disks" %
+                          vm.name)
+                    self._untagged_nodes.add(vm.name)
+
+        if full_scan:
+            return vms
+        return [vm for vm in vms if self.is_flocker_node(vm)]
+
+    def _list_all_vms(self, fresh=False):
+        # every group is listed at once, each through its own cache entry
+        if len(self._groups) == 1:
+            return self._list_group_vms(self._groups[0], fresh)
+        with ThreadPoolExecutor(max_workers=len(self._groups)) as pool:
+            listings = list(pool.map(
+                lambda group: self._list_group_vms(group, fresh),
+                self._groups))
+        return [vm for vms in listings for vm in vms]
+
+    def _list_group_vms(self, group, fresh=False):
+        def fetch():
+            return list(group.compute_client.virtual_machines.list(
+                group.name))
+
+        if fresh:
+            vms = fetch()
+            if self._node_cache is not None:
+                self._node_cache.put(
+                    self._cache_key('vms', scope=group.key), vms)
+        else:
+            vms = self._cached('vms', fetch, scope=group.key)
+
+        order = self._groups.index(group)
+        with self._vm_groups_lock:
+            for vm in vms:
+                indexed = self._vm_groups.get(vm.name)
+                if indexed is None or \
+                        self._groups.index(indexed) >= order:
+                    self._vm_groups[vm.name] = group
+        return vms
+
+    def _group_for_vm(self, vm_name):
+        if len(self._groups) == 1:
+            return self._groups[0]
+        group = self._vm_groups.get(vm_name)
+        if group is None:
+            # a VM not seen yet; a listing of every group indexes it
+            self._list_all_vms()
+            group = self._vm_groups.get(vm_name, self._groups[0])
+        return group
+
+    def hosts_flocker_disks(self, vm):
+        for disk in vm.storage_profile.data_disks:
+            if 'flocker-' in disk.name or \
+                    disk.name.endswith(self.LUN0_RESERVED_VHD_NAME_SUFFIX):
+                return True
+        return False
+
+    def find_stuck_state(self, vm_name):
+        """
+        Returns the names of the stuck and of the failed disks of a VM, as
+        ``list_stuck_disks`` and ``list_failed_disks`` find them, or
+        ``None`` while an update of the VM is in flight, when the model
+        and instance view are expected to differ.
+        """
+        return self._stuck_state(self.get_vm(vm_name, expand="instanceView"))
+
+    def _stuck_state(self, vm):
+        if vm.provisioning_state not in ("Succeeded", "Failed"):
+            return None
+        return ([d.name for d in self.list_stuck_disks(vm)],
+                [d.name for d in self.list_failed_disks(vm)])
+
+    def reconcile_vm(self, vm_name, deadline=None):
+        """
+        Clears stuck disk state from a VM.  Data disks whose provisioning
+        failed are removed from the model, then the model is updated, which
+        makes the service drop disks that are only in the instance view.
+
+        The VM is checked again first, and left alone while an update of
+        it is in flight or once nothing is stuck.  The update replaces the
+        whole model, so callers must serialize it with their own attaches
+        and detaches of the VM, and only reconcile VMs no other agent
+        updates.
+        :returns: The names of the stuck and of the failed disks cleared.
+        """
+        vm = self.get_vm(vm_name, expand="instanceView")
+        state = self._stuck_state(vm)
+        if state is None or state == ([], []):
+            return ([], [])
+        stuck, failed = state
+        # the instance view is read only, and not sent with the update
+        vm.storage_profile.data_disks = [
+            d for d in vm.storage_profile.data_disks
+            if d.name not in failed]
+        self._update_vm_and_wait(vm_name, vm, deadline)
+        return state
 
     def get_vm(self, vm_name, expand=None):
-        return self._compute_client.virtual_machines.get(
-            resource_group_name=self._resource_group,
+        group = self._group_for_vm(vm_name)
+        return group.compute_client.virtual_machines.get(
+            resource_group_name=group.name,
             vm_name=vm_name,
             expand=expand)
 
@@ -206,15 +1511,20 @@ class DiskManager(object):
         # To ensure the VM update will be a async update even if the
         # VM did not change we force a change to the VM by setting a
         # tag in every PUT request with a UUID
-        if vm.tags is not None:
-            vm.tags['updateId'] = str(uuid.uuid4())
-        else:
-            vm.tags = {'updateId': str(uuid.uuid4())}
+        # The flocker node tag lets VM discovery skip VMs which are not
+        # flocker nodes.
+        if vm.tags is None:
+            vm.tags = {}
+        vm.tags['updateId'] = str(uuid.uuid4())
+        vm.tags[self._node_tag] = 'true'
 
-        return self._compute_client.virtual_machines.create_or_update(
-            self._resource_group,
-            vm_name,
-            vm)
+        group = self._group_for_vm(vm_name)
+        try:
+            with phase(u'put', vm=vm_name):
+                return group.compute_client.virtual_machines \
+                    .create_or_update(group.name, vm_name, vm)
+        finally:
+            self._invalidate_vms(vm_name)
 
     def _attach_or_detach_disk(self,
                                vm_name,
@@ -223,18 +1533,26 @@ class DiskManager(object):
                                lun,
                                detach=False,
                                allow_lun_0_detach=False,
-                               is_from_retry=False):
-        vmcompute = self.get_vm(vm_name)
+                               is_from_retry=False,
+                               caching="None",
+                               storage=STANDARD_STORAGE,
+                               deadline=None):
+        from azure.mgmt.compute.models import DataDisk, VirtualHardDisk
+
+        deadline = self._deadline(deadline)
+        with phase(u'get_vm'):
+            vmcompute = self.get_vm(vm_name)
 
         if (not detach):
-            vhd_url = self._storage_client.make_blob_url(self._disk_container,
-                                                         vhd_name + ".vhd")
-            print("Attach disk name %s lun %s uri %s" %
-                  (vhd_name, lun, vhd_url))
+            storage_client = self._storage_client_for_tier(storage)
+            vhd_url = storage_client.make_blob_url(self._disk_container,
+                                                   vhd_name + ".vhd")
+            print("Attach disk name %s lun %s uri %s caching %s" %
+                  (vhd_name, lun, vhd_url, caching))
             disk = DataDisk(lun=lun,
                             name=vhd_name,
                             vhd=VirtualHardDisk(vhd_url),
-                            caching="None",
+                            caching=caching,
                             create_option="attach",
                             disk_size_gb=vhd_size_in_gibs)
             vmcompute.storage_profile.data_disks.append(disk)
@@ -253,26 +1571,16 @@ class DiskManager(object):
                     break
 
         result = self._update_vm(vm_name, vmcompute)
-        start = time.time()
+        attempts = 1
         while True:
-            time.sleep(2)
-            waited_sec = int(abs(time.time() - start))
-            if waited_sec > self._async_timeout:
-                raise AzureAsynchronousTimeout()
-
-            if not result.done():
-                continue
-
-            updated = self.get_vm(vm_name)
+            provisioning_state = self._wait_for_provisioning(vm_name, result,
+                                                             deadline)
 
-            print("Waited for %s s provisioningState is %s" %
-                  (waited_sec, updated.provisioning_state))
-
-            if updated.provisioning_state == "Succeeded":
+            if provisioning_state == "Succeeded":
                 print("Operation finshed")
-                break
+                return attempts
 
-            if updated.provisioning_state == "Failed":
+            if provisioning_state == "Failed":
                 print("Provisioning ended up in failed state.")
 
                 # Recovery from failed disk atatch-detach operation.
@@ -292,7 +1600,35 @@ class DiskManager(object):
                                                 lun,
                                                 detach=True,
                                                 allow_lun_0_detach=True,
-                                                is_from_retry=True)
+                                                is_from_retry=True,
+                                                deadline=deadline)
 
                 print("Retry disk action for disk %s" % vhd_name)
+                attempts += 1
                 result = self._update_vm(vm_name, vmcompute)
+
+    def _wait_for_provisioning(self, vm_name, result, deadline):
+        # Waits for a VM update to reach a final provisioning state and
+        # returns that state
+        start = time.time()
+        with phase(u'provisioning_poll', vm=vm_name) as action:
+            polls = 0
+            while True:
+                self._sleep(2, deadline)
+                polls += 1
+                waited_sec = int(time.time() - start)
+
+                if not result.done():
+                    continue
+
+                updated = self.get_vm(vm_name)
+
+                print("Waited for %s s provisioningState is %s" %
+                      (waited_sec, updated.provisioning_state))
+
+                if updated.provisioning_state in ("Succeeded", "Failed"):
+                    self._invalidate_vms(vm_name)
+                    action.addSuccessFields(
+                        polls=polls,
+                        provisioning_state=updated.provisioning_state)
+                    return updated.provisioning_state
@@ -0,0 +1,228 @@
+from azure.common import AzureMissingResourceHttpError
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+
+
+# update_page accepts at most 4MiB per call, so ranges are read and
+# written in chunks of that size
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+
+BACKUP_SNAPSHOT_METADATA_KEY = "flocker_backup_snapshot"
+
+
+def allocated_bytes(page_ranges):
+    """
+    Returns the number of bytes covered by a list of ``PageRange``s
+    returned from ``get_page_ranges``.  Page range ends are inclusive.
+    """
+    total = 0
+    for page_range in page_ranges:
+        total += page_range.end - page_range.start + 1
+    return total
+
+
+def split_ranges(page_ranges, chunk_size=MAX_CHUNK_SIZE):
+    """
+    Splits page ranges into ``(start, end, is_cleared)`` chunks no larger
+    than ``chunk_size`` bytes.  Ends are inclusive.
+    """
+    chunks = []
+    for page_range in page_ranges:
+        start = page_range.start
+        while start <= page_range.end:
+            end = min(start + chunk_size - 1, page_range.end)
+            chunks.append((start, end, page_range.is_cleared))
+            start = end + 1
+    return chunks
+
+
+class BackupResult(object):
+    """
+    The outcome of a single backup.
+    :ivar str snapshot: The source snapshot the backup was taken from.
+    :ivar bool incremental: Whether only changes since the previous
+        backup were copied.
+    :ivar int provisioned_bytes: The size of the source blob.
+    :ivar int transferred_bytes: The bytes read from the source.
+    :ivar int cleared_bytes: The bytes cleared in the source since the
+        previous backup, which were zeroed in the target.
+    """
+
+    def __init__(self, snapshot, incremental, provisioned_bytes):
+        self.snapshot = snapshot
+        self.incremental = incremental
+        self.provisioned_bytes = provisioned_bytes
+        self.transferred_bytes = 0
+        self.cleared_bytes = 0
+
+
+class _FileTarget(object):
+
+    def __init__(self, path):
+        self._path = path
+        self._state_path = path + '.snapshot'
+        self._lock = threading.Lock()
+        self._file = None
+
+    def previous_snapshot(self):
+        if not os.path.exists(self._path) or \
+                not os.path.exists(self._state_path):
+            return None
+        with open(self._state_path) as f:
+            return f.read().strip() or None
+
+    def open(self, size, incremental):
+        if incremental:
+            self._file = open(self._path, 'r+b')
+        else:
+            # start from an empty sparse file so pages cleared in the
+            # source don't survive from an older backup
+            self._file = open(self._path, 'wb')
+        self._file.truncate(size)
+
+    def write(self, start, data):
+        with self._lock:
+            self._file.seek(start)
+            self._file.write(data)
+
+    def clear(self, start, end):
+        self.write(start, b'\0' * (end - start + 1))
+
+    def close(self, snapshot):
+        self._file.close()
+        with open(self._state_path, 'w') as f:
+            f.write(snapshot)
+
+
+class _BlobTarget(object):
+
+    def __init__(self, storage_client, container_name, blob_name):
+        self._storage_client = storage_client
+        self._container = container_name
+        self._blob_name = blob_name
+
+    def previous_snapshot(self):
+        try:
+            metadata = self._storage_client.get_blob_metadata(
+                self._container, self._blob_name)
+        except AzureMissingResourceHttpError:
+            return None
+        return metadata.get(BACKUP_SNAPSHOT_METADATA_KEY)
+
+    def open(self, size, incremental):
+        self._storage_client.create_container(self._container)
+        if incremental:
+            self._storage_client.resize_blob(self._container,
+                                             self._blob_name, size)
+        else:
+            self._storage_client.create_blob(self._container,
+                                             self._blob_name, size)
+
+    def write(self, start, data):
+        self._storage_client.update_page(self._container, self._blob_name,
+                                         data, start, start + len(data) - 1)
+
+    def clear(self, start, end):
+        self._storage_client.clear_page(self._container, self._blob_name,
+                                        start, end)
+
+    def close(self, snapshot):
+        self._storage_client.set_blob_metadata(
+            self._container, self._blob_name,
+            {BACKUP_SNAPSHOT_METADATA_KEY: snapshot})
+
+
+class PageRangeBackup(object):
+    """
+    Backs up page blobs by copying only populated pages.
+
+    Each backup takes a snapshot of the source blob.  When the target
+    holds a backup from an earlier snapshot that still exists, only the
+    page ranges that differ between the two snapshots are copied.  The
+    latest snapshot is kept as the base for the next backup and older
+    ones are deleted.
+    """
+
+    def __init__(self, storage_client, container_name, max_workers=8):
+        self._storage_client = storage_client
+        self._container = container_name
+        self._max_workers = max_workers
+
+    def backup_to_file(self, blob_name, path):
+        return self._backup(blob_name, _FileTarget(path))
+
+    def backup_to_container(self, blob_name, target_container_name,
+                            target_blob_name=None):
+        return self._backup(blob_name, _BlobTarget(
+            self._storage_client, target_container_name,
+            target_blob_name or blob_name))
+
+    def _changed_ranges(self, blob_name, snapshot, previous_snapshot):
+        if previous_snapshot is not None:
+            try:
+                return self._storage_client.get_page_ranges_diff(
+                    self._container, blob_name,
+                    previous_snapshot=previous_snapshot,
+                    snapshot=snapshot), True
+            except AzureMissingResourceHttpError:
+                print("Snapshot %s of %s no longer exists, taking a full "
+                      "backup" % (previous_snapshot, blob_name))
+        return self._storage_client.get_page_ranges(
+            self._container, blob_name, snapshot=snapshot), False
+
+    def _copy_chunk(self, blob_name, snapshot, target, chunk):
+        start, end, is_cleared = chunk
+        if is_cleared:
+            target.clear(start, end)
+            return 0
+        blob = self._storage_client.get_blob_to_bytes(
+            self._container, blob_name, snapshot=snapshot,
+            start_range=start, end_range=end)
+        target.write(start, blob.content)
+        return len(blob.content)
+
+    def _backup(self, blob_name, target):
+        previous_snapshot = target.previous_snapshot()
+        snapshot = self._storage_client.snapshot_blob(
+            self._container, blob_name).snapshot
+
+        try:
+            size = self._storage_client.get_blob_properties(
+                self._container, blob_name,
+                snapshot=snapshot).properties.content_length
+            page_ranges, incremental = self._changed_ranges(
+                blob_name, snapshot, previous_snapshot)
+            result = BackupResult(snapshot, incremental, size)
+
+            chunks = split_ranges(page_ranges)
+            target.open(size, incremental)
+            pool = ThreadPoolExecutor(max_workers=self._max_workers)
+            try:
+                futures = [pool.submit(self._copy_chunk, blob_name,
+                                       snapshot, target, chunk)
+                           for chunk in chunks]
+                for chunk, future in zip(chunks, futures):
+                    copied = future.result()
+                    result.transferred_bytes += copied
+                    if chunk[2]:
+                        result.cleared_bytes += chunk[1] - chunk[0] + 1
+            finally:
+                pool.shutdown(wait=True)
+            target.close(snapshot)
+        except Exception:
+            # the new snapshot is useless without a completed backup
+            self._storage_client.delete_blob(self._container, blob_name,
+                                             snapshot=snapshot)
+            raise
+
+        if previous_snapshot is not None:
+            try:
+                self._storage_client.delete_blob(
+                    self._container, blob_name, snapshot=previous_snapshot)
+            except AzureMissingResourceHttpError:
+                pass
+
+        print("Backup of %s from snapshot %s copied %s of %s bytes" %
+              (blob_name, snapshot, result.transferred_bytes, size))
+        return result
@@ -0,0 +1,150 @@
+import eliot
+import socket
+import threading
+import time
+import types
+
+_logger = eliot.Logger()
+
+# Method name prefixes of SDK clients which build values locally and never
+# make a request, so are not counted by a breaker
+LOCAL_METHOD_PREFIXES = ('make_', 'generate_')
+
+
+class CircuitOpen(Exception):
+
+    def __init__(self, endpoint):
+        Exception.__init__(self, endpoint)
+        self.endpoint = endpoint
+
+
+def is_endpoint_failure(error):
+    """
+    Returns whether an error raised by an SDK call means the endpoint is
+    unhealthy, rather than that the request was refused.  Server errors,
+    throttling, timeouts and connection failures count; missing resources,
+    conflicts and other client errors do not.
+    """
+    from azure.common import AzureException
+    from msrest.exceptions import ClientRequestError
+    from requests.exceptions import RequestException
+
+    status_code = getattr(error, 'status_code', None)
+    if status_code is not None:
+        return status_code >= 500 or status_code in (408, 429)
+    return isinstance(error, (AzureException, ClientRequestError,
+                              RequestException, socket.error))
+
+
+def is_paged(value):
+    """
+    Returns whether an SDK call returned a paged result, such as the VM
+    listing or a blob listing, which makes requests as it is read.
+    """
+    return isinstance(value, types.GeneratorType) or \
+        type(value).__name__ == 'ListGenerator' or \
+        hasattr(value, 'next_link')
+
+
+class CircuitBreaker(object):
+    """
+    Fails calls to an endpoint fast once it has failed repeatedly.
+
+    After ``failure_threshold`` consecutive failures the breaker opens and
+    calls raise ``CircuitOpen`` without a request.  Once ``reset_timeout``
+    seconds have passed the breaker is half open: a single call is let
+    through as a probe, and closes the breaker if it succeeds or opens it
+    again if it fails.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, endpoint, failure_threshold=5, reset_timeout=30):
+        self.endpoint = endpoint
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self.state = self.CLOSED
+
+    def _set_state(self, state):
+        if state != self.state:
+            eliot.Message.new(
+                message_type=u"azure_flocker_driver:breaker:state",
+                endpoint=self.endpoint,
+                old_state=self.state,
+                new_state=state,
+                failures=self._failures).write(_logger)
+            self.state = state
+
+    def _before_call(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN:
+                if time.time() - self._opened_at < self._reset_timeout:
+                    raise CircuitOpen(self.endpoint)
+                self._set_state(self.HALF_OPEN)
+            if self._probing:
+                raise CircuitOpen(self.endpoint)
+            self._probing = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._probing = False
+            self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or \
+                    self._failures >= self._failure_threshold:
+                self._opened_at = time.time()
+                self._set_state(self.OPEN)
+
+    def call(self, function, *args, **kwargs):
+        self._before_call()
+        try:
+            result = function(*args, **kwargs)
+            if is_paged(result):
+                # read here, so the requests of every page are counted
+                result = list(result)
+        except Exception as e:
+            if is_endpoint_failure(e):
+                self.record_failure()
+            else:
+                # the endpoint answered, even if it refused the request
+                self.record_success()
+            raise
+        self.record_success()
+        return result
+
+
+class BreakerProxy(object):
+    """
+    Wraps an SDK client so every request it makes goes through a breaker.
+    Attributes named in ``operations``, such as ``virtual_machines`` of a
+    compute client, are wrapped in turn.
+    """
+
+    def __init__(self, target, breaker, operations=()):
+        self._target = target
+        self._breaker = breaker
+        self._operations = operations
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if name in self._operations:
+            return BreakerProxy(value, self._breaker)
+        if not callable(value) or name.startswith(LOCAL_METHOD_PREFIXES):
+            return value
+
+        def call(*args, **kwargs):
+            return self._breaker.call(value, *args, **kwargs)
+        return call
@@ -0,0 +1,135 @@
+from msrestazure.azure_active_directory import ServicePrincipalCredentials
+import json
+import os
+import threading
+import time
+
+
+class CachedServicePrincipalCredentials(ServicePrincipalCredentials):
+    """
+    Service principal credentials which keep their token in a file only
+    readable by the owner, so a restarted agent can reuse an unexpired
+    token, and which refresh the token in the background before it
+    expires, so no request waits on AAD.
+
+    Refreshes requested by several threads at once are coalesced into a
+    single token request.
+    """
+
+    # seconds before expiry at which the token is refreshed
+    REFRESH_MARGIN = 300
+
+    # seconds to wait before retrying a failed background refresh
+    RETRY_INTERVAL = 30
+
+    def __init__(self, client_id, secret, cache_path, **kwargs):
+        self._cache_path = cache_path
+        self._refresh_lock = threading.Lock()
+        self._generation = 0
+        self._timer = None
+        self._timer_lock = threading.Lock()
+
+        kwargs['cached'] = True
+        super(CachedServicePrincipalCredentials, self).__init__(
+            client_id, secret, **kwargs)
+
+        self.token = self._load_cached_token()
+        if self.token is None:
+            self.set_token()
+        else:
+            self._schedule_refresh()
+
+    def _cache_identity(self):
+        return {'client_id': self.id,
+                'token_uri': self.token_uri,
+                'resource': self.resource}
+
+    def _expires_in(self, token=None):
+        token = token or self.token or {}
+        expires_at = token.get('expires_at', token.get('expires_on'))
+        if expires_at is None:
+            return 0
+        return float(expires_at) - time.time()
+
+    def _load_cached_token(self):
+        try:
+            with open(self._cache_path) as cache_file:
+                cached = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return None
+
+        identity = self._cache_identity()
+        for key in identity:
+            if cached.get(key) != identity[key]:
+                return None
+        token = cached.get('token')
+        if not token or self._expires_in(token) < self.REFRESH_MARGIN:
+            return None
+        return token
+
+    def _default_token_cache(self, token):
+        self.token = token
+        cached = self._cache_identity()
+        cached['token'] = token
+
+        # write a new file and rename it over the old one, so readers
+        # never see a partial token and the mode is set before any
+        # secret is written
+        temp_path = self._cache_path + '.tmp'
+        try:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0o600)
+            with os.fdopen(fd, 'w') as cache_file:
+                json.dump(cached, cache_file)
+            os.rename(temp_path, self._cache_path)
+        except (IOError, OSError) as e:
+            print("Unable to cache token in %s: %s" % (self._cache_path, e))
+
+    def _refresh(self, generation):
+        with self._refresh_lock:
+            # another thread fetched a token while this one waited
+            if generation != self._generation and \
+                    self._expires_in() > self.REFRESH_MARGIN:
+                return
+            super(CachedServicePrincipalCredentials, self).set_token()
+            self._generation += 1
+        self._schedule_refresh()
+
+    def set_token(self):
+        self._refresh(self._generation)
+
+    def signed_session(self, session=None):
+        # the generation is read before the expiry check, so a thread
+        # which sees an expired token can tell whether another thread has
+        # refreshed it since
+        generation = self._generation
+        if self._expires_in() <= 0:
+            self._refresh(generation)
+        return super(CachedServicePrincipalCredentials, self).signed_session(
+            session)
+
+    def _background_refresh(self):
+        try:
+            self.set_token()
+        except Exception as e:
+            print("Background token refresh failed, retrying in %s s: %s" %
+                  (self.RETRY_INTERVAL, e))
+            self._schedule_refresh(self.RETRY_INTERVAL)
+
+    def _schedule_refresh(self, delay=None):
+        if delay is None:
+            delay = max(self._expires_in() - self.REFRESH_MARGIN, 1)
+        with self._timer_lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(delay, self._background_refresh)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def stop(self):
+        with self._timer_lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
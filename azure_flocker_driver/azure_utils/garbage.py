@@ -0,0 +1,222 @@
+from concurrent.futures import ThreadPoolExecutor
+import calendar
+import eliot
+import json
+import threading
+import time
+
+_logger = eliot.Logger()
+
+FLOCKER_DISK_PREFIX = 'flocker-'
+
+# Kinds of orphaned blob
+ORPHANED_VOLUME = 'volume'
+ORPHANED_LUN0_RESERVATION = 'lun0_reservation'
+
+
+class Orphan(object):
+    """
+    A blob no VM or Flocker refers to.
+    :ivar str name: The disk name, without the ``.vhd`` suffix.
+    :ivar str kind: ``ORPHANED_VOLUME`` or ``ORPHANED_LUN0_RESERVATION``.
+    :ivar str storage: The storage tier the blob is in.
+    :ivar str etag: The ETag of the blob when it was listed.
+    :ivar int size: The provisioned size of the blob in bytes.
+    :ivar float last_modified: When the blob was last modified, in seconds
+        since the epoch.
+    """
+
+    def __init__(self, name, kind, storage, etag, size, last_modified):
+        self.name = name
+        self.kind = kind
+        self.storage = storage
+        self.etag = etag
+        self.size = size
+        self.last_modified = last_modified
+
+
+class CollectionReport(object):
+    """
+    The result of one ``OrphanCollector.collect`` pass.
+    :ivar int blobs_listed: Blobs in the container listings.
+    :ivar list orphans: The ``Orphan``s found.
+    :ivar list deleted: Names of the orphans deleted.
+    :ivar dict failed: Names of orphans mapped to the error deleting them.
+    :ivar bool dry_run: Whether deletes were only reported.
+    :ivar float duration: Seconds the pass took.
+    """
+
+    def __init__(self, dry_run):
+        self.blobs_listed = 0
+        self.orphans = []
+        self.deleted = []
+        self.failed = {}
+        self.dry_run = dry_run
+        self.duration = 0.0
+
+
+class _RateLimiter(object):
+    # spaces calls at least 1 / rate seconds apart across threads
+
+    def __init__(self, rate):
+        self._interval = 1.0 / rate if rate else 0
+        self._lock = threading.Lock()
+        self._next = 0
+
+    def wait(self):
+        with self._lock:
+            now = time.time()
+            start = max(now, self._next)
+            self._next = start + self._interval
+        if start > now:
+            time.sleep(start - now)
+
+
+def _epoch(last_modified):
+    if last_modified is None:
+        return 0
+    return calendar.timegm(last_modified.utctimetuple())
+
+
+class OrphanCollector(object):
+    """
+    Finds and deletes blobs in the disk container that nothing refers to.
+
+    A single listing of the container is joined with a single listing of
+    every VM in the resource group.  A blob is an orphan when it is not
+    leased, which Azure does for attached disks and this driver while it
+    records an attachment, no VM model refers to it, and it was not
+    modified during the grace period, which covers disks being created
+    or attached.  LUN-0 reservations are orphans once their VM is gone.
+    ``flocker-`` volumes are only orphans when the caller passes the
+    blockdevice ids Flocker knows about and the volume is not one of
+    them.  Other blobs, such as OS disks, are never touched.
+    """
+
+    def __init__(self, manager, grace_period=86400, max_workers=8,
+                 rate=10, audit_log_path=None):
+        """
+        :param DiskManager manager: The disk manager to list and delete
+            disks with.
+        :param float grace_period: Seconds a blob must have been left
+            unmodified to be an orphan.
+        :param int max_workers: Deletes to run at once.
+        :param float rate: Most deletes to start per second, or ``None``
+            for no limit.
+        :param str audit_log_path: A file to append a JSON line to for
+            every orphan deleted, or found in a dry run.
+        """
+        self._manager = manager
+        self._grace_period = grace_period
+        self._max_workers = max_workers
+        self._rate = rate
+        self._audit_log_path = audit_log_path
+        self._audit_lock = threading.Lock()
+
+    def find_orphans(self, known_disk_names=None, report=None):
+        """
+        :param known_disk_names: The blockdevice ids Flocker reports, or
+            ``None`` to leave every ``flocker-`` volume alone.
+        :returns: A ``list`` of ``Orphan``s.
+        """
+        now = time.time()
+        vm_names = set()
+        referenced = set()
+        for vm in self._manager.list_vms(full_scan=True):
+            vm_names.add(vm.name)
+            for disk in vm.storage_profile.data_disks:
+                referenced.add(disk.name)
+                if disk.vhd is not None:
+                    referenced.add(
+                        disk.vhd.uri.rsplit('/', 1)[-1].replace('.vhd', ''))
+
+        reservation_suffix = '-' + self._manager.LUN0_RESERVED_VHD_NAME_SUFFIX
+        orphans = []
+        for blob in self._manager.list_disks():
+            if report is not None:
+                report.blobs_listed += 1
+            if blob.name.startswith(FLOCKER_DISK_PREFIX):
+                if known_disk_names is None or \
+                        blob.name in known_disk_names:
+                    continue
+                kind = ORPHANED_VOLUME
+            elif blob.name.endswith(reservation_suffix):
+                if blob.name[:-len(reservation_suffix)] in vm_names:
+                    continue
+                kind = ORPHANED_LUN0_RESERVATION
+            else:
+                continue
+
+            properties = blob.properties
+            if properties.lease.state == 'leased' or \
+                    blob.name in referenced:
+                continue
+            last_modified = _epoch(properties.last_modified)
+            if now - last_modified < self._grace_period:
+                continue
+            orphans.append(Orphan(blob.name, kind, blob.storage,
+                                  properties.etag,
+                                  properties.content_length,
+                                  last_modified))
+        return orphans
+
+    def _audit(self, action, orphan, error=None):
+        if self._audit_log_path is None:
+            return
+        entry = {'time': time.time(),
+                 'action': action,
+                 'name': orphan.name,
+                 'kind': orphan.kind,
+                 'storage': orphan.storage,
+                 'size': orphan.size,
+                 'last_modified': orphan.last_modified}
+        if error is not None:
+            entry['error'] = str(error)
+        with self._audit_lock:
+            with open(self._audit_log_path, 'a') as audit_log:
+                audit_log.write(json.dumps(entry, sort_keys=True) + '\n')
+
+    def _delete(self, orphan, limiter):
+        limiter.wait()
+        # the delete only succeeds if the blob is unchanged since it was
+        # listed and has not been leased by an attach since
+        self._manager.destroy_disk(orphan.name, storage=orphan.storage,
+                                   etag=orphan.etag)
+
+    def collect(self, known_disk_names=None, dry_run=True):
+        """
+        Finds orphans and, unless ``dry_run``, deletes them concurrently.
+        :returns: A ``CollectionReport``.
+        """
+        start = time.time()
+        report = CollectionReport(dry_run)
+        report.orphans = self.find_orphans(known_disk_names, report)
+
+        if dry_run:
+            for orphan in report.orphans:
+                self._audit('dry_run', orphan)
+        elif report.orphans:
+            limiter = _RateLimiter(self._rate)
+            with ThreadPoolExecutor(max_workers=self._max_workers) as pool:
+                futures = [(orphan, pool.submit(self._delete, orphan,
+                                                limiter))
+                           for orphan in report.orphans]
+                for orphan, future in futures:
+                    error = future.exception()
+                    if error is None:
+                        report.deleted.append(orphan.name)
+                        self._audit('delete', orphan)
+                    else:
+                        report.failed[orphan.name] = error
+                        self._audit('error', orphan, error)
+
+        report.duration = time.time() - start
+        eliot.Message.new(
+            message_type=u"azure_flocker_driver:gc:pass",
+            blobs_listed=report.blobs_listed,
+            orphans=len(report.orphans),
+            deleted=len(report.deleted),
+            failed=len(report.failed),
+            dry_run=dry_run,
+            duration=report.duration).write(_logger)
+        return report
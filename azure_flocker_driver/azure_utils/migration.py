@@ -0,0 +1,120 @@
+from concurrent.futures import ThreadPoolExecutor
+import eliot
+import threading
+import time
+
+_logger = eliot.Logger()
+
+
+class MigrationReport(object):
+    """
+    The result of one ``VolumeMigrator.migrate`` run.
+    :ivar str target_storage: The storage the disks were moved to.
+    :ivar list migrated: Names of the disks moved.
+    :ivar dict failed: Names of disks mapped to the error moving them.
+    :ivar int migrated_bytes: Provisioned bytes of the disks moved.
+    :ivar float duration: Seconds the run took.
+    """
+
+    def __init__(self, target_storage):
+        self.target_storage = target_storage
+        self.migrated = []
+        self.failed = {}
+        self.migrated_bytes = 0
+        self.duration = 0.0
+
+
+class _ByteBudget(object):
+    # Admits migrations while the bytes of those running stay within the
+    # budget.  A disk larger than the whole budget runs alone.
+
+    def __init__(self, budget):
+        self._budget = budget
+        self._in_flight = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, size):
+        if self._budget is None:
+            return
+        with self._condition:
+            while self._in_flight and self._in_flight + size > self._budget:
+                self._condition.wait()
+            self._in_flight += size
+
+    def release(self, size):
+        if self._budget is None:
+            return
+        with self._condition:
+            self._in_flight -= size
+            self._condition.notify_all()
+
+
+class VolumeMigrator(object):
+    """
+    Moves detached disks to another storage account, several at once, to
+    take load off a hot account without taking nodes down.
+
+    Each disk is moved with ``DiskManager.migrate_disk``, a server side
+    copy.  The copies are limited by ``max_workers`` and by
+    ``max_bytes_in_flight``, the provisioned bytes of the disks being
+    copied at once, as the copies share the bandwidth of both accounts.
+    """
+
+    def __init__(self, manager, max_workers=4, max_bytes_in_flight=None,
+                 copy_timeout=21600):
+        """
+        :param DiskManager manager: The disk manager to move disks with.
+        :param int max_workers: Disks to move at once.
+        :param int max_bytes_in_flight: Most provisioned bytes to copy at
+            once, or ``None`` for no limit.
+        :param float copy_timeout: Seconds the copies of a disk may take.
+        """
+        self._manager = manager
+        self._max_workers = max_workers
+        self._max_bytes_in_flight = max_bytes_in_flight
+        self._copy_timeout = copy_timeout
+
+    def _migrate(self, disk, target_storage, budget):
+        size = disk.properties.content_length
+        budget.acquire(size)
+        try:
+            self._manager.migrate_disk(disk.name, target_storage,
+                                       copy_timeout=self._copy_timeout)
+        finally:
+            budget.release(size)
+        return size
+
+    def migrate(self, disk_names, target_storage):
+        """
+        :param disk_names: The disks to move.
+        :param str target_storage: A name from ``DiskManager.list_storage``.
+        :returns: A ``MigrationReport``.
+        """
+        start = time.time()
+        report = MigrationReport(target_storage)
+        disks = dict((disk.name, disk)
+                     for disk in self._manager.list_disks()
+                     if disk.name in disk_names)
+        budget = _ByteBudget(self._max_bytes_in_flight)
+        with ThreadPoolExecutor(max_workers=self._max_workers) as pool:
+            futures = [(name, pool.submit(self._migrate, disks[name],
+                                          target_storage, budget))
+                       for name in disk_names]
+            for name, future in futures:
+                error = future.exception()
+                if error is None:
+                    report.migrated.append(name)
+                    report.migrated_bytes += future.result()
+                else:
+                    report.failed[name] = error
+
+        report.duration = time.time() - start
+        eliot.Message.new(
+            message_type=u"azure_flocker_driver:migration:run",
+            target_storage=target_storage,
+            migrated=report.migrated,
+            failed=dict((name, repr(error))
+                        for (name, error) in report.failed.items()),
+            migrated_bytes=report.migrated_bytes,
+            duration=report.duration).write(_logger)
+        return report
@@ -0,0 +1,202 @@
+"""
+A cache of Azure state shared by the driver processes of a node.
+
+The dataset agent and the Docker plugin each run a driver, and without a
+shared cache each lists the container and the VMs itself.  ``NodeCache``
+keeps those results in a SQLite database in the Flocker state directory.
+SQLite locks the file, so any number of processes and threads can use
+it at once.
+
+When an entry has expired one caller refreshes it and the others wait
+for that refresh rather than making the same requests.  A caller which
+changes the state an entry was read from invalidates it.  Every
+invalidation bumps the entry's generation, and a refresh which started
+before it doesn't store its now stale result.
+"""
+import cPickle as pickle
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_FILE = 'azure_node_cache.sqlite'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    stored_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS generations (
+    key TEXT PRIMARY KEY,
+    generation INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS refreshes (
+    key TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    started_at REAL NOT NULL
+);
+"""
+
+
+class NodeCacheStats(object):
+    """
+    How the entries read through one ``NodeCache`` were found.
+    :ivar int hits: Reads served from a fresh entry.
+    :ivar int refreshes: Reads which fetched the value.
+    :ivar int waits: Reads served by another caller's refresh.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.refreshes = 0
+        self.waits = 0
+
+
+class NodeCache(object):
+    """
+    :param path: The SQLite database, created if missing.
+    :param float refresh_timeout: Seconds a caller waits for another
+        caller's refresh before fetching the value itself.
+    """
+
+    def __init__(self, path, refresh_timeout=60):
+        self._path = path
+        self._refresh_timeout = refresh_timeout
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self.stats = NodeCacheStats()
+
+        if not os.path.exists(path):
+            # entries hold VM models and blob metadata
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0600))
+        connection = self._connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.executescript(_SCHEMA)
+
+    def _connection(self):
+        # connections can't be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self._path, timeout=30,
+                                         isolation_level=None)
+            self._local.connection = connection
+        return connection
+
+    def _count(self, name):
+        with self._stats_lock:
+            setattr(self.stats, name, getattr(self.stats, name) + 1)
+
+    def _owner(self):
+        return '%d:%d' % (os.getpid(), threading.current_thread().ident)
+
+    def _read(self, key, ttl):
+        row = self._connection().execute(
+            'SELECT value, stored_at FROM entries WHERE key = ?',
+            (key,)).fetchone()
+        if row is None or time.time() - row[1] > ttl:
+            return None
+        return pickle.loads(str(row[0]))
+
+    def _generation(self, connection, key):
+        row = connection.execute(
+            'SELECT generation FROM generations WHERE key = ?',
+            (key,)).fetchone()
+        return row[0] if row else 0
+
+    def _claim_refresh(self, key):
+        # Returns the generation the refresh started at, or None when
+        # another caller is refreshing the entry
+        connection = self._connection()
+        now = time.time()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            row = connection.execute(
+                'SELECT started_at FROM refreshes WHERE key = ?',
+                (key,)).fetchone()
+            if row is not None and now - row[0] < self._refresh_timeout:
+                return None
+            connection.execute(
+                'INSERT OR REPLACE INTO refreshes VALUES (?, ?, ?)',
+                (key, self._owner(), now))
+            return self._generation(connection, key)
+        finally:
+            connection.execute('COMMIT')
+
+    def _finish_refresh(self, key, generation, value):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            if value is not None and \
+                    self._generation(connection, key) == generation:
+                connection.execute(
+                    'INSERT OR REPLACE INTO entries VALUES (?, ?, ?)',
+                    (key, sqlite3.Binary(pickle.dumps(value, 2)),
+                     time.time()))
+            connection.execute(
+                'DELETE FROM refreshes WHERE key = ? AND owner = ?',
+                (key, self._owner()))
+        finally:
+            connection.execute('COMMIT')
+
+    def _refresh(self, key, generation, fetch):
+        try:
+            value = fetch()
+        except Exception:
+            self._finish_refresh(key, generation, None)
+            raise
+        self._finish_refresh(key, generation, value)
+        self._count('refreshes')
+        return value
+
+    def get(self, key, ttl, fetch):
+        """
+        :param key: The entry.
+        :param float ttl: Seconds an entry is used for after it was
+            stored.
+        :param fetch: Called with no arguments to get the value when the
+            entry is missing or expired.
+        :returns: The value of the entry.
+        """
+        value = self._read(key, ttl)
+        if value is not None:
+            self._count('hits')
+            return value
+
+        deadline = time.time() + self._refresh_timeout
+        while True:
+            generation = self._claim_refresh(key)
+            if generation is not None:
+                return self._refresh(key, generation, fetch)
+            time.sleep(0.1)
+            value = self._read(key, ttl)
+            if value is not None:
+                self._count('waits')
+                return value
+            if time.time() > deadline:
+                return fetch()
+
+    def put(self, key, value):
+        """
+        Stores a value fetched outside of ``get``.
+        """
+        connection = self._connection()
+        connection.execute(
+            'INSERT OR REPLACE INTO entries VALUES (?, ?, ?)',
+            (key, sqlite3.Binary(pickle.dumps(value, 2)), time.time()))
+
+    def invalidate(self, *keys):
+        """
+        Drops entries whose state was just changed.
+        """
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            for key in keys:
+                connection.execute('DELETE FROM entries WHERE key = ?',
+                                   (key,))
+                connection.execute(
+                    'INSERT OR REPLACE INTO generations VALUES (?, ?)',
+                    (key, self._generation(connection, key) + 1))
+        finally:
+            connection.execute('COMMIT')
@@ -0,0 +1,336 @@
+from azure.common import AzureConflictHttpError, AzureHttpError
+from backup import split_ranges
+from concurrent.futures import ThreadPoolExecutor
+from garbage import FLOCKER_DISK_PREFIX, _RateLimiter
+import eliot
+import threading
+import time
+
+_logger = eliot.Logger()
+
+PAGE_SIZE = 512
+VHD_FOOTER_SIZE = 512
+
+# Zero runs shorter than this are left allocated.  Clearing lone pages
+# fragments the page ranges of a blob, which makes every later
+# get_page_ranges and backup slower, for little saving.
+DEFAULT_MIN_RUN = 64 * 1024
+
+# Runs cleared under each short lease.  An attach waits for the lease
+# of the batch under way, so batches are kept short.
+DEFAULT_BATCH_SIZE = 64
+
+# The shortest lease Azure grants
+RECLAIM_LEASE_DURATION = 15
+
+_ZERO_PAGE = b'\0' * PAGE_SIZE
+
+
+def zero_runs(data, offset):
+    """
+    Returns the ``(start, end)`` byte ranges of the zero pages in
+    ``data``, read from ``offset`` of a blob, merging adjacent pages.
+    ``offset`` is page aligned and ends are inclusive.
+    """
+    if not data.strip(b'\0'):
+        return [(offset, offset + len(data) - 1)] if data else []
+    runs = []
+    run_start = None
+    for position in range(0, len(data), PAGE_SIZE):
+        if data[position:position + PAGE_SIZE] == _ZERO_PAGE:
+            if run_start is None:
+                run_start = position
+        elif run_start is not None:
+            runs.append((offset + run_start, offset + position - 1))
+            run_start = None
+    if run_start is not None:
+        runs.append((offset + run_start, offset + len(data) - 1))
+    return runs
+
+
+def merge_runs(runs):
+    """
+    Merges ``(start, end)`` runs which are adjacent or overlap.
+    """
+    merged = []
+    for start, end in sorted(runs):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class ReclaimResult(object):
+    """
+    The outcome of reclaiming the zero pages of one blob.
+    :ivar str blob_name: The blob.
+    :ivar int scanned_bytes: Populated bytes read, footer excluded.
+    :ivar int zero_bytes: Populated bytes found to be zero.
+    :ivar int reclaimed_bytes: Bytes cleared.
+    :ivar int cleared_ranges: Clear requests made.
+    :ivar str interrupted: Why clearing stopped early, ``leased`` or
+        ``changed``, or ``None`` if every run was cleared.
+    :ivar str etag: The ETag of the blob once cleared.
+    """
+
+    def __init__(self, blob_name):
+        self.blob_name = blob_name
+        self.scanned_bytes = 0
+        self.zero_bytes = 0
+        self.reclaimed_bytes = 0
+        self.cleared_ranges = 0
+        self.interrupted = None
+        self.etag = None
+
+
+class ZeroPageReclaimer(object):
+    """
+    Clears the populated pages of a page blob which hold only zeros.
+
+    Page blobs are billed, and backed up, by their populated pages, and
+    pages a filesystem has zeroed stay populated until they are cleared.
+    The populated ranges are read concurrently, zero pages found in runs
+    of at least ``min_run`` bytes, and the runs cleared in batches.  The
+    VHD footer in the last page is never read or cleared.
+
+    The blob must be detached.  Reads are made against the ETag the
+    caller saw it detached at, and each batch is cleared under a short
+    lease taken on that ETag, so a blob attached or written since is left
+    alone from the next batch on.
+    """
+
+    def __init__(self, storage_client, container_name, max_workers=8,
+                 rate=None, min_run=DEFAULT_MIN_RUN,
+                 batch_size=DEFAULT_BATCH_SIZE):
+        """
+        :param int max_workers: Ranged reads to run at once.
+        :param float rate: Most requests to start per second, or ``None``
+            for no limit.
+        :param int min_run: Bytes of consecutive zero pages worth
+            clearing.
+        :param int batch_size: Runs cleared under each lease.
+        """
+        self._storage_client = storage_client
+        self._container = container_name
+        self._max_workers = max_workers
+        self._limiter = _RateLimiter(rate)
+        self._min_run = max(min_run, PAGE_SIZE)
+        self._batch_size = batch_size
+
+    def _read_runs(self, blob_name, etag, chunk):
+        start, end, is_cleared = chunk
+        self._limiter.wait()
+        blob = self._storage_client.get_blob_to_bytes(
+            self._container, blob_name, start_range=start, end_range=end,
+            if_match=etag)
+        return zero_runs(blob.content, start)
+
+    def find_zero_runs(self, blob_name, etag, result):
+        """
+        Returns the runs of zero pages of a blob worth clearing.
+        """
+        self._limiter.wait()
+        properties = self._storage_client.get_blob_properties(
+            self._container, blob_name, if_match=etag).properties
+        footer_start = properties.content_length - VHD_FOOTER_SIZE
+        self._limiter.wait()
+        chunks = []
+        for start, end, is_cleared in split_ranges(
+                self._storage_client.get_page_ranges(
+                    self._container, blob_name, if_match=etag)):
+            end = min(end, footer_start - 1)
+            if not is_cleared and start <= end:
+                chunks.append((start, end, is_cleared))
+                result.scanned_bytes += end - start + 1
+
+        with ThreadPoolExecutor(max_workers=self._max_workers) as pool:
+            runs = [run for chunk_runs in pool.map(
+                lambda chunk: self._read_runs(blob_name, etag, chunk),
+                chunks) for run in chunk_runs]
+        runs = merge_runs(runs)
+        result.zero_bytes = sum(last - first + 1 for (first, last) in runs)
+        return [(first, last) for (first, last) in runs
+                if last - first + 1 >= self._min_run]
+
+    def _clear_batch(self, blob_name, etag, batch, result):
+        # Returns the ETag after the batch is cleared
+        try:
+            lease_id = self._storage_client.acquire_blob_lease(
+                self._container, blob_name,
+                lease_duration=RECLAIM_LEASE_DURATION, if_match=etag)
+        except AzureConflictHttpError:
+            result.interrupted = 'leased'
+            return None
+        except AzureHttpError as e:
+            if e.status_code != 412:
+                raise
+            result.interrupted = 'changed'
+            return None
+        try:
+            for start, end in batch:
+                self._limiter.wait()
+                etag = self._storage_client.clear_page(
+                    self._container, blob_name, start, end,
+                    lease_id=lease_id).etag
+                result.reclaimed_bytes += end - start + 1
+                result.cleared_ranges += 1
+        finally:
+            self._storage_client.release_blob_lease(
+                self._container, blob_name, lease_id)
+        return etag
+
+    def reclaim(self, blob_name, etag):
+        """
+        :param str etag: The ETag of the blob when it was seen detached.
+        :returns: A ``ReclaimResult``.
+        """
+        result = ReclaimResult(blob_name)
+        try:
+            runs = self.find_zero_runs(blob_name, etag, result)
+        except AzureHttpError as e:
+            if e.status_code != 412:
+                raise
+            result.interrupted = 'changed'
+            return result
+
+        for index in range(0, len(runs), self._batch_size):
+            etag = self._clear_batch(
+                blob_name, etag, runs[index:index + self._batch_size],
+                result)
+            if etag is None:
+                break
+        result.etag = etag
+        return result
+
+
+class ReclaimReport(object):
+    """
+    The result of one ``VolumeReclaimer.reclaim_once`` pass.
+    :ivar int volumes_checked: Detached volumes considered.
+    :ivar list results: ``ReclaimResult``s of the volumes scanned.
+    :ivar dict errors: Disk names mapped to errors raised while
+        reclaiming.
+    :ivar float duration: Seconds the pass took.
+    """
+
+    def __init__(self):
+        self.volumes_checked = 0
+        self.results = []
+        self.errors = {}
+        self.duration = 0.0
+
+    @property
+    def reclaimed_bytes(self):
+        return sum(result.reclaimed_bytes for result in self.results)
+
+
+class VolumeReclaimer(object):
+    """
+    Periodically reclaims the zero pages of detached flocker volumes.
+
+    Volumes which are leased, or have an attachment record, are skipped.
+    A volume is scanned again only once its ETag has changed since it was
+    last reclaimed.
+
+    Every node lists the same volumes, so a reclaimer should run on one
+    node only.
+    """
+
+    def __init__(self, manager, interval, max_workers=8, rate=20,
+                 min_run=DEFAULT_MIN_RUN):
+        """
+        :param DiskManager manager: The disk manager to list volumes and
+            reclaim with.
+        :param float interval: Seconds between passes.
+        :param int max_workers: Ranged reads of a volume to run at once.
+        :param float rate: Most requests to start per second.
+        :param int min_run: Bytes of consecutive zero pages worth
+            clearing.
+        """
+        self._manager = manager
+        self._interval = interval
+        self._max_workers = max_workers
+        self._rate = rate
+        self._min_run = min_run
+        self._stopping = threading.Event()
+        self._thread = None
+
+        # disk name -> ETag after its last reclaim
+        self._reclaimed_etags = {}
+
+        self.passes = 0
+        self.total_reclaimed = 0
+
+    def _detached(self, disk):
+        owner, lun = self._manager.get_disk_owner(disk)
+        return disk.properties.lease.state != 'leased' and owner is None
+
+    def reclaim_once(self, disk_names=None):
+        """
+        :param disk_names: The volumes to reclaim, or ``None`` for every
+            detached volume.
+        :returns: A ``ReclaimReport``.
+        """
+        report = ReclaimReport()
+        start = time.time()
+        for disk in self._manager.list_disks():
+            if not disk.name.startswith(FLOCKER_DISK_PREFIX) or \
+                    (disk_names is not None and
+                     disk.name not in disk_names) or \
+                    not self._detached(disk):
+                continue
+            report.volumes_checked += 1
+            etag = disk.properties.etag
+            if self._reclaimed_etags.get(disk.name) == etag:
+                continue
+            try:
+                result = self._manager.reclaim_disk(
+                    disk.name, etag, storage=disk.storage,
+                    max_workers=self._max_workers, rate=self._rate,
+                    min_run=self._min_run)
+            except Exception as e:
+                report.errors[disk.name] = repr(e)
+                continue
+            report.results.append(result)
+            if result.interrupted is None:
+                self._reclaimed_etags[disk.name] = result.etag or etag
+
+        report.duration = time.time() - start
+        self._record(report)
+        return report
+
+    def _record(self, report):
+        self.passes += 1
+        self.total_reclaimed += report.reclaimed_bytes
+        eliot.Message.new(
+            message_type=u"azure_flocker_driver:reclaimer:pass",
+            volumes_checked=report.volumes_checked,
+            volumes_scanned=len(report.results),
+            scanned_bytes=sum(r.scanned_bytes for r in report.results),
+            reclaimed_bytes=report.reclaimed_bytes,
+            interrupted=dict((r.blob_name, r.interrupted)
+                             for r in report.results if r.interrupted),
+            errors=report.errors,
+            duration=report.duration,
+            total_reclaimed=self.total_reclaimed).write(_logger)
+
+    def _run(self):
+        while not self._stopping.wait(self._interval):
+            try:
+                self.reclaim_once()
+            except Exception as e:
+                eliot.Message.new(
+                    message_type=u"azure_flocker_driver:reclaimer:error",
+                    error=repr(e)).write(_logger)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='azure-zero-page-reclaimer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,130 @@
+import eliot
+import threading
+import time
+
+_logger = eliot.Logger()
+
+
+class ReconcileReport(object):
+    """
+    What a single reconcile pass found.
+    :ivar int vms_checked: VMs whose instance view was compared.
+    :ivar dict stuck_disks: VM names mapped to the names of disks in the
+        instance view but not in the model.
+    :ivar dict failed_disks: VM names mapped to the names of model disks
+        whose provisioning failed.
+    :ivar list reconciled_vms: VMs whose stuck state was cleared.
+    :ivar dict errors: VM names mapped to errors raised while clearing.
+    :ivar float duration: Seconds the pass took.
+    """
+
+    def __init__(self):
+        self.vms_checked = 0
+        self.stuck_disks = {}
+        self.failed_disks = {}
+        self.reconciled_vms = []
+        self.errors = {}
+        self.duration = 0.0
+
+
+class DiskReconciler(object):
+    """
+    Periodically compares the model and instance view of the VM of this
+    node and clears stuck disks before they block an attach.
+
+    Disks can be left in the instance view of a VM after they are removed
+    from its model, or fail to provision while in the model.  Either way
+    the next attach to that VM waits out ``async_timeout`` before the
+    retry path recovers it.
+
+    Clearing replaces the whole VM model, so only the VM of this node is
+    reconciled, under the lock its attaches and detaches take, and every
+    node reconciles its own.  The VM is checked again once the lock is
+    held.
+    """
+
+    def __init__(self, manager, interval, vm_name, lock=None):
+        """
+        :param DiskManager manager: The disk manager to reconcile with.
+        :param float interval: Seconds between reconcile passes.
+        :param str vm_name: The VM of this node.
+        :param lock: Held while the VM is being updated, to serialize with
+            attaches and detaches in the same process.
+        """
+        self._manager = manager
+        self._interval = interval
+        self._vm_name = vm_name
+        self._lock = lock or threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+        self.passes = 0
+        self.total_stuck = 0
+        self.total_failed = 0
+        self.total_reconciled = 0
+
+    def reconcile_once(self):
+        report = ReconcileReport()
+        start = time.time()
+        vm_name = self._vm_name
+        report.vms_checked = 1
+
+        try:
+            # checked without the lock first, so a pass finding nothing
+            # never holds up an attach
+            state = self._manager.find_stuck_state(vm_name)
+            if state is not None and state != ([], []):
+                with self._lock:
+                    stuck, failed = self._manager.reconcile_vm(vm_name)
+                if stuck or failed:
+                    print("VM %s had stuck disks %s and failed disks %s" %
+                          (vm_name, stuck, failed))
+                    report.stuck_disks[vm_name] = stuck
+                    report.failed_disks[vm_name] = failed
+                    report.reconciled_vms.append(vm_name)
+        except Exception as e:
+            report.errors[vm_name] = repr(e)
+
+        report.duration = time.time() - start
+        self._record(report)
+        return report
+
+    def _record(self, report):
+        self.passes += 1
+        stuck = sum(len(d) for d in report.stuck_disks.values())
+        failed = sum(len(d) for d in report.failed_disks.values())
+        self.total_stuck += stuck
+        self.total_failed += failed
+        self.total_reconciled += len(report.reconciled_vms)
+
+        eliot.Message.new(
+            message_type=u"azure_flocker_driver:reconciler:pass",
+            vms_checked=report.vms_checked,
+            stuck_disks=report.stuck_disks,
+            failed_disks=report.failed_disks,
+            reconciled_vms=report.reconciled_vms,
+            errors=report.errors,
+            duration=report.duration,
+            total_stuck=self.total_stuck,
+            total_failed=self.total_failed,
+            total_reconciled=self.total_reconciled).write(_logger)
+
+    def _run(self):
+        while not self._stopping.wait(self._interval):
+            try:
+                self.reconcile_once()
+            except Exception as e:
+                eliot.Message.new(
+                    message_type=u"azure_flocker_driver:reconciler:error",
+                    error=repr(e)).write(_logger)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='azure-disk-reconciler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
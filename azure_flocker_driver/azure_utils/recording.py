@@ -0,0 +1,483 @@
+"""
+Recording and replay of the requests the driver makes to Azure.
+
+``RecordingProxy`` wraps an SDK client like ``BreakerProxy`` does, and
+writes every request to a trace file as a JSON line: the client and
+method, the arguments, when it started relative to the start of the
+trace, how long it took and what it returned or raised.  Long running
+operations return pollers, and the time each poller was first seen done
+is recorded as well, so provisioning tails are kept.  Driver operations
+are recorded too, so the workload can be issued again.
+
+``TraceReplayer`` serves the requests of a trace back through
+``ReplayClient``s in place of the SDK clients, sleeping for each
+request's recorded duration divided by ``speed``.  Requests which change
+something are answered in the order they were recorded.  Reads are
+answered with the response recorded most recently before the same point
+of the replay clock, so polling a VM sees the provisioning states in the
+order, and for the time, production saw them.
+
+Passwords, keys, tokens and SAS signatures are scrubbed from everything
+written.  Blob data, such as the pages backups and the reclaimer read or
+the pages written, is recorded by its length only, and replayed as that
+many zero bytes, so a trace holds no volume data.  Results are recorded
+by class and attributes and rebuilt without calling their constructors,
+which covers the SDK models and storage objects the driver reads.
+"""
+from contextlib import contextmanager
+from datetime import datetime
+from uuid import UUID
+import importlib
+import json
+import re
+import threading
+import time
+
+from breaker import LOCAL_METHOD_PREFIXES, is_paged
+
+TRACE_VERSION = 1
+
+CALL = 'call'
+POLLER_DONE = 'poller_done'
+OPERATION = 'operation'
+
+SCRUBBED = '<scrubbed>'
+_SECRET_NAME = re.compile(
+    r'password|secret|key|token|signature|authorization|credential|sas',
+    re.IGNORECASE)
+_SIGNATURE_PARAMETER = re.compile(r'([?&]sig=)[^&]*', re.IGNORECASE)
+
+# Names of arguments and attributes which hold blob data, such as the
+# ``content`` of a ``Blob``
+_PAYLOAD_NAMES = ('content', 'page')
+
+# Method names of requests which read state rather than change it
+READ_METHOD_PREFIXES = ('get', 'list', 'exists')
+
+
+class ReplayExhausted(Exception):
+
+    def __init__(self, client, method):
+        Exception.__init__(self, client, method)
+        self.client = client
+        self.method = method
+
+
+def _class_path(cls):
+    return '%s.%s' % (cls.__module__, cls.__name__)
+
+
+def _load_class(path):
+    (module_name, class_name) = path.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def encode(value, name=u''):
+    """
+    Converts a value to JSON with secrets scrubbed.  Objects are encoded
+    by class and attributes, and iterables such as paged results are
+    read to the end.
+    """
+    if name and _SECRET_NAME.search(name) and value is not None:
+        return SCRUBBED
+    if value is None or isinstance(value, (bool, int, long, float)):
+        return value
+    if isinstance(value, bytearray) or isinstance(value, str) and (
+            name in _PAYLOAD_NAMES or '\0' in value):
+        return {'__payload__': len(value)}
+    if isinstance(value, str):
+        try:
+            value = value.decode('utf-8')
+        except UnicodeDecodeError:
+            return {'__payload__': len(value)}
+    if isinstance(value, unicode):
+        return _SIGNATURE_PARAMETER.sub(r'\1' + SCRUBBED, value)
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, UUID):
+        return {'__uuid__': unicode(value)}
+    if isinstance(value, dict):
+        return {'__dict__': [[encode(k), encode(v, unicode(k))]
+                             for (k, v) in value.items()]}
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [encode(item) for item in value]
+    enum_value = getattr(value, '_value_', None)
+    if enum_value is not None and hasattr(type(value), '__members__'):
+        return {'__enum__': _class_path(type(value)), 'value': enum_value}
+    if hasattr(value, '__dict__') and not callable(value):
+        return {'__class__': _class_path(type(value)),
+                'attributes': dict((k, encode(v, k))
+                                   for (k, v) in vars(value).items()
+                                   if not k.startswith('_'))}
+    if hasattr(value, '__iter__'):
+        return [encode(item) for item in value]
+    return {'__repr__': repr(value)}
+
+
+def decode(value):
+    """
+    Rebuilds a value encoded by ``encode``.
+    """
+    if isinstance(value, list):
+        return [decode(item) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if '__payload__' in value:
+        return b'\0' * value['__payload__']
+    if '__datetime__' in value:
+        from dateutil.parser import parse
+        return parse(value['__datetime__'])
+    if '__uuid__' in value:
+        return UUID(value['__uuid__'])
+    if '__dict__' in value:
+        return dict((decode(k), decode(v)) for (k, v) in value['__dict__'])
+    if '__enum__' in value:
+        return _load_class(value['__enum__'])(value['value'])
+    if '__class__' in value:
+        cls = _load_class(value['__class__'])
+        result = cls.__new__(cls)
+        for (name, attribute) in value['attributes'].items():
+            setattr(result, name, decode(attribute))
+        return result
+    if '__repr__' in value:
+        return value['__repr__']
+    return value
+
+
+def encode_error(error):
+    return {'class': _class_path(type(error)),
+            'message': encode(unicode(error)),
+            'status_code': getattr(error, 'status_code', None)}
+
+
+def decode_error(encoded):
+    """
+    Rebuilds an error without its constructor, since SDK errors are built
+    from the HTTP response that raised them, and ``AzureHttpError`` picks
+    its subclass from the status code.
+    """
+    try:
+        cls = _load_class(encoded['class'])
+    except (ImportError, AttributeError, ValueError):
+        cls = Exception
+    error = Exception.__new__(cls)
+    Exception.__init__(error, encoded['message'])
+    error.message = encoded['message']
+    if encoded['status_code'] is not None:
+        error.status_code = encoded['status_code']
+    return error
+
+
+def _encode_arguments(args, kwargs):
+    return (encode(list(args)),
+            dict((name, encode(value, name))
+                 for (name, value) in kwargs.items()))
+
+
+def _signature(args, kwargs):
+    return json.dumps([args, kwargs], sort_keys=True)
+
+
+class TraceRecorder(object):
+    """
+    Appends the entries of a trace to a file, one JSON object per line.
+    """
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._sequence = 0
+        self.started = time.time()
+        self._file = open(path, 'a')
+        self._write({'type': 'header', 'version': TRACE_VERSION,
+                     'started': self.started})
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry, sort_keys=True) + '\n')
+        self._file.flush()
+
+    def offset(self):
+        return time.time() - self.started
+
+    def record(self, entry_type, **fields):
+        with self._lock:
+            self._sequence += 1
+            fields.update(type=entry_type, sequence=self._sequence)
+            self._write(fields)
+            return self._sequence
+
+    @contextmanager
+    def operation(self, name, args, kwargs):
+        """
+        Records a driver operation once it finishes.
+        """
+        (args, kwargs) = _encode_arguments(args, kwargs)
+        start = self.offset()
+        error = None
+        try:
+            yield
+        except Exception as e:
+            error = encode_error(e)
+            raise
+        finally:
+            self.record(OPERATION, name=name, args=args, kwargs=kwargs,
+                        start=start, duration=self.offset() - start,
+                        error=error)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class _RecordingPoller(object):
+    """
+    Wraps a long running operation's poller to record when it was first
+    seen done.
+    """
+
+    def __init__(self, poller, recorder, sequence):
+        self._poller = poller
+        self._recorder = recorder
+        self._sequence = sequence
+        self._recorded = False
+
+    def _check(self):
+        if not self._recorded and self._poller.done():
+            self._recorded = True
+            fields = {}
+            try:
+                fields['result'] = encode(self._poller.result(0))
+            except Exception as e:
+                fields['error'] = encode_error(e)
+            self._recorder.record(POLLER_DONE, call=self._sequence,
+                                  offset=self._recorder.offset(), **fields)
+
+    def done(self):
+        done = self._poller.done()
+        self._check()
+        return done
+
+    def wait(self, timeout=None):
+        self._poller.wait(timeout)
+        self._check()
+
+    def result(self, timeout=None):
+        result = self._poller.result(timeout)
+        self._check()
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self._poller, name)
+
+
+def _is_poller(value):
+    return all(callable(getattr(value, name, None))
+               for name in ('done', 'result', 'wait',
+                            'add_done_callback'))
+
+
+class RecordingProxy(object):
+    """
+    Wraps an SDK client so every request it makes is written to a trace.
+    Attributes named in ``operations``, such as ``virtual_machines`` of a
+    compute client, are wrapped in turn, and recorded as
+    ``<client>.<operation>``.
+    """
+
+    def __init__(self, target, recorder, client, operations=()):
+        self._target = target
+        self._recorder = recorder
+        self._client = client
+        self._operations = operations
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if name in self._operations:
+            return RecordingProxy(value, self._recorder,
+                                  '%s.%s' % (self._client, name))
+        if not callable(value) or name.startswith(LOCAL_METHOD_PREFIXES):
+            return value
+
+        def call(*args, **kwargs):
+            start = self._recorder.offset()
+            (encoded_args, encoded_kwargs) = _encode_arguments(args, kwargs)
+            fields = dict(client=self._client, method=name,
+                          args=encoded_args, kwargs=encoded_kwargs,
+                          start=start)
+            try:
+                result = value(*args, **kwargs)
+            except Exception as e:
+                self._recorder.record(
+                    CALL, duration=self._recorder.offset() - start,
+                    error=encode_error(e), **fields)
+                raise
+            poller = _is_poller(result)
+            if is_paged(result):
+                # paged results make requests as they are read, so are
+                # read here and counted in the duration
+                result = list(result)
+            sequence = self._recorder.record(
+                CALL, duration=self._recorder.offset() - start,
+                poller=poller, result=None if poller else encode(result),
+                **fields)
+            if poller:
+                return _RecordingPoller(result, self._recorder, sequence)
+            return result
+        return call
+
+
+def read_operations(path):
+    """
+    :returns: The driver operations recorded in a trace, as ``dict``s
+        with the arguments decoded, in the order they started.
+    """
+    operations = []
+    with open(path) as trace_file:
+        for line in trace_file:
+            entry = json.loads(line)
+            if entry['type'] == OPERATION:
+                entry['replayable'] = '"__repr__"' not in line
+                entry['args'] = decode(entry['args'])
+                entry['kwargs'] = dict((name, decode(value)) for
+                                       (name, value) in
+                                       entry['kwargs'].items())
+                operations.append(entry)
+    operations.sort(key=lambda entry: entry['start'])
+    return operations
+
+
+class _ReplayPoller(object):
+
+    def __init__(self, replayer, done_at, outcome):
+        self._replayer = replayer
+        self._done_at = done_at
+        self._outcome = outcome
+
+    def done(self):
+        return self._done_at is None or \
+            self._replayer.clock() >= self._done_at
+
+    def wait(self, timeout=None):
+        if not self.done():
+            remaining = (self._done_at - self._replayer.clock()) / \
+                self._replayer.speed
+            if timeout is not None:
+                remaining = min(remaining, timeout)
+            time.sleep(max(remaining, 0))
+
+    def result(self, timeout=None):
+        self.wait(timeout)
+        if self._outcome.get('error') is not None:
+            raise decode_error(self._outcome['error'])
+        return decode(self._outcome.get('result'))
+
+    def add_done_callback(self, func):
+        self.wait()
+        func(self)
+
+
+class TraceReplayer(object):
+    """
+    Answers requests from a recorded trace.
+
+    :param path: The trace file.
+    :param float speed: How many times faster than recorded the replay
+        runs.
+    """
+
+    def __init__(self, path, speed=1.0):
+        self.speed = float(speed)
+        if self.speed <= 0:
+            raise ValueError("Replay speed must be positive")
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._finished = {}
+        self.operations = []
+        with open(path) as trace_file:
+            for line in trace_file:
+                entry = json.loads(line)
+                if entry['type'] == CALL:
+                    entry['signature'] = _signature(entry['args'],
+                                                    entry['kwargs'])
+                    entry['used'] = False
+                    self._calls.setdefault(
+                        (entry['client'], entry['method']), []).append(entry)
+                elif entry['type'] == POLLER_DONE:
+                    self._finished.setdefault(entry['call'], entry)
+                elif entry['type'] == OPERATION:
+                    self.operations.append(entry)
+        self.clients = set(client for (client, method) in self._calls)
+        self.started = time.time()
+
+    def clock(self):
+        """
+        The offset into the trace the replay has reached.
+        """
+        return (time.time() - self.started) * self.speed
+
+    def client(self, name, local=None):
+        """
+        :param name: The client name the requests were recorded under.
+        :param local: A client to build values such as blob URLs with,
+            which are never recorded.
+        """
+        return ReplayClient(self, name, local)
+
+    def _select(self, client, method, signature):
+        entries = self._calls.get((client, method), [])
+        matching = [e for e in entries if e['signature'] == signature] or \
+            entries
+        if method.startswith(READ_METHOD_PREFIXES):
+            clock = self.clock()
+            earlier = [e for e in matching if e['start'] <= clock]
+            if earlier:
+                return earlier[-1]
+            if matching:
+                return matching[0]
+        else:
+            with self._lock:
+                for entry in matching:
+                    if not entry['used']:
+                        entry['used'] = True
+                        return entry
+        raise ReplayExhausted(client, method)
+
+    def call(self, client, method, args, kwargs):
+        entry = self._select(client, method,
+                             _signature(*_encode_arguments(args, kwargs)))
+        time.sleep(entry['duration'] / self.speed)
+        if entry.get('error') is not None:
+            raise decode_error(entry['error'])
+        if entry.get('poller'):
+            # the poller finishes as long after the request as it did
+            # when recorded
+            finished = self._finished.get(entry['sequence'], {})
+            done_at = None
+            if finished:
+                done_at = self.clock() + finished['offset'] - \
+                    entry['start'] - entry['duration']
+            return _ReplayPoller(self, done_at, finished)
+        return decode(entry['result'])
+
+
+class ReplayClient(object):
+    """
+    Stands in for an SDK client, answering from a ``TraceReplayer``.
+    """
+
+    def __init__(self, replayer, name, local=None):
+        self._replayer = replayer
+        self._name = name
+        self._local = local
+
+    def __getattr__(self, name):
+        if name.startswith(LOCAL_METHOD_PREFIXES) and self._local:
+            return getattr(self._local, name)
+        nested = '%s.%s' % (self._name, name)
+        if nested in self._replayer.clients or any(
+                client.startswith(nested + '.')
+                for client in self._replayer.clients):
+            return ReplayClient(self._replayer, nested)
+
+        def call(*args, **kwargs):
+            return self._replayer.call(self._name, name, args, kwargs)
+        return call
@@ -0,0 +1,182 @@
+from arm_disk_manager import AzureAsynchronousTimeout, AzureDiskClaimed, \
+    DiskManager
+from azure.common import AzureConflictHttpError
+from azure.mgmt.compute.models import DataDisk, StorageProfile
+from azure.storage.blob.models import Blob
+from twisted.trial import unittest
+import time
+
+
+class FakeLeasedBlobService(object):
+    """
+    Enough of ``PageBlobService`` to lease a blob and keep its metadata.
+    """
+
+    def __init__(self):
+        self.metadata = {}
+        self.lease_id = None
+        self.lease_duration = None
+
+    def acquire_blob_lease(self, container_name, blob_name,
+                           lease_duration=-1):
+        if self.lease_id is not None:
+            raise AzureConflictHttpError('LeaseAlreadyPresent', 409)
+        self.lease_id = 'lease'
+        self.lease_duration = 'fixed'
+        return self.lease_id
+
+    def release_blob_lease(self, container_name, blob_name, lease_id):
+        assert lease_id == self.lease_id
+        self.lease_id = None
+
+    def get_blob_metadata(self, container_name, blob_name, lease_id=None):
+        return dict(self.metadata)
+
+    def get_blob_properties(self, container_name, blob_name):
+        blob = Blob(blob_name, metadata=dict(self.metadata))
+        if self.lease_id is not None:
+            blob.properties.lease.duration = self.lease_duration
+        return blob
+
+    def hold_lease(self, lease_id, duration):
+        self.lease_id = lease_id
+        self.lease_duration = duration
+
+    def set_blob_metadata(self, container_name, blob_name, metadata,
+                          lease_id=None):
+        assert lease_id == self.lease_id
+        self.metadata = dict(metadata)
+
+
+class FakeVM(object):
+
+    def __init__(self, name, disk_names, provisioning_state='Succeeded'):
+        self.name = name
+        self.provisioning_state = provisioning_state
+        self.storage_profile = StorageProfile(data_disks=[
+            DataDisk(lun=lun, name=disk_name, vhd=None, create_option='')
+            for (lun, disk_name) in enumerate(disk_names)])
+
+
+class FakeVirtualMachines(object):
+
+    def __init__(self):
+        self.vms = {}
+
+    def get(self, resource_group_name, vm_name, expand=None):
+        return self.vms[vm_name]
+
+
+class FakeComputeClient(object):
+
+    def __init__(self):
+        self.virtual_machines = FakeVirtualMachines()
+
+
+class AttachmentRecordTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = FakeLeasedBlobService()
+        self.storage.metadata = {DiskManager.PROFILE_METADATA_KEY: 'gold'}
+        self.compute = FakeComputeClient()
+        self.manager = DiskManager(None, self.compute, self.storage,
+                                   'vhds', 'group', 'westus')
+
+    def test_record_keeps_profile(self):
+        self.manager._write_attachment_record('flocker-a', 'node1', 3)
+        self.assertEqual(self.manager.read_disk_owner('flocker-a'),
+                         ('node1', 3))
+        self.assertEqual(
+            self.storage.metadata[DiskManager.PROFILE_METADATA_KEY], 'gold')
+        self.assertIs(self.storage.lease_id, None)
+
+        self.manager._clear_attachment_record('flocker-a')
+        self.assertEqual(self.storage.metadata,
+                         {DiskManager.PROFILE_METADATA_KEY: 'gold'})
+
+    def test_leased_disk_refused(self):
+        self.storage.hold_lease('platform', 'infinite')
+        self.manager._sleep = lambda seconds, deadline: self.fail('waited')
+        self.assertRaises(AzureDiskClaimed,
+                          self.manager._write_attachment_record,
+                          'flocker-a', 'node1', 3)
+
+    def test_short_lease_waited_out(self):
+        self.storage.hold_lease('reclaim', 'fixed')
+        sleeps = []
+
+        def sleep(seconds, deadline):
+            # the reclaimer finishes its batch
+            sleeps.append(seconds)
+            self.storage.lease_id = None
+        self.manager._sleep = sleep
+        self.manager._write_attachment_record('flocker-a', 'node1', 3)
+        self.assertEqual(self.manager.read_disk_owner('flocker-a'),
+                         ('node1', 3))
+        self.assertEqual(sleeps, [1])
+
+    def test_short_lease_past_deadline_refused(self):
+        self.storage.hold_lease('reclaim', 'fixed')
+
+        def sleep(seconds, deadline):
+            raise AzureAsynchronousTimeout()
+        self.manager._sleep = sleep
+        self.assertRaises(AzureDiskClaimed,
+                          self.manager._write_attachment_record,
+                          'flocker-a', 'node1', 3)
+
+    def claim(self, vm_name, age):
+        self.manager._write_attachment_record('flocker-a', vm_name, 3)
+        self.storage.metadata[DiskManager.CLAIMED_AT_METADATA_KEY] = \
+            str(int(time.time() - age))
+
+    def test_recent_claim_by_other_vm_refused(self):
+        self.compute.virtual_machines.vms['node1'] = FakeVM('node1', [])
+        self.manager._write_attachment_record('flocker-a', 'node1', 3)
+        self.assertRaises(AzureDiskClaimed,
+                          self.manager._write_attachment_record,
+                          'flocker-a', 'node2', 4)
+        self.assertIs(self.storage.lease_id, None)
+
+    def test_stale_claim_taken_over(self):
+        self.manager._write_attachment_record('flocker-a', 'node1', 3)
+        self.storage.metadata[DiskManager.CLAIMED_AT_METADATA_KEY] = \
+            str(int(time.time()) - 3600)
+        self.compute.virtual_machines.vms['node1'] = FakeVM('node1', [])
+        self.manager._write_attachment_record('flocker-a', 'node2', 4)
+        self.assertEqual(self.manager.read_disk_owner('flocker-a'),
+                         ('node2', 4))
+
+    def test_claim_of_vm_without_disk_taken_over(self):
+        # well within async_timeout, but the VM is idle without the disk
+        self.claim('node1', 2 * DiskManager.CLAIM_LEASE_DURATION)
+        self.compute.virtual_machines.vms['node1'] = FakeVM('node1', [])
+        self.manager._write_attachment_record('flocker-a', 'node2', 4)
+        self.assertEqual(self.manager.read_disk_owner('flocker-a'),
+                         ('node2', 4))
+
+    def test_claim_of_vm_updating_kept(self):
+        self.claim('node1', 2 * DiskManager.CLAIM_LEASE_DURATION)
+        self.compute.virtual_machines.vms['node1'] = FakeVM(
+            'node1', [], provisioning_state='Updating')
+        self.assertRaises(AzureDiskClaimed,
+                          self.manager._write_attachment_record,
+                          'flocker-a', 'node2', 4)
+
+    def test_claim_of_vm_with_disk_kept(self):
+        self.claim('node1', 3600)
+        self.compute.virtual_machines.vms['node1'] = FakeVM(
+            'node1', ['flocker-a'])
+        self.assertRaises(AzureDiskClaimed,
+                          self.manager._write_attachment_record,
+                          'flocker-a', 'node2', 4)
+
+    def test_clear_gives_up_at_deadline(self):
+        self.manager._write_attachment_record('flocker-a', 'node1', 3)
+        self.storage.hold_lease('platform', 'infinite')
+        start = time.time()
+        self.manager._clear_attachment_record('flocker-a',
+                                              deadline=time.time() + 0.1)
+        self.assertTrue(time.time() - start < 1)
+        self.assertEqual(self.manager.read_disk_owner('flocker-a'),
+                         ('node1', 3))
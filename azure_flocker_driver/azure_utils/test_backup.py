@@ -0,0 +1,109 @@
+from azure.storage.blob.models import Blob, PageRange
+from backup import PageRangeBackup, allocated_bytes, split_ranges
+from twisted.trial import unittest
+
+
+class FakePageBlobService(object):
+    """
+    Enough of ``PageBlobService`` to back up a single page blob.
+    """
+
+    def __init__(self, size):
+        self.blobs = {None: bytearray(size)}
+        self.snapshot_count = 0
+        self.bytes_read = 0
+
+    def write(self, start, data):
+        self.blobs[None][start:start + len(data)] = data
+
+    def snapshot_blob(self, container_name, blob_name):
+        self.snapshot_count += 1
+        snapshot = str(self.snapshot_count)
+        self.blobs[snapshot] = bytearray(self.blobs[None])
+        return Blob(blob_name, snapshot)
+
+    def delete_blob(self, container_name, blob_name, snapshot=None):
+        del self.blobs[snapshot]
+
+    def get_blob_properties(self, container_name, blob_name, snapshot=None):
+        blob = Blob(blob_name, snapshot)
+        blob.properties.content_length = len(self.blobs[snapshot])
+        return blob
+
+    def _ranges(self, data, previous=None):
+        empty = bytearray(512)
+        ranges = []
+        for start in range(0, len(data), 512):
+            page = data[start:start + 512]
+            if previous is None:
+                if page == empty:
+                    continue
+                ranges.append(PageRange(start, start + 511))
+            elif page != previous[start:start + 512]:
+                ranges.append(PageRange(start, start + 511, page == empty))
+        return ranges
+
+    def get_page_ranges(self, container_name, blob_name, snapshot=None):
+        return self._ranges(self.blobs[snapshot])
+
+    def get_page_ranges_diff(self, container_name, blob_name,
+                             previous_snapshot, snapshot=None):
+        return self._ranges(self.blobs[snapshot],
+                            self.blobs[previous_snapshot])
+
+    def get_blob_to_bytes(self, container_name, blob_name, snapshot=None,
+                          start_range=None, end_range=None):
+        content = bytes(self.blobs[snapshot][start_range:end_range + 1])
+        self.bytes_read += len(content)
+        return Blob(blob_name, snapshot, content)
+
+
+class PageRangeTestCase(unittest.TestCase):
+
+    def test_allocated_bytes(self):
+        self.assertEqual(allocated_bytes([PageRange(0, 511),
+                                          PageRange(4096, 8191)]), 4608)
+
+    def test_split_ranges(self):
+        self.assertEqual(split_ranges([PageRange(0, 2047),
+                                       PageRange(4096, 4607, True)], 1024),
+                         [(0, 1023, False), (1024, 2047, False),
+                          (4096, 4607, True)])
+
+
+class PageRangeBackupTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.size = 1024 * 1024
+        self.client = FakePageBlobService(self.size)
+        self.client.write(0, b'a' * 512)
+        self.client.write(8192, b'b' * 1024)
+        self.backup = PageRangeBackup(self.client, 'vhds', max_workers=2)
+        self.path = self.mktemp()
+
+    def _read_backup(self):
+        with open(self.path, 'rb') as f:
+            return bytearray(f.read())
+
+    def test_full_backup(self):
+        result = self.backup.backup_to_file('disk.vhd', self.path)
+        self.assertEqual(result.incremental, False)
+        self.assertEqual(result.provisioned_bytes, self.size)
+        self.assertEqual(result.transferred_bytes, 1536)
+        self.assertEqual(self._read_backup(), self.client.blobs[None])
+
+    def test_incremental_backup(self):
+        self.backup.backup_to_file('disk.vhd', self.path)
+        self.client.bytes_read = 0
+        self.client.write(65536, b'c' * 512)
+        self.client.write(8192, b'\0' * 512)
+
+        result = self.backup.backup_to_file('disk.vhd', self.path)
+        self.assertEqual(result.incremental, True)
+        self.assertEqual(result.transferred_bytes, 512)
+        self.assertEqual(result.cleared_bytes, 512)
+        self.assertEqual(self.client.bytes_read, 512)
+        self.assertEqual(self._read_backup(), self.client.blobs[None])
+
+        # only the latest snapshot is kept as the base of the next backup
+        self.assertEqual(sorted(self.client.blobs.keys()), [None, '2'])
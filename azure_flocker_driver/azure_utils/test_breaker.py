@@ -0,0 +1,81 @@
+from azure.common import AzureHttpError, AzureMissingResourceHttpError
+from breaker import BreakerProxy, CircuitBreaker, CircuitOpen
+from twisted.trial import unittest
+import time
+
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.error = None
+
+    def get_blob_properties(self, container_name, blob_name):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return blob_name
+
+    def list_blobs(self, container_name):
+        # pages are fetched as the listing is read
+        self.calls += 1
+        yield 'a'
+        if self.error is not None:
+            raise self.error
+        yield 'b'
+
+    def make_blob_url(self, container_name, blob_name):
+        return container_name + '/' + blob_name
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = FakeClient()
+        self.breaker = CircuitBreaker('storage', failure_threshold=2,
+                                      reset_timeout=30)
+        self.proxy = BreakerProxy(self.client, self.breaker)
+
+    def _fail(self, times):
+        self.client.error = AzureHttpError('ServerBusy', 503)
+        for i in range(times):
+            self.assertRaises(AzureHttpError,
+                              self.proxy.get_blob_properties, 'vhds', 'a')
+
+    def test_opens_after_consecutive_failures(self):
+        self._fail(2)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertRaises(CircuitOpen,
+                          self.proxy.get_blob_properties, 'vhds', 'a')
+        self.assertEqual(self.client.calls, 2)
+        # local methods are not refused
+        self.assertEqual(self.proxy.make_blob_url('vhds', 'a'), 'vhds/a')
+
+    def test_client_errors_not_counted(self):
+        self.client.error = AzureMissingResourceHttpError('BlobNotFound', 404)
+        for i in range(3):
+            self.assertRaises(AzureHttpError,
+                              self.proxy.get_blob_properties, 'vhds', 'a')
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open_probe_closes(self):
+        self._fail(2)
+        self.breaker._opened_at = time.time() - 31
+        self.client.error = None
+        self.assertEqual(self.proxy.get_blob_properties('vhds', 'a'), 'a')
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open_probe_failure_reopens(self):
+        self._fail(2)
+        self.breaker._opened_at = time.time() - 31
+        self._fail(1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertRaises(CircuitOpen,
+                          self.proxy.get_blob_properties, 'vhds', 'a')
+
+    def test_paged_results_read_in_call(self):
+        self.assertEqual(self.proxy.list_blobs('vhds'), ['a', 'b'])
+        self.client.error = AzureHttpError('ServerBusy', 503)
+        for i in range(2):
+            self.assertRaises(AzureHttpError, self.proxy.list_blobs, 'vhds')
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
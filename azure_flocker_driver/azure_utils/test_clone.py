@@ -0,0 +1,80 @@
+from arm_disk_manager import AzureCopyFailed, AzureOperationNotAllowed, \
+    DiskManager
+from azure.common import AzureHttpError, AzureMissingResourceHttpError
+from azure.storage.blob.models import Blob, CopyProperties
+from twisted.trial import unittest
+
+
+class FakeSnapshot(object):
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+
+class FakeCloneAccount(object):
+    """
+    Enough of ``PageBlobService`` to clone a page blob from a snapshot,
+    with copies ending in ``copy_status``.
+    """
+
+    def __init__(self):
+        self.blobs = {}
+        self.snapshots = {}
+        self.copy_status = 'success'
+
+    def get_blob_metadata(self, container_name, blob_name):
+        return {DiskManager.PROFILE_METADATA_KEY: 'gold'}
+
+    def snapshot_blob(self, container_name, blob_name):
+        snapshot = str(len(self.snapshots))
+        self.snapshots[snapshot] = self.blobs[blob_name]
+        return FakeSnapshot(snapshot)
+
+    def make_blob_url(self, container_name, blob_name):
+        return 'https://account/%s/%s' % (container_name, blob_name)
+
+    def copy_blob(self, container_name, blob_name, copy_source,
+                  metadata=None, destination_if_none_match=None):
+        if destination_if_none_match == '*' and blob_name in self.blobs:
+            raise AzureHttpError('BlobAlreadyExists', 409)
+        snapshot = copy_source.split('?snapshot=')[1]
+        self.blobs[blob_name] = self.snapshots[snapshot]
+        copy = CopyProperties()
+        copy.status = self.copy_status
+        return copy
+
+    def delete_blob(self, container_name, blob_name, snapshot=None):
+        if snapshot is not None:
+            del self.snapshots[snapshot]
+        elif blob_name not in self.blobs:
+            raise AzureMissingResourceHttpError('BlobNotFound', 404)
+        else:
+            del self.blobs[blob_name]
+
+    def get_blob_properties(self, container_name, blob_name):
+        blob = Blob(blob_name)
+        blob.properties.content_length = len(self.blobs[blob_name])
+        return blob
+
+
+class CloneDiskTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.account = FakeCloneAccount()
+        self.account.blobs['golden.vhd'] = b'golden'
+        self.manager = DiskManager(None, None, self.account, 'vhds',
+                                   'group', 'westus')
+
+    def test_existing_disk_is_not_replaced(self):
+        self.account.blobs['flocker-a.vhd'] = b'data'
+        self.assertRaises(AzureOperationNotAllowed,
+                          self.manager.clone_disk, 'golden', 'flocker-a')
+        self.assertEqual((self.account.blobs['flocker-a.vhd'],
+                          self.account.snapshots), (b'data', {}))
+
+    def test_failed_copy_is_deleted(self):
+        self.account.copy_status = 'failed'
+        self.assertRaises(AzureCopyFailed,
+                          self.manager.clone_disk, 'golden', 'flocker-a')
+        self.assertEqual((sorted(self.account.blobs),
+                          self.account.snapshots), (['golden.vhd'], {}))
@@ -0,0 +1,69 @@
+from arm_disk_manager import DiskManager
+from azure.mgmt.compute.models import DataDisk, StorageProfile
+from twisted.trial import unittest
+import threading
+
+
+class FakeVM(object):
+
+    def __init__(self):
+        self.storage_profile = StorageProfile(data_disks=[
+            DataDisk(lun=0, name='node1-lun0', vhd=None, create_option='')])
+
+
+class CreateAndAttachTestCase(unittest.TestCase):
+    """
+    ``create_and_attach_disk`` with the blob, VM and attach steps replaced,
+    to check how they are overlapped and ordered.
+    """
+
+    def setUp(self):
+        self.manager = DiskManager(None, None, None, 'vhds', 'group',
+                                   'westus')
+        self.lock = threading.Lock()
+        self.creating = threading.Event()
+        self.planning = threading.Event()
+        self.steps = []
+        self.create_error = None
+        self.manager.create_disk = self.create_disk
+        self.manager._prepare_vm_for_attach = self.prepare
+        self.manager._claim_and_attach = self.claim_and_attach
+
+    def create_disk(self, disk_name, size_in_gibs, storage, profile_name,
+                    caching):
+        self.creating.set()
+        # the VM is fetched while the blob is created
+        if not self.planning.wait(5):
+            raise AssertionError('the VM was not fetched meanwhile')
+        self.steps.append('created')
+        if self.create_error is not None:
+            raise self.create_error
+
+    def prepare(self, vm_name, deadline):
+        if not self.creating.wait(5):
+            raise AssertionError('the blob was not created meanwhile')
+        self.assertTrue(self.lock.locked())
+        self.planning.set()
+        return (FakeVM(), 64)
+
+    def claim_and_attach(self, vm_name, vhd_name, vhd_size_in_gibs, lun,
+                         caching, storage, deadline):
+        self.assertTrue(self.lock.locked())
+        self.steps.append(('attached', vm_name, vhd_name, lun, caching))
+
+    def test_overlaps_create_with_planning(self):
+        lun = self.manager.create_and_attach_disk(
+            'flocker-a', 10, 'node1', lock=self.lock)
+        self.assertEqual((lun, self.steps),
+                         (1, ['created',
+                              ('attached', 'node1', 'flocker-a', 1,
+                               'None')]))
+        self.assertEqual(self.manager._luns._reserved, {})
+
+    def test_failed_create_is_not_attached(self):
+        self.create_error = ValueError()
+        self.assertRaises(ValueError, self.manager.create_and_attach_disk,
+                          'flocker-a', 10, 'node1', lock=self.lock)
+        self.assertEqual((self.steps, self.manager._luns._reserved,
+                          self.lock.locked()),
+                         (['created'], {}, False))
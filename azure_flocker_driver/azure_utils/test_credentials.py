@@ -0,0 +1,64 @@
+from credentials import CachedServicePrincipalCredentials
+from msrestazure.azure_active_directory import ServicePrincipalCredentials
+from twisted.trial import unittest
+import os
+import stat
+import threading
+import time
+
+
+class CachedServicePrincipalCredentialsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.fetches = []
+        self.cache_path = self.mktemp()
+        self.lifetime = 3600
+
+        def fake_set_token(credentials):
+            self.fetches.append(time.time())
+            credentials._default_token_cache({
+                'access_token': 'token-%d' % len(self.fetches),
+                'token_type': 'Bearer',
+                'expires_at': time.time() + self.lifetime})
+
+        self.patch(ServicePrincipalCredentials, 'set_token', fake_set_token)
+
+    def _credentials(self, client_id='client'):
+        credentials = CachedServicePrincipalCredentials(
+            client_id, 'secret', self.cache_path, tenant='tenant')
+        self.addCleanup(credentials.stop)
+        return credentials
+
+    def test_token_cached_across_instances(self):
+        first = self._credentials()
+        self.assertEqual(len(self.fetches), 1)
+        self.assertEqual(
+            stat.S_IMODE(os.stat(self.cache_path).st_mode), 0o600)
+
+        second = self._credentials()
+        self.assertEqual(len(self.fetches), 1)
+        self.assertEqual(second.token['access_token'],
+                         first.token['access_token'])
+
+    def test_cached_token_for_other_client_ignored(self):
+        self._credentials()
+        self._credentials(client_id='other')
+        self.assertEqual(len(self.fetches), 2)
+
+    def test_expiring_cached_token_ignored(self):
+        self.lifetime = CachedServicePrincipalCredentials.REFRESH_MARGIN - 1
+        self._credentials()
+        self._credentials()
+        self.assertEqual(len(self.fetches), 2)
+
+    def test_concurrent_refreshes_coalesced(self):
+        credentials = self._credentials()
+        credentials.token['expires_at'] = time.time() - 1
+
+        threads = [threading.Thread(target=credentials.signed_session)
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(self.fetches), 2)
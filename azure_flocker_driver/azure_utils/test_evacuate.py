@@ -0,0 +1,226 @@
+from arm_disk_manager import AzureDiskClaimed, AzureInsufficientLuns, \
+    AzureProvisioningFailed, DiskManager
+from azure.common import AzureConflictHttpError
+from azure.mgmt.compute.models import DataDisk, HardwareProfile, \
+    StorageProfile, VirtualHardDisk, VirtualMachine
+from azure.storage.blob.models import Blob
+from twisted.trial import unittest
+import copy
+import time
+
+
+def data_disk(name, lun):
+    return DataDisk(lun=lun, name=name, create_option='attach',
+                    vhd=VirtualHardDisk('https://account/vhds/%s.vhd' % name),
+                    caching='None', disk_size_gb=10)
+
+
+class EvacuateTestBase(unittest.TestCase):
+    """
+    ``evacuate_disks`` with the VM updates and attachment records replaced,
+    to check what ends up attached where.
+    """
+
+    def setUp(self):
+        self.manager = DiskManager(None, None, None, 'vhds', 'group',
+                                   'westus')
+        self.vms = {}
+        self.failing = set()
+        self.records = {}
+        self.states = []
+        self.add_vm('node1', [data_disk('node1-lun0_reserved', 0),
+                              data_disk('flocker-a', 1),
+                              data_disk('flocker-b', 3)])
+        self.add_vm('node2', [data_disk('node2-lun0_reserved', 0)])
+        self.manager.get_vm = self.get_vm
+        self.manager._update_vm_and_wait = self.update_vm
+        self.manager._wait_for_disks = lambda *args: None
+        self.manager._get_max_luns_for_vm_size = lambda vm_size: 4
+        self.manager._write_attachment_record = self.write_record
+        self.manager._clear_attachment_record = \
+            lambda disk_name, deadline=None: self.records.pop(disk_name, None)
+
+    def add_vm(self, name, data_disks):
+        vm = VirtualMachine(location='westus',
+                            hardware_profile=HardwareProfile(vm_size='A2'),
+                            storage_profile=StorageProfile(
+                                data_disks=data_disks))
+        self.vms[name] = vm
+
+    def get_vm(self, vm_name, expand=None):
+        return copy.deepcopy(self.vms[vm_name])
+
+    def update_vm(self, vm_name, vm, deadline=None):
+        if vm_name in self.failing:
+            raise AzureProvisioningFailed()
+        self.vms[vm_name] = vm
+
+    def write_record(self, disk_name, vm_name, lun, deadline=None,
+                     detached_from=None):
+        self.records[disk_name] = (vm_name, lun)
+
+    def progress(self, disk_name, state, lun):
+        self.states.append((disk_name, state, lun))
+
+    def disks_of(self, vm_name):
+        return sorted((d.name, d.lun) for d in
+                      self.vms[vm_name].storage_profile.data_disks)
+
+
+class EvacuateDisksTestCase(EvacuateTestBase):
+
+    def test_moves_disks(self):
+        moved = self.manager.evacuate_disks('node1', 'node2', self.progress)
+        self.assertEqual(moved, [('flocker-a', 1), ('flocker-b', 2)])
+        self.assertEqual((self.disks_of('node1'), self.disks_of('node2')),
+                         ([('node1-lun0_reserved', 0)],
+                          [('flocker-a', 1), ('flocker-b', 2),
+                           ('node2-lun0_reserved', 0)]))
+        self.assertEqual(self.records, {'flocker-a': ('node2', 1),
+                                        'flocker-b': ('node2', 2)})
+        self.assertEqual(self.manager._luns._reserved, {})
+
+    def test_target_without_luns_leaves_source(self):
+        self.add_vm('node2', [data_disk('node2-lun0_reserved', 0),
+                              data_disk('flocker-c', 1),
+                              data_disk('flocker-d', 2)])
+        self.assertRaises(AzureInsufficientLuns,
+                          self.manager.evacuate_disks, 'node1', 'node2')
+        self.assertEqual(len(self.disks_of('node1')), 3)
+
+    def test_failed_target_returns_disks(self):
+        self.failing.add('node2')
+        self.assertRaises(AzureProvisioningFailed,
+                          self.manager.evacuate_disks, 'node1', 'node2',
+                          self.progress)
+        self.assertEqual(self.disks_of('node1'),
+                         [('flocker-a', 1), ('flocker-b', 2),
+                          ('node1-lun0_reserved', 0)])
+        self.assertEqual(self.records, {'flocker-a': ('node1', 1),
+                                        'flocker-b': ('node1', 2)})
+        self.assertEqual(self.states[-2:], [('flocker-a', 'returned', 1),
+                                            ('flocker-b', 'returned', 2)])
+        self.assertEqual(self.manager._luns._reserved, {})
+
+    def test_disks_left_detached_are_reported(self):
+        original_update = self.update_vm
+
+        def update_vm(vm_name, vm, deadline=None):
+            original_update(vm_name, vm, deadline)
+            # the source fails once its disks are detached
+            self.failing.update(['node1', 'node2'])
+        self.manager._update_vm_and_wait = update_vm
+        self.assertRaises(AzureProvisioningFailed,
+                          self.manager.evacuate_disks, 'node1', 'node2',
+                          self.progress)
+        self.assertEqual(self.states[-2:], [('flocker-a', 'detached', None),
+                                            ('flocker-b', 'detached', None)])
+
+
+class FakeDetachedBlobService(object):
+    """
+    Enough of ``PageBlobService`` to write attachment records, with the
+    platform's infinite lease on a detached disk's blob kept for a number
+    of lease attempts.
+    """
+
+    def __init__(self):
+        self.metadata = {}
+        self.leases = set()
+        # blob name -> lease attempts the platform lease outlasts
+        self.platform_leases = {}
+
+    def acquire_blob_lease(self, container_name, blob_name,
+                           lease_duration=-1):
+        attempts = self.platform_leases.get(blob_name)
+        if attempts:
+            self.platform_leases[blob_name] = attempts - 1
+            raise AzureConflictHttpError('LeaseAlreadyPresent', 409)
+        self.platform_leases.pop(blob_name, None)
+        assert blob_name not in self.leases
+        self.leases.add(blob_name)
+        return blob_name
+
+    def release_blob_lease(self, container_name, blob_name, lease_id):
+        self.leases.remove(lease_id)
+
+    def get_blob_properties(self, container_name, blob_name):
+        blob = Blob(blob_name)
+        if blob_name in self.platform_leases:
+            blob.properties.lease.duration = 'infinite'
+        return blob
+
+    def get_blob_metadata(self, container_name, blob_name, lease_id=None):
+        return dict(self.metadata.get(blob_name, {}))
+
+    def set_blob_metadata(self, container_name, blob_name, metadata,
+                          lease_id=None):
+        assert lease_id in self.leases
+        self.metadata[blob_name] = dict(metadata)
+
+
+class EvacuateClaimTestCase(EvacuateTestBase):
+    """
+    ``evacuate_disks`` writing the attachment records of disks whose
+    platform lease outlasts their detach from the source.
+    """
+
+    def setUp(self):
+        EvacuateTestBase.setUp(self)
+        self.storage = FakeDetachedBlobService()
+        self.manager._storage_client = self.storage
+        self.manager._storage_clients = [
+            (DiskManager.STANDARD_STORAGE, self.storage)]
+        self.manager._write_attachment_record = \
+            DiskManager._write_attachment_record.__get__(self.manager)
+        self.sleeps = []
+        self.manager._sleep = \
+            lambda seconds, deadline: self.sleeps.append(seconds)
+        self.lingering = 2
+        for name in ('flocker-a', 'flocker-b'):
+            self.storage.metadata[name + '.vhd'] = {
+                DiskManager.OWNER_METADATA_KEY: 'node1',
+                DiskManager.LUN_METADATA_KEY: '1',
+                DiskManager.CLAIMED_AT_METADATA_KEY: str(int(time.time()))}
+        original_update = self.update_vm
+
+        def update_vm(vm_name, vm, deadline=None):
+            original_update(vm_name, vm, deadline)
+            if vm_name == 'node1':
+                for name in ('flocker-a', 'flocker-b'):
+                    if name not in [d.name for d in
+                                    vm.storage_profile.data_disks]:
+                        self.storage.platform_leases[name + '.vhd'] = \
+                            self.lingering
+        self.manager._update_vm_and_wait = update_vm
+
+    def owner(self, disk_name):
+        return self.manager._owner_from_metadata(
+            self.storage.metadata[disk_name + '.vhd'])
+
+    def test_platform_lease_waited_out(self):
+        moved = self.manager.evacuate_disks('node1', 'node2', self.progress)
+        self.assertEqual(moved, [('flocker-a', 1), ('flocker-b', 2)])
+        self.assertEqual((self.owner('flocker-a'), self.owner('flocker-b')),
+                         (('node2', 1), ('node2', 2)))
+        self.assertEqual(len(self.sleeps), 4)
+        self.assertEqual(self.storage.leases, set())
+
+    def test_disk_claimed_elsewhere_returns_disks(self):
+        self.storage.metadata['flocker-b.vhd'][
+            DiskManager.OWNER_METADATA_KEY] = 'node3'
+        node3 = VirtualMachine(location='westus',
+                               storage_profile=StorageProfile(data_disks=[]))
+        node3.provisioning_state = 'Updating'
+        self.vms['node3'] = node3
+        self.assertRaises(AzureDiskClaimed,
+                          self.manager.evacuate_disks, 'node1', 'node2',
+                          self.progress)
+        self.assertEqual(self.disks_of('node2'),
+                         [('node2-lun0_reserved', 0)])
+        self.assertEqual(self.disks_of('node1'),
+                         [('flocker-a', 1), ('node1-lun0_reserved', 0)])
+        self.assertEqual(self.owner('flocker-a'), ('node1', 1))
+        self.assertEqual(self.states[-3:], [('flocker-b', 'claimed', None),
+                                            ('flocker-b', 'detached', None),
+                                            ('flocker-a', 'returned', 1)])
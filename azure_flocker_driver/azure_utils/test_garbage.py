@@ -0,0 +1,116 @@
+from azure.common import AzureHttpError
+from azure.mgmt.compute.models import (
+    DataDisk, StorageProfile, VirtualHardDisk, VirtualMachine
+)
+from azure.storage.blob.models import Blob
+from datetime import datetime, timedelta
+from garbage import (
+    ORPHANED_LUN0_RESERVATION, ORPHANED_VOLUME, OrphanCollector
+)
+from twisted.trial import unittest
+import json
+import threading
+
+
+class FakeDiskManager(object):
+
+    LUN0_RESERVED_VHD_NAME_SUFFIX = "lun0_reserved"
+
+    def __init__(self):
+        self.blobs = {}
+        self.vms = []
+        self.deleted = []
+        self.refuse = set()
+        self._lock = threading.Lock()
+
+    def add_blob(self, name, age=timedelta(days=2), leased=False):
+        blob = Blob(name)
+        blob.storage = 'standard'
+        blob.properties.etag = 'etag-' + name
+        blob.properties.content_length = 512
+        blob.properties.last_modified = datetime.utcnow() - age
+        blob.properties.lease.state = 'leased' if leased else 'available'
+        self.blobs[name] = blob
+
+    def add_vm(self, name, disk_names):
+        vm = VirtualMachine(location='westus')
+        vm.name = name
+        vm.storage_profile = StorageProfile(data_disks=[
+            DataDisk(lun=lun, name=disk_name, create_option='attach',
+                     vhd=VirtualHardDisk(
+                         'https://account/vhds/%s.vhd' % disk_name))
+            for (lun, disk_name) in enumerate(disk_names)])
+        self.vms.append(vm)
+
+    def list_disks(self):
+        return list(self.blobs.values())
+
+    def list_vms(self, full_scan=False):
+        return self.vms
+
+    def destroy_disk(self, disk_name, storage=None, etag=None):
+        assert etag == self.blobs[disk_name].properties.etag
+        if disk_name in self.refuse:
+            raise AzureHttpError('LeaseIdMissing', 412)
+        with self._lock:
+            self.deleted.append(disk_name)
+
+
+class OrphanCollectorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = FakeDiskManager()
+        self.manager.add_vm('node1', ['node1-lun0_reserved', 'flocker-a'])
+        self.manager.add_blob('node1-lun0_reserved')
+        self.manager.add_blob('node2-lun0_reserved')
+        self.manager.add_blob('flocker-a')
+        self.manager.add_blob('flocker-b')
+        self.manager.add_blob('flocker-c', leased=True)
+        self.manager.add_blob('flocker-d', age=timedelta(minutes=5))
+        self.manager.add_blob('os-disk')
+        self.audit_log_path = self.mktemp()
+        self.collector = OrphanCollector(self.manager, grace_period=3600,
+                                         rate=None,
+                                         audit_log_path=self.audit_log_path)
+
+    def _audit_log(self):
+        with open(self.audit_log_path) as audit_log:
+            return [json.loads(line) for line in audit_log]
+
+    def test_volumes_kept_without_known_ids(self):
+        report = self.collector.collect()
+        self.assertEqual([(o.name, o.kind) for o in report.orphans],
+                         [('node2-lun0_reserved',
+                           ORPHANED_LUN0_RESERVATION)])
+        self.assertEqual(report.blobs_listed, 7)
+
+    def test_dry_run_deletes_nothing(self):
+        report = self.collector.collect(known_disk_names=set(['flocker-a']))
+        self.assertEqual(sorted(o.name for o in report.orphans),
+                         ['flocker-b', 'node2-lun0_reserved'])
+        self.assertEqual(self.manager.deleted, [])
+        self.assertEqual(sorted((e['action'], e['name'])
+                                for e in self._audit_log()),
+                         [('dry_run', 'flocker-b'),
+                          ('dry_run', 'node2-lun0_reserved')])
+
+    def test_delete(self):
+        self.manager.refuse.add('flocker-b')
+        report = self.collector.collect(known_disk_names=set(),
+                                        dry_run=False)
+        self.assertEqual([o.kind for o in report.orphans
+                          if o.name == 'flocker-b'], [ORPHANED_VOLUME])
+        self.assertEqual(report.deleted, ['node2-lun0_reserved'])
+        self.assertEqual(list(report.failed), ['flocker-b'])
+        self.assertEqual(sorted((e['action'], e['name'])
+                                for e in self._audit_log()),
+                         [('delete', 'node2-lun0_reserved'),
+                          ('error', 'flocker-b')])
+
+    def test_large_container(self):
+        for i in range(10000):
+            self.manager.add_blob('flocker-%05d' % i)
+        collector = OrphanCollector(self.manager, grace_period=3600,
+                                    max_workers=16, rate=None)
+        report = collector.collect(known_disk_names=set(), dry_run=False)
+        self.assertEqual(len(report.deleted), 10002)
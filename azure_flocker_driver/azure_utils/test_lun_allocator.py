@@ -0,0 +1,53 @@
+from arm_disk_manager import AzureInsufficientLuns, LunAllocator
+from azure.mgmt.compute.models import DataDisk, VirtualHardDisk
+from twisted.trial import unittest
+import threading
+
+
+def data_disks(*luns):
+    return [DataDisk(lun=lun, name='flocker-%d' % (lun,),
+                     vhd=VirtualHardDisk('https://account/vhds/%d' % (lun,)),
+                     create_option='attach')
+            for lun in luns]
+
+
+class LunAllocatorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.allocator = LunAllocator()
+
+    def test_skips_used_and_reserved_luns(self):
+        first = self.allocator.reserve('node0', data_disks(0, 1, 3), 8)
+        second = self.allocator.reserve('node0', data_disks(0, 1, 3), 8,
+                                        count=2)
+        self.assertEqual((first, second), ([2], [4, 5]))
+
+    def test_full_lun_range(self):
+        luns = self.allocator.reserve('node0', data_disks(0), 64, count=63)
+        self.assertEqual(luns, range(1, 64))
+        self.assertRaises(AzureInsufficientLuns, self.allocator.reserve,
+                          'node0', data_disks(0), 64)
+
+    def test_concurrent_reservations_are_distinct(self):
+        picked = []
+        start = threading.Event()
+
+        def attach():
+            start.wait()
+            picked.extend(self.allocator.reserve('node0', data_disks(0), 64))
+        threads = [threading.Thread(target=attach) for i in range(32)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(picked), range(1, 33))
+
+    def test_released_on_failure(self):
+        def attach():
+            with self.allocator.reservation('node0', data_disks(0), 2):
+                raise ValueError()
+        self.assertRaises(ValueError, attach)
+        with self.allocator.reservation('node0', data_disks(0), 2) as luns:
+            self.assertEqual(luns, [1])
+        self.assertEqual(self.allocator._reserved, {})
@@ -0,0 +1,249 @@
+from arm_disk_manager import AzureCopyFailed, AzureDiskClaimed, DiskManager
+from azure.common import AzureConflictHttpError, AzureHttpError, \
+    AzureMissingResourceHttpError
+from azure.storage.blob.models import Blob, CopyProperties
+from migration import VolumeMigrator, _ByteBudget
+from twisted.trial import unittest
+import threading
+import time
+
+
+class FakeAccount(object):
+    """
+    Enough of ``PageBlobService`` to copy page blobs between accounts,
+    which find each other by name in ``accounts``.
+    """
+
+    def __init__(self, name, accounts):
+        self.name = name
+        self.accounts = accounts
+        accounts[name] = self
+        self.blobs = {}
+        self.metadata = {}
+        self.lease_id = None
+        self.renewals = 0
+        # copies made corrupt, for failure tests
+        self.corrupt_copies = False
+
+    def create_container(self, container_name):
+        pass
+
+    def list_blobs(self, container_name, include=None):
+        return [self.get_blob_properties(container_name, name)
+                for name in sorted(self.blobs)]
+
+    def exists(self, container_name, blob_name):
+        return blob_name in self.blobs
+
+    def acquire_blob_lease(self, container_name, blob_name,
+                           lease_duration=-1):
+        if self.lease_id is not None:
+            raise AzureConflictHttpError('LeaseAlreadyPresent', 409)
+        self.lease_id = 'lease'
+        return self.lease_id
+
+    def renew_blob_lease(self, container_name, blob_name, lease_id):
+        assert lease_id == self.lease_id
+        self.renewals += 1
+
+    def release_blob_lease(self, container_name, blob_name, lease_id):
+        assert lease_id == self.lease_id
+        self.lease_id = None
+
+    def get_blob_properties(self, container_name, blob_name, lease_id=None):
+        blob = Blob(blob_name, metadata=dict(self.metadata.get(blob_name,
+                                                               {})))
+        blob.properties.content_length = len(self.blobs[blob_name])
+        blob.properties.copy = CopyProperties()
+        blob.properties.copy.status = 'success'
+        return blob
+
+    def get_blob_to_bytes(self, container_name, blob_name, start_range,
+                          end_range):
+        return Blob(blob_name, content=bytes(
+            self.blobs[blob_name][start_range:end_range + 1]))
+
+    def generate_blob_shared_access_signature(self, container_name,
+                                              blob_name, permission,
+                                              expiry):
+        return 'sig=read'
+
+    def make_blob_url(self, container_name, blob_name, sas_token=None):
+        url = 'https://%s/%s/%s' % (self.name, container_name, blob_name)
+        if sas_token is not None:
+            url += '?' + sas_token
+        return url
+
+    def set_blob_metadata(self, container_name, blob_name, metadata):
+        self.metadata[blob_name] = dict(metadata)
+
+    def copy_blob(self, container_name, blob_name, copy_source,
+                  metadata=None):
+        account, container, source_name = \
+            copy_source.split('?')[0][len('https://'):].split('/')
+        source = self.accounts[account]
+        if account != self.name:
+            assert copy_source.endswith('?sig=read')
+        self.blobs[blob_name] = bytearray(source.blobs[source_name])
+        if self.corrupt_copies:
+            self.blobs[blob_name][-1:] = b'x'
+        if metadata is None:
+            metadata = source.metadata.get(source_name, {})
+        self.metadata[blob_name] = dict(metadata)
+        copy = CopyProperties()
+        copy.status = 'success'
+        return copy
+
+    def delete_blob(self, container_name, blob_name, lease_id=None,
+                    delete_snapshots=None):
+        if blob_name not in self.blobs:
+            raise AzureMissingResourceHttpError('BlobNotFound', 404)
+        if self.lease_id is not None:
+            assert lease_id == self.lease_id
+        del self.blobs[blob_name]
+
+
+class MigrateDiskTestCase(unittest.TestCase):
+
+    def setUp(self):
+        accounts = {}
+        self.source = FakeAccount('hot', accounts)
+        self.target = FakeAccount('cool', accounts)
+        self.source.blobs['flocker-a.vhd'] = bytearray(b'data' * 256)
+        self.source.metadata['flocker-a.vhd'] = {
+            DiskManager.PROFILE_METADATA_KEY: 'gold'}
+        self.manager = DiskManager(
+            None, None, self.source, 'vhds', 'group', 'westus',
+            extra_storage_clients=[('cool', self.target)])
+
+    def test_migrates_disk(self):
+        url = self.manager.migrate_disk('flocker-a', 'cool')
+        self.assertEqual(url, 'https://cool/vhds/flocker-a.vhd')
+        self.assertEqual((sorted(self.source.blobs),
+                          sorted(self.target.blobs)),
+                         ([], ['flocker-a.vhd']))
+        self.assertEqual(self.target.blobs['flocker-a.vhd'],
+                         bytearray(b'data' * 256))
+        self.assertEqual(
+            self.target.metadata['flocker-a.vhd'],
+            {DiskManager.PROFILE_METADATA_KEY: 'gold'})
+
+    def delete_source_with(self, delete):
+        original_delete = self.source.delete_blob
+
+        def delete_blob(container_name, blob_name, lease_id=None,
+                        delete_snapshots=None):
+            delete(lambda: original_delete(container_name, blob_name,
+                                           lease_id, delete_snapshots))
+        self.source.delete_blob = delete_blob
+
+    def test_copy_unlisted_until_source_deleted(self):
+        listings = []
+
+        def delete(original_delete):
+            listings.append([(d.name, d.storage)
+                             for d in self.manager._list_disks()
+                             if d.name.startswith('flocker-')])
+            original_delete()
+        self.delete_source_with(delete)
+        self.manager.migrate_disk('flocker-a', 'cool')
+        self.assertEqual(listings, [[('flocker-a', 'standard')]])
+        self.assertEqual([(d.name, d.storage)
+                          for d in self.manager._list_disks()],
+                         [('flocker-a', 'cool')])
+
+    def test_source_already_deleted(self):
+        def delete(original_delete):
+            # the first attempt went through, a retry finds nothing
+            original_delete()
+            original_delete()
+        self.delete_source_with(delete)
+        self.manager.migrate_disk('flocker-a', 'cool')
+        self.assertEqual((sorted(self.source.blobs),
+                          sorted(self.target.blobs)),
+                         ([], ['flocker-a.vhd']))
+
+    def test_failed_delete_of_removed_source_keeps_copy(self):
+        def delete(original_delete):
+            original_delete()
+            raise AzureHttpError('ServerBusy', 503)
+        self.delete_source_with(delete)
+        self.assertRaises(AzureHttpError, self.manager.migrate_disk,
+                          'flocker-a', 'cool')
+        self.assertEqual((sorted(self.source.blobs),
+                          sorted(self.target.blobs)),
+                         ([], ['flocker-a.vhd']))
+
+    def test_failed_delete_leaves_source(self):
+        def delete(original_delete):
+            raise AzureHttpError('ServerBusy', 503)
+        self.delete_source_with(delete)
+        self.assertRaises(AzureHttpError, self.manager.migrate_disk,
+                          'flocker-a', 'cool')
+        self.assertEqual((sorted(self.source.blobs),
+                          sorted(self.target.blobs), self.source.lease_id),
+                         (['flocker-a.vhd'], [], None))
+
+    def test_failed_copy_leaves_source(self):
+        self.target.corrupt_copies = True
+        self.assertRaises(AzureCopyFailed, self.manager.migrate_disk,
+                          'flocker-a', 'cool')
+        self.assertEqual((sorted(self.source.blobs),
+                          sorted(self.target.blobs), self.source.lease_id),
+                         (['flocker-a.vhd'], [], None))
+
+    def test_attached_disk_is_not_migrated(self):
+        self.source.metadata['flocker-a.vhd'][
+            DiskManager.OWNER_METADATA_KEY] = 'node1'
+        self.assertRaises(AzureDiskClaimed, self.manager.migrate_disk,
+                          'flocker-a', 'cool')
+        self.assertEqual((sorted(self.target.blobs), self.source.lease_id),
+                         ([], None))
+
+
+class ByteBudgetTestCase(unittest.TestCase):
+
+    def test_limits_bytes_in_flight(self):
+        budget = _ByteBudget(100)
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def migrate(size):
+            budget.acquire(size)
+            with lock:
+                running.append(size)
+                peak.append(sum(running))
+            time.sleep(0.01)
+            with lock:
+                running.remove(size)
+            budget.release(size)
+        threads = [threading.Thread(target=migrate, args=(size,))
+                   for size in (60, 60, 30, 150)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # the disk larger than the budget ran alone
+        self.assertEqual(max(peak), 150)
+        self.assertTrue(all(p <= 100 or p == 150 for p in peak))
+
+
+class VolumeMigratorTestCase(unittest.TestCase):
+
+    def test_reports_failures(self):
+        accounts = {}
+        source = FakeAccount('hot', accounts)
+        FakeAccount('cool', accounts)
+        for name in ('flocker-a', 'flocker-b'):
+            source.blobs[name + '.vhd'] = bytearray(512)
+        source.metadata['flocker-b.vhd'] = {
+            DiskManager.OWNER_METADATA_KEY: 'node1'}
+        manager = DiskManager(
+            None, None, source, 'vhds', 'group', 'westus',
+            extra_storage_clients=[('cool', accounts['cool'])])
+        report = VolumeMigrator(manager, max_workers=1).migrate(
+            ['flocker-a', 'flocker-b'], 'cool')
+        self.assertEqual((report.migrated, list(report.failed),
+                          report.migrated_bytes),
+                         (['flocker-a'], ['flocker-b'], 512))
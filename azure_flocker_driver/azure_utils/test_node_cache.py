@@ -0,0 +1,85 @@
+from arm_disk_manager import DiskManager
+from azure.storage.blob.models import Blob
+from node_cache import NodeCache
+from twisted.trial import unittest
+import threading
+import time
+
+
+class FakeStorageClient(object):
+
+    def __init__(self):
+        self.blobs = ['flocker-a.vhd', 'flocker-b.vhd']
+        self.listings = 0
+
+    def create_container(self, container_name):
+        pass
+
+    def list_blobs(self, container_name, include=None):
+        self.listings += 1
+        return [Blob(name) for name in self.blobs]
+
+    def delete_blob(self, container_name, blob_name, **kwargs):
+        self.blobs.remove(blob_name)
+
+
+class NodeCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.cache = NodeCache(self.path, refresh_timeout=5)
+        self.fetches = []
+
+    def _fetch(self, value, delay=0):
+        def fetch():
+            self.fetches.append(value)
+            time.sleep(delay)
+            return value
+        return fetch
+
+    def test_ttl(self):
+        values = [self.cache.get('disks', 0.2, self._fetch(v))
+                  for v in ('a', 'b')]
+        time.sleep(0.3)
+        values.append(self.cache.get('disks', 0.2, self._fetch('c')))
+        self.assertEqual((values, self.fetches),
+                         (['a', 'a', 'c'], ['a', 'c']))
+
+    def test_single_refresh_across_instances(self):
+        # a second instance stands in for another process on the node
+        other = NodeCache(self.path, refresh_timeout=5)
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            other.get('vms', 60, self._fetch(['vm1'], delay=0.5))))
+        thread.start()
+        while not self.fetches:
+            time.sleep(0.01)
+        results.append(self.cache.get('vms', 60, self._fetch(['vm2'])))
+        thread.join()
+        self.assertEqual((results, self.fetches, self.cache.stats.waits),
+                         ([['vm1'], ['vm1']], [['vm1']], 1))
+
+    def test_invalidated_refresh_not_stored(self):
+        thread = threading.Thread(target=self.cache.get, args=(
+            'disks', 60, self._fetch('stale', delay=0.3)))
+        thread.start()
+        while not self.fetches:
+            time.sleep(0.01)
+        NodeCache(self.path).invalidate('disks')
+        thread.join()
+        self.assertEqual(self.cache.get('disks', 60, self._fetch('fresh')),
+                         'fresh')
+
+    def test_disk_manager_invalidates(self):
+        storage_client = FakeStorageClient()
+        managers = [DiskManager(None, None, storage_client, 'vhds',
+                                'group', 'westus',
+                                node_cache=NodeCache(self.path))
+                    for i in range(2)]
+        listed = [[d.name for d in manager.list_disks()]
+                  for manager in managers]
+        managers[0].destroy_disk('flocker-a')
+        listed.append([d.name for d in managers[1].list_disks()])
+        self.assertEqual(listed, [['flocker-a', 'flocker-b']] * 2 +
+                         [['flocker-b']])
+        self.assertEqual(storage_client.listings, 2)
@@ -0,0 +1,79 @@
+from arm_disk_manager import DiskManager
+from azure.mgmt.compute.models import DataDisk, StorageProfile, \
+    VirtualMachine
+from twisted.trial import unittest
+
+
+def make_vm(name, disk_names=(), tags=None):
+    vm = VirtualMachine(location='westus', tags=tags,
+                        storage_profile=StorageProfile(data_disks=[
+                            DataDisk(lun=lun, name=disk_name, vhd=None,
+                                     create_option='attach')
+                            for (lun, disk_name) in enumerate(disk_names)]))
+    vm.name = name
+    return vm
+
+
+class FakeVirtualMachines(object):
+
+    def __init__(self):
+        self.vms = []
+        self.updates = []
+
+    def list(self, group_name):
+        return iter(self.vms)
+
+    def create_or_update(self, group_name, vm_name, vm):
+        self.updates.append((vm_name, dict(vm.tags)))
+
+
+class FakeComputeClient(object):
+
+    def __init__(self):
+        self.virtual_machines = FakeVirtualMachines()
+
+
+class NodeDiscoveryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.compute = FakeComputeClient()
+        self.compute.virtual_machines.vms = [
+            make_vm('tagged', tags={'flocker-node': 'true'}),
+            make_vm('named'),
+            make_vm('untagged', ['node-lun0_reserved', 'flocker-a']),
+            make_vm('other', ['data'])]
+
+    def manager(self, node_names=None):
+        return DiskManager(None, self.compute, None, 'vhds', 'group',
+                           'westus', node_names=node_names)
+
+    def names(self, vms):
+        return [vm.name for vm in vms]
+
+    def test_updates_tag_the_vm(self):
+        self.manager()._update_vm('node1', make_vm('node1'))
+        (vm_name, tags), = self.compute.virtual_machines.updates
+        self.assertEqual((vm_name, tags['flocker-node']), ('node1', 'true'))
+
+    def test_lists_tagged_vms(self):
+        manager = self.manager()
+        self.assertEqual(self.names(manager.list_vms()),
+                         ['tagged', 'untagged'])
+
+    def test_lists_named_vms(self):
+        manager = self.manager(node_names=['named'])
+        self.assertEqual(self.names(manager.list_vms()),
+                         ['tagged', 'named', 'untagged'])
+
+    def test_full_scan_finds_untagged_nodes(self):
+        manager = self.manager(node_names=['named'])
+        self.assertEqual(self.names(manager.list_vms(full_scan=True)),
+                         ['tagged', 'named', 'untagged', 'other'])
+        self.assertEqual(manager._untagged_nodes, set(['untagged']))
+
+    def test_untagged_nodes_kept_between_scans(self):
+        manager = self.manager()
+        manager.list_vms()
+        self.compute.virtual_machines.vms[2].storage_profile.data_disks = []
+        self.assertEqual(self.names(manager.list_vms()),
+                         ['tagged', 'untagged'])
@@ -0,0 +1,133 @@
+from azure.common import AzureConflictHttpError, AzureHttpError
+from azure.storage.blob.models import Blob, PageRange, ResourceProperties
+from reclaim import ZeroPageReclaimer, merge_runs, zero_runs
+from twisted.trial import unittest
+
+
+class FakeSparsePageBlob(object):
+    """
+    Enough of ``PageBlobService`` to reclaim a single page blob, keeping
+    track of which pages are populated, zero or not.
+    """
+
+    def __init__(self, size):
+        self.content = bytearray(size)
+        self.populated = set()
+        self.etag = 1
+        self.lease_id = None
+        self.leases = 0
+
+    def write(self, start, data):
+        self.content[start:start + len(data)] = data
+        self.populated.update(range(start // 512,
+                                    (start + len(data) - 1) // 512 + 1))
+        self.etag += 1
+
+    def _check(self, if_match):
+        if if_match is not None and if_match != self.etag:
+            raise AzureHttpError('ConditionNotMet', 412)
+
+    def get_blob_properties(self, container_name, blob_name, if_match=None):
+        self._check(if_match)
+        blob = Blob(blob_name)
+        blob.properties.content_length = len(self.content)
+        return blob
+
+    def get_page_ranges(self, container_name, blob_name, if_match=None):
+        self._check(if_match)
+        return [PageRange(page * 512, page * 512 + 511)
+                for page in sorted(self.populated)]
+
+    def get_blob_to_bytes(self, container_name, blob_name, start_range,
+                          end_range, if_match=None):
+        self._check(if_match)
+        return Blob(blob_name,
+                    content=bytes(self.content[start_range:end_range + 1]))
+
+    def acquire_blob_lease(self, container_name, blob_name, lease_duration,
+                           if_match=None):
+        if self.lease_id is not None:
+            raise AzureConflictHttpError('LeaseAlreadyPresent', 409)
+        self._check(if_match)
+        self.leases += 1
+        self.lease_id = 'lease'
+        return self.lease_id
+
+    def release_blob_lease(self, container_name, blob_name, lease_id):
+        assert lease_id == self.lease_id
+        self.lease_id = None
+
+    def clear_page(self, container_name, blob_name, start_range, end_range,
+                   lease_id=None):
+        assert lease_id == self.lease_id is not None
+        assert start_range % 512 == 0 and (end_range + 1) % 512 == 0
+        self.content[start_range:end_range + 1] = \
+            bytearray(end_range + 1 - start_range)
+        self.populated.difference_update(
+            range(start_range // 512, end_range // 512 + 1))
+        self.etag += 1
+        properties = ResourceProperties()
+        properties.etag = self.etag
+        return properties
+
+
+class ZeroRunsTestCase(unittest.TestCase):
+
+    def test_zero_runs(self):
+        data = b'\0' * 1024 + b'a' * 512 + b'\0' * 512
+        self.assertEqual(zero_runs(data, 4096),
+                         [(4096, 5119), (5632, 6143)])
+        self.assertEqual(zero_runs(b'\0' * 2048, 0), [(0, 2047)])
+
+    def test_merge_runs(self):
+        self.assertEqual(merge_runs([(1024, 2047), (0, 1023), (4096, 4607)]),
+                         [(0, 2047), (4096, 4607)])
+
+
+class ZeroPageReclaimerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.size = 1024 * 1024
+        self.blob = FakeSparsePageBlob(self.size)
+        # a zeroed run, data, a zeroed run too short to clear, and a
+        # footer of zeros
+        self.blob.write(0, b'\0' * 65536)
+        self.blob.write(65536, b'a' * 512)
+        self.blob.write(66048, b'\0' * 1024)
+        self.blob.write(self.size - 512, b'\0' * 512)
+        self.reclaimer = ZeroPageReclaimer(self.blob, 'vhds',
+                                           min_run=4096, batch_size=1)
+
+    def test_reclaims_zero_runs(self):
+        result = self.reclaimer.reclaim('flocker-a.vhd', self.blob.etag)
+        self.assertEqual((result.scanned_bytes, result.zero_bytes,
+                          result.reclaimed_bytes, result.interrupted),
+                         (65536 + 512 + 1024, 65536 + 1024, 65536, None))
+        # the short run and the footer are still populated
+        self.assertEqual(sorted(self.blob.populated),
+                         [128, 129, 130, self.size // 512 - 1])
+        self.assertEqual(result.etag, self.blob.etag)
+
+    def test_changed_blob_is_left_alone(self):
+        etag = self.blob.etag
+        self.blob.write(131072, b'b' * 512)
+        result = self.reclaimer.reclaim('flocker-a.vhd', etag)
+        self.assertEqual((result.reclaimed_bytes, result.interrupted),
+                         (0, 'changed'))
+
+    def test_stops_when_leased(self):
+        self.blob.write(196608, b'\0' * 8192)
+        original_clear = self.blob.clear_page
+
+        def clear_then_attach(*args, **kwargs):
+            # an attach leases the blob as the first batch finishes
+            properties = original_clear(*args, **kwargs)
+            self.blob.release_blob_lease('vhds', 'flocker-a.vhd',
+                                         self.blob.lease_id)
+            self.blob.lease_id = 'attach'
+            self.blob.release_blob_lease = lambda *args: None
+            return properties
+        self.blob.clear_page = clear_then_attach
+        result = self.reclaimer.reclaim('flocker-a.vhd', self.blob.etag)
+        self.assertEqual((result.reclaimed_bytes, result.cleared_ranges,
+                          result.interrupted), (65536, 1, 'leased'))
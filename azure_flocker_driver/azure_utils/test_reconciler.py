@@ -0,0 +1,118 @@
+from arm_disk_manager import DiskManager
+from azure.mgmt.compute.models import DataDisk, DiskInstanceView, \
+    InstanceViewStatus, OSDisk, StorageProfile, VirtualMachine, \
+    VirtualMachineInstanceView
+from reconciler import DiskReconciler
+from twisted.trial import unittest
+import copy
+import threading
+
+
+def make_vm(model_disks, view_disks, provisioning_state='Succeeded'):
+    """
+    A VM model fetched with its instance view, with ``model_disks`` names
+    in the model and ``view_disks`` mapping names in the instance view to
+    their status codes.
+    """
+    vm = VirtualMachine(
+        location='westus',
+        storage_profile=StorageProfile(
+            os_disk=OSDisk(name='os', vhd=None, create_option=''),
+            data_disks=[DataDisk(lun=lun, name=name, vhd=None,
+                                 create_option='attach')
+                        for (lun, name) in enumerate(model_disks)]))
+    vm.instance_view = VirtualMachineInstanceView(disks=[
+        DiskInstanceView(name=name,
+                         statuses=[InstanceViewStatus(code=code)])
+        for (name, code) in sorted(view_disks.items())])
+    vm.provisioning_state = provisioning_state
+    return vm
+
+
+SUCCEEDED = 'ProvisioningState/succeeded'
+FAILED = 'ProvisioningState/failed/AttachDiskWhileBeingDetached'
+
+
+class StuckDisksTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = DiskManager(None, None, None, 'vhds', 'group',
+                                   'westus')
+
+    def test_stuck_disks(self):
+        vm = make_vm(['a'], {'os': SUCCEEDED, 'a': SUCCEEDED,
+                             'b': SUCCEEDED})
+        self.assertEqual([d.name for d in self.manager.list_stuck_disks(vm)],
+                         ['b'])
+
+    def test_failed_disks(self):
+        vm = make_vm(['a', 'b'], {'os': SUCCEEDED, 'a': FAILED,
+                                  'b': SUCCEEDED, 'c': FAILED})
+        self.assertEqual([d.name for d in
+                          self.manager.list_failed_disks(vm)], ['a'])
+
+    def test_without_instance_view(self):
+        vm = make_vm(['a'], {})
+        vm.instance_view = None
+        self.assertEqual((self.manager.list_stuck_disks(vm),
+                          self.manager.list_failed_disks(vm)), ([], []))
+
+
+class ReconcilerTestCase(unittest.TestCase):
+    """
+    ``DiskReconciler`` and ``DiskManager.reconcile_vm`` with the VMs and
+    their updates replaced.
+    """
+
+    def setUp(self):
+        self.manager = DiskManager(None, None, None, 'vhds', 'group',
+                                   'westus')
+        self.lock = threading.Lock()
+        self.vms = {}
+        self.gets = []
+        self.updates = []
+        self.manager.get_vm = self.get_vm
+        self.manager._update_vm_and_wait = self.update_vm
+        self.reconciler = DiskReconciler(self.manager, None, 'node1',
+                                         self.lock)
+
+    def get_vm(self, vm_name, expand=None):
+        self.gets.append(vm_name)
+        return copy.deepcopy(self.vms[vm_name])
+
+    def update_vm(self, vm_name, vm, deadline=None):
+        self.assertTrue(self.lock.locked())
+        self.updates.append(
+            (vm_name, [d.name for d in vm.storage_profile.data_disks]))
+
+    def test_reconciles_own_vm(self):
+        self.vms['node1'] = make_vm(['a', 'b'], {'a': SUCCEEDED,
+                                                 'b': FAILED,
+                                                 'c': SUCCEEDED})
+        self.vms['node2'] = make_vm([], {'d': SUCCEEDED})
+        report = self.reconciler.reconcile_once()
+        self.assertEqual(self.updates, [('node1', ['a'])])
+        self.assertEqual((report.stuck_disks, report.failed_disks,
+                          report.reconciled_vms, set(self.gets)),
+                         ({'node1': ['c']}, {'node1': ['b']}, ['node1'],
+                          set(['node1'])))
+
+    def test_update_in_flight_is_left_alone(self):
+        self.vms['node1'] = make_vm(['a'], {'a': SUCCEEDED, 'b': SUCCEEDED},
+                                    provisioning_state='Updating')
+        report = self.reconciler.reconcile_once()
+        self.assertEqual((self.updates, report.reconciled_vms), ([], []))
+
+    def test_checked_again_under_lock(self):
+        self.vms['node1'] = make_vm(['a'], {'a': SUCCEEDED, 'b': SUCCEEDED})
+        original_get = self.get_vm
+
+        def get_vm(vm_name, expand=None):
+            vm = original_get(vm_name, expand)
+            # an attach starts between the check and taking the lock
+            self.vms['node1'].provisioning_state = 'Updating'
+            return vm
+        self.manager.get_vm = get_vm
+        report = self.reconciler.reconcile_once()
+        self.assertEqual((self.updates, report.reconciled_vms,
+                          report.errors), ([], [], {}))
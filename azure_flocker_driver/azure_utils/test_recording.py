@@ -0,0 +1,182 @@
+from azure.common import AzureHttpError
+from azure.mgmt.compute.models import (
+    CachingTypes, DataDisk, VirtualHardDisk, VirtualMachine
+)
+from azure.storage.blob.models import Blob
+from datetime import datetime
+from recording import (
+    CALL, SCRUBBED, RecordingProxy, ReplayExhausted, TraceRecorder,
+    TraceReplayer
+)
+from twisted.trial import unittest
+import json
+import time
+
+
+class FakePoller(object):
+
+    def __init__(self, done_after):
+        self._done_at = time.time() + done_after
+
+    def done(self):
+        return time.time() >= self._done_at
+
+    def wait(self, timeout=None):
+        pass
+
+    def result(self, timeout=None):
+        return None
+
+    def add_done_callback(self, func):
+        pass
+
+
+class FakeVirtualMachines(object):
+
+    def __init__(self):
+        self.states = ['Updating', 'Updating', 'Succeeded']
+
+    def get(self, group_name, vm_name):
+        vm = VirtualMachine(location='westus')
+        vm.name = vm_name
+        vm.provisioning_state = self.states.pop(0)
+        vm.data_disks = [DataDisk(lun=1, name='flocker-a',
+                                  create_option='attach',
+                                  vhd=VirtualHardDisk(
+                                      'https://account/vhds/flocker-a.vhd'),
+                                  caching=CachingTypes.read_write)]
+        return vm
+
+    def create_or_update(self, group_name, vm_name, vm):
+        return FakePoller(0.2)
+
+
+class FakeCompute(object):
+
+    def __init__(self):
+        self.virtual_machines = FakeVirtualMachines()
+
+
+class FakeStorage(object):
+
+    def get_blob_properties(self, container_name, blob_name):
+        if blob_name == 'missing':
+            raise AzureHttpError('BlobNotFound', 404)
+        blob = Blob(blob_name, metadata={'flocker_owner': 'node1'})
+        blob.properties.last_modified = datetime(2016, 5, 1, 12, 30)
+        return blob
+
+    def list_blobs(self, container_name, account_key=None):
+        return (Blob(name) for name in ('flocker-a', 'flocker-b'))
+
+    def make_blob_url(self, container_name, blob_name, sas_token=None):
+        return 'https://account/%s/%s?se=1&sig=abc' % (container_name,
+                                                       blob_name)
+
+    def get_blob_to_bytes(self, container_name, blob_name, start_range,
+                          end_range):
+        return Blob(blob_name, content=b'volume data' * 100)
+
+    def update_page(self, container_name, blob_name, page, start_range,
+                    end_range):
+        pass
+
+
+class RecordingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.trace_path = self.mktemp()
+        self.recorder = TraceRecorder(self.trace_path)
+        self.storage = RecordingProxy(FakeStorage(), self.recorder,
+                                      'storage:account')
+        self.compute = RecordingProxy(FakeCompute(), self.recorder,
+                                      'compute',
+                                      operations=('virtual_machines',))
+
+    def _calls(self):
+        with open(self.trace_path) as trace_file:
+            return [entry for entry in map(json.loads, trace_file)
+                    if entry['type'] == CALL]
+
+    def _replayer(self, speed=1.0):
+        self.recorder.close()
+        return TraceReplayer(self.trace_path, speed=speed)
+
+    def test_secrets_scrubbed(self):
+        self.storage.list_blobs('vhds', account_key='c2VjcmV0')
+        self.storage.get_blob_properties(
+            'vhds', 'https://account/vhds/a.vhd?se=1&sig=secret')
+        (listed, read) = self._calls()
+        self.assertEqual(listed['kwargs'], {'account_key': SCRUBBED})
+        self.assertEqual(read['args'][1],
+                         'https://account/vhds/a.vhd?se=1&sig=' + SCRUBBED)
+        self.assertNotIn('secret', open(self.trace_path).read())
+
+    def test_blob_data_not_recorded(self):
+        self.storage.get_blob_to_bytes('vhds', 'flocker-a', 0, 1099)
+        self.storage.update_page('vhds', 'flocker-a', b'\0\1volume data',
+                                 0, 511)
+        self.storage.update_page('vhds', 'flocker-a', start_range=0,
+                                 end_range=511, page=b'volume data')
+        self.assertNotIn('volume data', open(self.trace_path).read())
+
+        storage = self._replayer(speed=100).client('storage:account')
+        self.assertEqual(
+            storage.get_blob_to_bytes('vhds', 'flocker-a', 0, 1099).content,
+            b'\0' * 1100)
+
+    def test_replay_results_and_errors(self):
+        self.storage.get_blob_properties('vhds', 'flocker-a')
+        self.assertRaises(AzureHttpError, self.storage.get_blob_properties,
+                          'vhds', 'missing')
+        self.assertEqual(len(self.storage.list_blobs('vhds')), 2)
+        self.compute.virtual_machines.get('group', 'node1')
+
+        replayer = self._replayer(speed=100)
+        storage = replayer.client('storage:account', local=FakeStorage())
+        blob = storage.get_blob_properties('vhds', 'flocker-a')
+        self.assertEqual((blob.name, blob.metadata,
+                          blob.properties.last_modified),
+                         ('flocker-a', {'flocker_owner': 'node1'},
+                          datetime(2016, 5, 1, 12, 30)))
+        error = self.assertRaises(AzureHttpError,
+                                  storage.get_blob_properties,
+                                  'vhds', 'missing')
+        self.assertEqual(error.status_code, 404)
+        self.assertEqual([b.name for b in storage.list_blobs('vhds')],
+                         ['flocker-a', 'flocker-b'])
+        self.assertIn('sig=abc', storage.make_blob_url('vhds', 'flocker-a'))
+        vm = replayer.client('compute').virtual_machines.get('group',
+                                                             'node1')
+        self.assertEqual(vm.data_disks[0].caching, CachingTypes.read_write)
+
+    def test_poller_tail_replayed(self):
+        poller = self.compute.virtual_machines.create_or_update(
+            'group', 'node1', VirtualMachine(location='westus'))
+        while not poller.done():
+            time.sleep(0.01)
+
+        replayer = self._replayer(speed=2)
+        virtual_machines = replayer.client('compute').virtual_machines
+        poller = virtual_machines.create_or_update(
+            'group', 'node1', VirtualMachine(location='westus'))
+        start = time.time()
+        while not poller.done():
+            time.sleep(0.01)
+        self.assertTrue(0.05 <= time.time() - start < 0.2)
+        self.assertRaises(ReplayExhausted,
+                          virtual_machines.create_or_update,
+                          'group', 'node1', VirtualMachine(location='westus'))
+
+    def test_reads_follow_replay_clock(self):
+        for delay in (0, 0.2, 0.2):
+            time.sleep(delay)
+            self.compute.virtual_machines.get('group', 'node1')
+
+        replayer = self._replayer(speed=4)
+        virtual_machines = replayer.client('compute').virtual_machines
+        states = [virtual_machines.get('group', 'node1').provisioning_state]
+        time.sleep(0.15)
+        states.append(
+            virtual_machines.get('group', 'node1').provisioning_state)
+        self.assertEqual(states, ['Updating', 'Succeeded'])
@@ -0,0 +1,79 @@
+from arm_disk_manager import DiskManager, ResourceGroup
+from twisted.trial import unittest
+import threading
+
+
+class FakeVM(object):
+
+    def __init__(self, name, group_name):
+        self.name = name
+        self.group_name = group_name
+        self.tags = {DiskManager.DEFAULT_NODE_TAG: 'true'}
+
+
+class FakeGroupVirtualMachines(object):
+    """
+    The VMs of one resource group.  Listings can be held until another
+    group's listing has started, to show that groups are listed at once.
+    """
+
+    def __init__(self, group_name, vm_names, started, wait_for=None):
+        self.group_name = group_name
+        self.vm_names = vm_names
+        self.started = started
+        self.wait_for = wait_for
+        self.lists = 0
+
+    def list(self, resource_group_name):
+        assert resource_group_name == self.group_name
+        self.lists += 1
+        self.started.set()
+        if self.wait_for is not None and not self.wait_for.wait(5):
+            raise AssertionError('groups were listed one at a time')
+        return [FakeVM(name, self.group_name) for name in self.vm_names]
+
+    def get(self, resource_group_name, vm_name, expand=None):
+        assert resource_group_name == self.group_name
+        assert vm_name in self.vm_names
+        return FakeVM(vm_name, self.group_name)
+
+
+class FakeComputeClient(object):
+
+    def __init__(self, virtual_machines):
+        self.virtual_machines = virtual_machines
+
+
+class ResourceGroupsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        first_started = threading.Event()
+        second_started = threading.Event()
+        self.first = FakeGroupVirtualMachines(
+            'group', ['node0', 'shared'], first_started,
+            wait_for=second_started)
+        self.second = FakeGroupVirtualMachines(
+            'other', ['node1', 'shared'], second_started,
+            wait_for=first_started)
+        self.manager = DiskManager(
+            None, FakeComputeClient(self.first), None, 'vhds', 'group',
+            'westus',
+            resource_groups=[
+                ResourceGroup('other', FakeComputeClient(self.second),
+                              subscription_id='sub2')])
+
+    def test_lists_groups_concurrently(self):
+        self.assertEqual(
+            sorted((vm.group_name, vm.name)
+                   for vm in self.manager.list_vms()),
+            [('group', 'node0'), ('group', 'shared'),
+             ('other', 'node1'), ('other', 'shared')])
+
+    def test_get_vm_resolves_group_from_index(self):
+        self.assertEqual(self.manager.get_vm('node1').group_name, 'other')
+        self.assertEqual(self.manager.get_vm('node0').group_name, 'group')
+        # the first lookup indexed every group
+        self.assertEqual((self.first.lists, self.second.lists), (1, 1))
+
+    def test_first_group_wins_a_shared_name(self):
+        self.assertEqual(self.manager.get_vm('shared').group_name, 'group')
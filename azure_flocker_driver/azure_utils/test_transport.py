@@ -0,0 +1,102 @@
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from transport import PooledTransport
+from twisted.trial import unittest
+import threading
+import time
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/slow':
+            self.server.release.wait()
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write('ok')
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeServiceClient(object):
+
+    def __init__(self):
+        self.config = type('Configuration', (object,), {})()
+        self.config.keep_alive = False
+        self._session = None
+
+
+class FakeManagementClient(object):
+
+    def __init__(self):
+        self._client = FakeServiceClient()
+
+
+class PooledTransportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), KeepAliveHandler)
+        self.server.release = threading.Event()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def _transport(self, **kwargs):
+        transport = PooledTransport(**kwargs)
+        self.addCleanup(transport.close)
+        return transport
+
+    def test_connections_reused(self):
+        transport = self._transport()
+        for endpoint in ('arm', 'arm', 'storage:account'):
+            for i in range(3):
+                transport.session(endpoint).get(self.url + '/')
+        stats = transport.stats()
+        self.assertEqual(
+            [(stats[e]['requests'], stats[e]['handshakes'],
+              stats[e]['reused'], stats[e]['pool_size'])
+             for e in ('arm', 'storage:account')],
+            [(6, 1, 5, 10), (3, 1, 2, 32)])
+
+    def test_reuse_limit(self):
+        transport = self._transport(max_requests=2)
+        for i in range(5):
+            transport.session('arm').get(self.url + '/')
+        stats = transport.stats()['arm']
+        self.assertEqual((stats['handshakes'], stats['recycled']), (3, 2))
+
+    def test_utilization(self):
+        transport = self._transport(pool_sizes={'arm': 4})
+        session = transport.session('arm')
+        threads = [threading.Thread(target=session.get,
+                                    args=(self.url + '/slow',))
+                   for i in range(3)]
+        for thread in threads:
+            thread.start()
+        while transport.stats()['arm']['in_use'] < 3:
+            time.sleep(0.01)
+        self.server.release.set()
+        for thread in threads:
+            thread.join()
+        stats = transport.stats()['arm']
+        self.assertEqual((stats['in_use'], stats['peak_in_use'],
+                          stats['utilization']), (0, 3, 0.75))
+
+    def test_management_client_shares_session(self):
+        transport = self._transport()
+        clients = [transport.configure_management_client(
+            FakeManagementClient(), 'arm') for i in range(2)]
+        self.assertEqual(
+            [(c._client.config.keep_alive, c._client._session)
+             for c in clients],
+            [(True, transport.session('arm'))] * 2)
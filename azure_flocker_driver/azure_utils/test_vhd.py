@@ -0,0 +1,186 @@
+from arm_disk_manager import AzureAsynchronousTimeout, \
+    AzureOperationNotAllowed, DiskManager
+from azure.common import AzureConflictHttpError
+from azure.storage.blob.models import Blob
+from vhd import Vhd, AzureOperationFailed
+from twisted.trial import unittest
+import time
+
+GIB = 1024 * 1024 * 1024
+
+
+class FakePageBlob(object):
+
+    def __init__(self, size):
+        self.content = bytearray(size)
+        self.pages_written = 0
+        self.lease_ids = set()
+
+    def get_blob_to_bytes(self, container_name, blob_name, start_range,
+                          end_range):
+        blob = type('Blob', (object,), {})()
+        blob.content = bytes(self.content[start_range:end_range + 1])
+        return blob
+
+    def update_page(self, container_name, blob_name, page, start_range,
+                    end_range, lease_id=None):
+        self.lease_ids.add(lease_id)
+        self.pages_written += 1
+        self.content[start_range:end_range + 1] = page
+
+    def clear_page(self, container_name, blob_name, start_range,
+                   end_range, lease_id=None):
+        self.lease_ids.add(lease_id)
+        self.content[start_range:end_range + 1] = \
+            bytearray(end_range + 1 - start_range)
+
+    def resize_blob(self, container_name, blob_name, content_length,
+                    lease_id=None):
+        self.lease_ids.add(lease_id)
+        self.content.extend(bytearray(content_length - len(self.content)))
+
+    def make_blob_url(self, container_name, blob_name):
+        return 'https://account/%s/%s' % (container_name, blob_name)
+
+
+class FakeLeasedVhdBlob(object):
+    """
+    Enough of ``PageBlobService`` to resize a leased VHD of any size,
+    keeping only the pages written.  The first ``busy`` lease requests
+    conflict, as the platform's lease does shortly after a detach.
+    """
+
+    def __init__(self, size, busy=0):
+        self.length = size + 512
+        self.pages = {}
+        self.busy = busy
+        self.lease_id = None
+        Vhd.write_vhd_footer(self, 'vhds', 'flocker-a.vhd', self.length,
+                             Vhd.generate_vhd_footer(size))
+
+    def acquire_blob_lease(self, container_name, blob_name,
+                           lease_duration=-1):
+        if self.busy or self.lease_id is not None:
+            self.busy = max(self.busy - 1, 0)
+            raise AzureConflictHttpError('LeaseAlreadyPresent', 409)
+        self.lease_id = 'lease'
+        return self.lease_id
+
+    def release_blob_lease(self, container_name, blob_name, lease_id):
+        assert lease_id == self.lease_id
+        self.lease_id = None
+
+    def get_blob_properties(self, container_name, blob_name,
+                            lease_id=None):
+        blob = Blob(blob_name)
+        blob.properties.content_length = self.length
+        return blob
+
+    def get_blob_to_bytes(self, container_name, blob_name, start_range,
+                          end_range):
+        return Blob(blob_name, content=self.pages.get(
+            start_range, bytes(bytearray(end_range + 1 - start_range))))
+
+    def update_page(self, container_name, blob_name, page, start_range,
+                    end_range, lease_id=None):
+        assert lease_id == self.lease_id
+        self.pages[start_range] = bytes(page)
+
+    def clear_page(self, container_name, blob_name, start_range,
+                   end_range, lease_id=None):
+        assert lease_id == self.lease_id is not None
+        self.pages.pop(start_range, None)
+
+    def resize_blob(self, container_name, blob_name, content_length,
+                    lease_id=None):
+        assert lease_id == self.lease_id is not None
+        self.length = content_length
+
+    def make_blob_url(self, container_name, blob_name):
+        return 'https://account/%s/%s' % (container_name, blob_name)
+
+
+class ResizeDiskTestCase(unittest.TestCase):
+
+    def manager(self, blob):
+        return DiskManager(None, None, blob, 'vhds', 'group', 'westus')
+
+    def test_grows_disk(self):
+        blob = FakeLeasedVhdBlob(2 * GIB)
+        self.manager(blob).resize_disk('flocker-a', 3)
+        self.assertEqual((blob.length, sorted(blob.pages), blob.lease_id),
+                         (3 * GIB + 512, [3 * GIB], None))
+
+    def test_shrink_refused(self):
+        blob = FakeLeasedVhdBlob(2 * GIB)
+        self.assertRaises(AzureOperationNotAllowed,
+                          self.manager(blob).resize_disk, 'flocker-a', 1)
+        self.assertEqual((blob.length, blob.lease_id), (2 * GIB + 512, None))
+
+    def test_lease_retried(self):
+        blob = FakeLeasedVhdBlob(2 * GIB, busy=2)
+        manager = self.manager(blob)
+        sleeps = []
+        manager._sleep = lambda seconds, deadline: sleeps.append(seconds)
+        manager.resize_disk('flocker-a', 3)
+        self.assertEqual((sleeps, blob.length), ([1, 1], 3 * GIB + 512))
+
+    def test_lease_retried_until_deadline(self):
+        blob = FakeLeasedVhdBlob(2 * GIB, busy=1000)
+        self.assertRaises(AzureAsynchronousTimeout,
+                          self.manager(blob).resize_disk, 'flocker-a', 3,
+                          deadline=time.time() + 0.1)
+        self.assertEqual(blob.length, 2 * GIB + 512)
+
+
+class VhdFooterTestCase(unittest.TestCase):
+
+    def test_regenerate_unique_id(self):
+        size = 2 * 1024 * 1024 * 1024
+        footer = Vhd.generate_vhd_footer(size)
+        new_footer = Vhd.regenerate_unique_id(footer)
+
+        self.assertEqual(len(new_footer), 512)
+        self.assertNotEqual(footer[68:84], new_footer[68:84])
+
+        # everything other than the unique id and checksum is unchanged
+        self.assertEqual(footer[0:64], new_footer[0:64])
+        self.assertEqual(footer[84:], new_footer[84:])
+
+    def test_regenerate_unique_id_checksum(self):
+        footer = Vhd.regenerate_unique_id(Vhd.generate_vhd_footer(1024))
+        total = 0
+        for byte in bytearray(footer[0:64] + footer[68:]):
+            total += byte
+        checksum = bytearray(footer[64:68])
+        self.assertEqual((checksum[0] << 24) | (checksum[1] << 16) |
+                         (checksum[2] << 8) | checksum[3],
+                         ~total & 0xffffffff)
+
+    def test_regenerate_unique_id_not_a_footer(self):
+        self.assertRaises(AzureOperationFailed,
+                          Vhd.regenerate_unique_id, bytes(bytearray(512)))
+
+    def test_resize_vhd(self):
+        size = 4 * 1024 * 1024
+        new_size = 2 * size
+        blob = FakePageBlob(size + 512)
+        blob.content[0:4] = b'data'
+        footer = Vhd.generate_vhd_footer(size)
+        Vhd.write_vhd_footer(blob, 'vhds', 'disk.vhd', size + 512, footer)
+
+        Vhd.resize_vhd(blob, 'vhds', 'disk.vhd', size + 512, new_size,
+                       lease_id='lease')
+
+        new_footer = bytes(blob.content[-512:])
+        self.assertEqual(len(blob.content), new_size + 512)
+        self.assertEqual(bytes(blob.content[0:4]), b'data')
+        self.assertEqual(bytes(blob.content[size:size + 512]),
+                         bytes(bytearray(512)))
+        # the footer records the new size and keeps the disk's unique id
+        self.assertEqual(new_footer[48:56],
+                         Vhd.generate_vhd_footer(new_size)[48:56])
+        self.assertEqual(new_footer[68:84], footer[68:84])
+        self.assertEqual(Vhd.set_unique_id(new_footer, footer[68:84]),
+                         new_footer)
+        self.assertEqual(blob.lease_ids, set([None, 'lease']))
@@ -0,0 +1,24 @@
+"""
+Eliot actions for the phases of driver operations.
+
+Every driver operation is an ``azure_flocker_driver:operation`` action,
+and the work it does is split into nested ``azure_flocker_driver:phase``
+actions, so the log records when each phase started and how long it took.
+Polling phases add the number of polls when they succeed.
+"""
+import eliot
+
+_logger = eliot.Logger()
+
+OPERATION_ACTION = u"azure_flocker_driver:operation"
+PHASE_ACTION = u"azure_flocker_driver:phase"
+
+
+def operation(name, **fields):
+    return eliot.start_action(_logger, OPERATION_ACTION,
+                              operation=unicode(name), **fields)
+
+
+def phase(name, **fields):
+    return eliot.start_action(_logger, PHASE_ACTION,
+                              phase=unicode(name), **fields)
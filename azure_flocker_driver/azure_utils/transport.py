@@ -0,0 +1,209 @@
+"""
+Pooled HTTP connections shared by the SDK clients.
+
+By default the management clients open a new session, and so a new TLS
+connection, for every request.  ``PooledTransport`` keeps one
+``requests.Session`` per endpoint, with a keep-alive pool of connections
+sized for that endpoint, and every client talking to the endpoint sends
+its requests through it.
+
+Connections are reused until they have served ``max_requests`` requests
+or are ``max_age`` seconds old, then closed once their response is read,
+so load balancer changes are picked up.  The pools count requests, TLS
+handshakes, recycled connections and how many connections are in use.
+"""
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connectionpool import (
+    HTTPConnectionPool, HTTPSConnectionPool
+)
+
+# Connections kept open to each endpoint
+DEFAULT_POOL_SIZES = {'arm': 10, 'storage': 32}
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_REQUESTS = 1000
+DEFAULT_MAX_AGE = 600
+
+
+class EndpointStats(object):
+    """
+    Connection use of one endpoint.
+    :ivar int requests: Requests sent.
+    :ivar int handshakes: Connections opened, each a TCP and TLS
+        handshake.
+    :ivar int recycled: Connections closed by the reuse limits.
+    :ivar int in_use: Connections sending a request or holding a response.
+    :ivar int peak_in_use: The most connections in use at once.
+    :ivar int pool_size: Connections kept open between requests.
+    """
+
+    def __init__(self, pool_size):
+        self.requests = 0
+        self.handshakes = 0
+        self.recycled = 0
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.pool_size = pool_size
+
+    def as_dict(self):
+        return {'requests': self.requests,
+                'handshakes': self.handshakes,
+                'reused': max(self.requests - self.handshakes, 0),
+                'recycled': self.recycled,
+                'in_use': self.in_use,
+                'peak_in_use': self.peak_in_use,
+                'pool_size': self.pool_size,
+                'utilization': float(self.peak_in_use) / self.pool_size}
+
+
+class _EndpointPools(object):
+    """
+    Builds connection pool classes which count into an endpoint's stats
+    and apply the reuse limits.
+    """
+
+    def __init__(self, stats, lock, max_requests, max_age):
+        self.stats = stats
+        self._lock = lock
+        self._max_requests = max_requests
+        self._max_age = max_age
+
+    def _connection_class(self, base):
+        endpoint = self
+
+        class Connection(base):
+
+            def connect(self):
+                base.connect(self)
+                self.connected_at = time.time()
+                self.uses = 0
+                with endpoint._lock:
+                    endpoint.stats.handshakes += 1
+        return Connection
+
+    def pool_class(self, base):
+        endpoint = self
+
+        class Pool(base):
+            ConnectionCls = self._connection_class(base.ConnectionCls)
+
+            def _get_conn(self, timeout=None):
+                conn = base._get_conn(self, timeout)
+                with endpoint._lock:
+                    endpoint.stats.in_use += 1
+                    endpoint.stats.peak_in_use = max(
+                        endpoint.stats.peak_in_use, endpoint.stats.in_use)
+                return conn
+
+            def _put_conn(self, conn):
+                if conn is not None and endpoint._spent(conn):
+                    conn.close()
+                    with endpoint._lock:
+                        endpoint.stats.recycled += 1
+                with endpoint._lock:
+                    endpoint.stats.in_use -= 1
+                base._put_conn(self, conn)
+        return Pool
+
+    def _spent(self, conn):
+        with self._lock:
+            self.stats.requests += 1
+        if getattr(conn, 'sock', None) is None:
+            return False
+        conn.uses = getattr(conn, 'uses', 0) + 1
+        connected_at = getattr(conn, 'connected_at', time.time())
+        return conn.uses >= self._max_requests or \
+            time.time() - connected_at >= self._max_age
+
+
+class _PooledAdapter(HTTPAdapter):
+
+    def __init__(self, pools, **kwargs):
+        self._pools = pools
+        HTTPAdapter.__init__(self, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': self._pools.pool_class(HTTPConnectionPool),
+            'https': self._pools.pool_class(HTTPSConnectionPool)}
+
+
+class PooledTransport(object):
+    """
+    Keep-alive sessions shared by every client of an endpoint.
+
+    :param dict pool_sizes: Connections kept open per endpoint, by
+        endpoint name such as ``arm`` or ``storage:<account>``, or by the
+        part before the colon.
+    :param int max_requests: Requests a connection serves before it is
+        closed.
+    :param float max_age: Seconds a connection is used for before it is
+        closed.
+    """
+
+    def __init__(self, pool_sizes=None, max_requests=DEFAULT_MAX_REQUESTS,
+                 max_age=DEFAULT_MAX_AGE):
+        self._pool_sizes = dict(DEFAULT_POOL_SIZES)
+        self._pool_sizes.update(pool_sizes or {})
+        self._max_requests = max_requests
+        self._max_age = max_age
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._stats = {}
+
+    def _pool_size(self, endpoint):
+        for name in (endpoint, endpoint.split(':')[0]):
+            if name in self._pool_sizes:
+                return int(self._pool_sizes[name])
+        return DEFAULT_POOL_SIZE
+
+    def session(self, endpoint):
+        """
+        :returns: The ``requests.Session`` for ``endpoint``.
+        """
+        with self._lock:
+            if endpoint not in self._sessions:
+                pool_size = self._pool_size(endpoint)
+                stats = EndpointStats(pool_size)
+                pools = _EndpointPools(stats, threading.Lock(),
+                                       self._max_requests, self._max_age)
+                session = requests.Session()
+                # other hosts of the endpoint, such as login for tokens,
+                # share the adapter but have pools of their own
+                adapter = _PooledAdapter(pools, pool_connections=4,
+                                         pool_maxsize=pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._sessions[endpoint] = session
+                self._stats[endpoint] = stats
+            return self._sessions[endpoint]
+
+    def configure_management_client(self, client, endpoint):
+        """
+        Sends the requests of a management client through the endpoint's
+        session.  The clients otherwise build a session per request.
+        """
+        service_client = client._client
+        service_client.config.keep_alive = True
+        service_client._session = self.session(endpoint)
+        return client
+
+    def stats(self):
+        """
+        :returns: A ``dict`` of endpoint to a ``dict`` of its requests,
+            handshakes, reused and recycled connections, and pool
+            utilization.
+        """
+        with self._lock:
+            return dict((endpoint, stats.as_dict())
+                        for (endpoint, stats) in self._stats.items())
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
@@ -1,4 +1,5 @@
 import datetime
+import struct
 import uuid
 
 
@@ -17,7 +18,8 @@ class Vhd(object):
     def create_blank_vhd(azure_storage_client,
                          container_name,
                          name,
-                         size_in_bytes):
+                         size_in_bytes,
+                         metadata=None):
         # VHD size must be aligned on a megabyte boundary.  The
         # current calling function converts from gigabytes to bytes,
         # but ideally a check should be added.
@@ -32,17 +34,108 @@ class Vhd(object):
         azure_storage_client.create_blob(
             container_name=container_name,
             blob_name=name,
-            content_length=size_in_bytes_with_footer)
+            content_length=size_in_bytes_with_footer,
+            metadata=metadata)
 
         # for disk to be a valid vhd it requires a vhd footer
         # on the last 512 bytes
         vhd_footer = Vhd.generate_vhd_footer(size_in_bytes)
+        Vhd.write_vhd_footer(azure_storage_client, container_name, name,
+                             size_in_bytes_with_footer, vhd_footer)
+
+        return azure_storage_client.make_blob_url(container_name, name)
+
+    @staticmethod
+    def read_vhd_footer(azure_storage_client, container_name, name,
+                        size_in_bytes_with_footer):
+        blob = azure_storage_client.get_blob_to_bytes(
+            container_name=container_name,
+            blob_name=name,
+            start_range=size_in_bytes_with_footer-512,
+            end_range=size_in_bytes_with_footer-1)
+        return blob.content
+
+    @staticmethod
+    def write_vhd_footer(azure_storage_client, container_name, name,
+                         size_in_bytes_with_footer, vhd_footer,
+                         lease_id=None):
         azure_storage_client.update_page(
             container_name=container_name,
             blob_name=name,
             page=vhd_footer,
             start_range=size_in_bytes_with_footer-512,
-            end_range=size_in_bytes_with_footer-1)
+            end_range=size_in_bytes_with_footer-1,
+            lease_id=lease_id)
+
+    @staticmethod
+    def regenerate_unique_id(vhd_footer):
+        """
+        Returns a copy of a VHD footer with a new unique id and an
+        updated checksum.  A copied VHD must not share the unique id
+        of its source.
+        """
+        return Vhd.set_unique_id(vhd_footer,
+                                 bytearray.fromhex(uuid.uuid4().hex))
+
+    @staticmethod
+    def set_unique_id(vhd_footer, unique_id):
+        """
+        Returns a copy of a VHD footer with the given 16 byte unique id
+        and an updated checksum.
+        """
+        if len(vhd_footer) != 512 or vhd_footer[0:8] != b'conectix':
+            raise AzureOperationFailed()
+        footer = bytearray(vhd_footer)
+        footer[68:84] = bytearray(unique_id)
+
+        # the checksum is the ones compliment of the sum of every byte
+        # of the footer, excluding the checksum field
+        footer[64:68] = bytearray(4)
+        total = 0
+        for byte in footer:
+            total += byte
+        footer[64:68] = bytearray(struct.pack('>I', ~total & 0xffffffff))
+
+        return bytes(footer)
+
+    @staticmethod
+    def resize_vhd(azure_storage_client, container_name, name,
+                   size_in_bytes_with_footer, new_size_in_bytes,
+                   lease_id=None):
+        """
+        Grows a fixed VHD in place.  The page blob is resized, a footer
+        for the new size is written at the new tail, keeping the unique
+        id of the disk, and the page of the old footer is cleared.  The
+        data pages are not touched, so this takes the same time for any
+        size of disk.
+        """
+        old_footer = Vhd.read_vhd_footer(azure_storage_client,
+                                         container_name, name,
+                                         size_in_bytes_with_footer)
+        vhd_footer = Vhd.generate_vhd_footer(new_size_in_bytes)
+        try:
+            vhd_footer = Vhd.set_unique_id(vhd_footer, old_footer[68:84])
+        except AzureOperationFailed:
+            # a blob without a footer keeps the new unique id
+            pass
+
+        new_size_in_bytes_with_footer = new_size_in_bytes + 512
+        azure_storage_client.resize_blob(
+            container_name=container_name,
+            blob_name=name,
+            content_length=new_size_in_bytes_with_footer,
+            lease_id=lease_id)
+        Vhd.write_vhd_footer(azure_storage_client, container_name, name,
+                             new_size_in_bytes_with_footer, vhd_footer,
+                             lease_id)
+        # the old footer is now a page of data at the end of the old
+        # size, and the guest must read it as zeros
+        azure_storage_client.clear_page(
+            container_name=container_name,
+            blob_name=name,
+            start_range=size_in_bytes_with_footer-512,
+            end_range=size_in_bytes_with_footer-1,
+            lease_id=lease_id)
 
         return azure_storage_client.make_blob_url(container_name, name)
 
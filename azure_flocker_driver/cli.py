@@ -0,0 +1,309 @@
+"""
+Command line tools for operating the Azure Flocker driver outside of the
+dataset agent.  The driver is configured from the ``dataset`` section of
+the Flocker agent configuration.
+"""
+import argparse
+import sys
+import threading
+import time
+import yaml
+
+from bitmath import Byte, GiB
+
+DEFAULT_CONFIG_PATH = '/etc/flocker/agent.yml'
+
+
+def _format_bytes(size):
+    return Byte(size).best_prefix().format('{value:.2f} {unit}')
+
+
+def _driver_from_agent_configuration(config_path, **overrides):
+    from azure_flocker_driver import api_factory
+
+    with open(config_path) as config_file:
+        config = yaml.safe_load(config_file.read())
+    config['dataset'].update(overrides)
+    return api_factory(**config['dataset'])
+
+
+def usage(args, out):
+    api = _driver_from_agent_configuration(args.config)
+    total_size = 0
+    total_allocated = 0
+    for (blockdevice_id, size, allocated) in sorted(api.list_volume_usage()):
+        out.write('%s %12s %12s %6.2f%%\n' %
+                  (blockdevice_id, _format_bytes(size),
+                   _format_bytes(allocated), 100.0 * allocated / size))
+        total_size += size
+        total_allocated += allocated
+    out.write('total %12s %12s\n' % (_format_bytes(total_size),
+                                     _format_bytes(total_allocated)))
+
+
+def backup(args, out):
+    api = _driver_from_agent_configuration(args.config)
+    result = api.backup_volume(args.blockdevice_id,
+                               path=args.file,
+                               target_container_name=args.container)
+    out.write('%s backup of %s from snapshot %s\n' %
+              ('incremental' if result.incremental else 'full',
+               args.blockdevice_id, result.snapshot))
+    out.write('copied %s, cleared %s of %s provisioned\n' %
+              (_format_bytes(result.transferred_bytes),
+               _format_bytes(result.cleared_bytes),
+               _format_bytes(result.provisioned_bytes)))
+
+
+def evacuate(args, out):
+    api = _driver_from_agent_configuration(args.config)
+
+    def progress(blockdevice_id, state, lun):
+        out.write('%s %s lun %s\n' % (blockdevice_id, state, lun))
+        out.flush()
+
+    volumes = api.evacuate_volumes(args.source, args.target, progress)
+    out.write('moved %d volumes from %s to %s\n' %
+              (len(volumes), args.source, args.target))
+
+
+def resize(args, out):
+    api = _driver_from_agent_configuration(args.config)
+    volume = api.resize_volume(args.blockdevice_id,
+                               int(GiB(args.size).to_Byte().value))
+    out.write('%s is now %s%s\n' %
+              (volume.blockdevice_id, _format_bytes(volume.size),
+               ' attached to %s' % volume.attached_to
+               if volume.attached_to else ''))
+
+
+def gc(args, out):
+    api = _driver_from_agent_configuration(args.config)
+    known = None
+    if args.known is not None:
+        with open(args.known) as known_file:
+            known = [line.strip() for line in known_file if line.strip()]
+    report = api.collect_orphans(known_blockdevice_ids=known,
+                                 dry_run=not args.delete,
+                                 grace_period=args.grace_period,
+                                 max_workers=args.workers,
+                                 rate=args.rate,
+                                 audit_log_path=args.audit_log)
+    for orphan in report.orphans:
+        if orphan.name in report.failed:
+            state = 'failed: %s' % report.failed[orphan.name]
+        elif orphan.name in report.deleted:
+            state = 'deleted'
+        else:
+            state = 'would delete'
+        out.write('%s %s %12s %s\n' %
+                  (orphan.name, orphan.kind, _format_bytes(orphan.size),
+                   state))
+    out.write('%d orphans of %d blobs, %d deleted, %d failed in %.1fs\n' %
+              (len(report.orphans), report.blobs_listed,
+               len(report.deleted), len(report.failed), report.duration))
+
+
+def migrate(args, out):
+    api = _driver_from_agent_configuration(args.config)
+    max_bytes_in_flight = None
+    if args.max_in_flight is not None:
+        max_bytes_in_flight = int(GiB(args.max_in_flight).to_Byte().value)
+    report = api.migrate_volumes(args.blockdevice_id, args.to,
+                                 max_workers=args.workers,
+                                 max_bytes_in_flight=max_bytes_in_flight)
+    for blockdevice_id in args.blockdevice_id:
+        if blockdevice_id in report.failed:
+            state = 'failed: %r' % (report.failed[blockdevice_id],)
+        else:
+            state = 'moved'
+        out.write('%s %s\n' % (blockdevice_id, state))
+    out.write('moved %d volumes, %s, to %s in %.1fs, %d failed\n' %
+              (len(report.migrated), _format_bytes(report.migrated_bytes),
+               report.target_storage, report.duration, len(report.failed)))
+
+
+def reclaim(args, out):
+    api = _driver_from_agent_configuration(args.config)
+    report = api.reclaim_volumes(
+        blockdevice_ids=args.blockdevice_id or None,
+        max_workers=args.workers,
+        rate=args.rate,
+        min_run=args.min_run * 1024)
+    for result in report.results:
+        out.write('%s scanned %12s zero %12s reclaimed %12s%s\n' %
+                  (result.blob_name[:-len('.vhd')],
+                   _format_bytes(result.scanned_bytes),
+                   _format_bytes(result.zero_bytes),
+                   _format_bytes(result.reclaimed_bytes),
+                   ' (stopped, %s)' % result.interrupted
+                   if result.interrupted else ''))
+    for disk_name, error in sorted(report.errors.items()):
+        out.write('%s failed: %s\n' % (disk_name, error))
+    out.write('reclaimed %s from %d of %d detached volumes in %.1fs\n' %
+              (_format_bytes(report.reclaimed_bytes), len(report.results),
+               report.volumes_checked, report.duration))
+
+
+def analyze_log(args, out):
+    from log_analysis import parse_operations, write_report
+
+    operations = []
+    for path in args.log:
+        with open(path) as log_file:
+            operations.extend(parse_operations(log_file))
+    write_report(operations, out, slowest=args.slowest)
+
+
+def replay(args, out):
+    from azure_utils.recording import read_operations
+
+    api = _driver_from_agent_configuration(args.config,
+                                           record_trace=None,
+                                           replay_trace=args.trace,
+                                           replay_speed=args.speed)
+    operations = [entry for entry in read_operations(args.trace)
+                  if entry['replayable']]
+    started = time.time()
+    results = {}
+
+    def run(entry):
+        delay = started + entry['start'] / args.speed - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        start = time.time()
+        error = None
+        try:
+            getattr(api, entry['name'])(*entry['args'], **entry['kwargs'])
+        except Exception as e:
+            error = type(e).__name__
+        results[entry['sequence']] = (time.time() - start, error)
+
+    # operations start at the recorded offsets, so they overlap as they
+    # did in production
+    threads = [threading.Thread(target=run, args=(entry,))
+               for entry in operations]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # replayed durations are scaled back to the time of the trace
+    out.write('%-28s %10s %10s %s\n' %
+              ('operation', 'recorded', 'replayed', 'error'))
+    for entry in operations:
+        (duration, error) = results[entry['sequence']]
+        recorded_error = entry['error']['class'].rsplit('.', 1)[-1] \
+            if entry['error'] else None
+        out.write('%-28s %9.2fs %9.2fs %s\n' %
+                  (entry['name'], entry['duration'], duration * args.speed,
+                   error if error == recorded_error else
+                   '%s (recorded %s)' % (error, recorded_error)))
+
+
+def _parser():
+    parser = argparse.ArgumentParser(prog='azure-flocker')
+    parser.add_argument('--config', default=DEFAULT_CONFIG_PATH,
+                        help='Flocker agent configuration file.')
+    subparsers = parser.add_subparsers()
+
+    usage_parser = subparsers.add_parser(
+        'usage', help='Report the allocated bytes of every volume.')
+    usage_parser.set_defaults(command=usage)
+
+    backup_parser = subparsers.add_parser(
+        'backup', help='Incrementally back up the pages of a volume.')
+    backup_parser.add_argument('blockdevice_id')
+    target = backup_parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--file', help='Local file to back up to.')
+    target.add_argument('--container',
+                        help='Container in the storage account of the '
+                             'volume to back up to.')
+    backup_parser.set_defaults(command=backup)
+
+    evacuate_parser = subparsers.add_parser(
+        'evacuate', help='Move every volume attached to one node to '
+                         'another node.')
+    evacuate_parser.add_argument('source')
+    evacuate_parser.add_argument('target')
+    evacuate_parser.set_defaults(command=evacuate)
+
+    resize_parser = subparsers.add_parser(
+        'resize', help='Grow a volume in place, detaching it from its '
+                       'node while it is resized.')
+    resize_parser.add_argument('blockdevice_id')
+    resize_parser.add_argument('size', type=int, help='New size in GiB.')
+    resize_parser.set_defaults(command=resize)
+
+    gc_parser = subparsers.add_parser(
+        'gc', help='Find, and with --delete remove, blobs no VM or '
+                   'Flocker refers to.')
+    gc_parser.add_argument('--known',
+                           help='File of the blockdevice ids Flocker '
+                                'reports, one per line.  Without it no '
+                                'flocker- volume is collected.')
+    gc_parser.add_argument('--delete', action='store_true',
+                           help='Delete the orphans instead of only '
+                                'reporting them.')
+    gc_parser.add_argument('--grace-period', type=float, default=86400,
+                           help='Seconds a blob must have been left '
+                                'unmodified.')
+    gc_parser.add_argument('--workers', type=int, default=8)
+    gc_parser.add_argument('--rate', type=float, default=10,
+                           help='Most deletes to start per second.')
+    gc_parser.add_argument('--audit-log',
+                           help='File to append a JSON line to for every '
+                                'orphan.')
+    gc_parser.set_defaults(command=gc)
+
+    migrate_parser = subparsers.add_parser(
+        'migrate', help='Move detached volumes to another storage '
+                        'account with server side copies.')
+    migrate_parser.add_argument('blockdevice_id', nargs='+')
+    migrate_parser.add_argument('--to', required=True,
+                                help='standard, premium or the name of an '
+                                     'account in storage_accounts.')
+    migrate_parser.add_argument('--workers', type=int, default=4,
+                                help='Volumes to move at once.')
+    migrate_parser.add_argument('--max-in-flight', type=int,
+                                help='Most GiB of volumes to copy at once.')
+    migrate_parser.set_defaults(command=migrate)
+
+    reclaim_parser = subparsers.add_parser(
+        'reclaim', help='Clear the zero pages of detached volumes.')
+    reclaim_parser.add_argument('blockdevice_id', nargs='*',
+                                help='Volumes to reclaim, by default every '
+                                     'detached volume.')
+    reclaim_parser.add_argument('--workers', type=int, default=8)
+    reclaim_parser.add_argument('--rate', type=float, default=20,
+                                help='Most requests to start per second.')
+    reclaim_parser.add_argument('--min-run', type=int, default=64,
+                                help='KiB of consecutive zero pages worth '
+                                     'clearing.')
+    reclaim_parser.set_defaults(command=reclaim)
+
+    analyze_parser = subparsers.add_parser(
+        'analyze-log', help='Break down the latency of driver operations '
+                            'by phase from agent logs.')
+    analyze_parser.add_argument('log', nargs='+',
+                                help='Dataset agent log files.')
+    analyze_parser.add_argument('--slowest', type=int, default=5,
+                                help='Slowest operations to show the '
+                                     'phases of.')
+    analyze_parser.set_defaults(command=analyze_log)
+
+    replay_parser = subparsers.add_parser(
+        'replay', help='Issue the driver operations of a trace again, '
+                       'answered offline from the trace.')
+    replay_parser.add_argument('trace',
+                               help='Trace recorded with record_trace.')
+    replay_parser.add_argument('--speed', type=float, default=1.0,
+                               help='Times faster than recorded to run.')
+    replay_parser.set_defaults(command=replay)
+
+    return parser
+
+
+def main(argv=None, out=sys.stdout):
+    args = _parser().parse_args(argv)
+    args.command(args, out)
@@ -0,0 +1,223 @@
+import eliot
+import threading
+import time
+
+_logger = eliot.Logger()
+
+_GIB = 1024 * 1024 * 1024
+
+
+class InventoryRefresh(object):
+    """
+    What one ``VolumeInventory.list_volumes`` call had to fetch.
+    :ivar int blobs_listed: Blobs in the container listing.
+    :ivar int blobs_changed: Blobs which are new or whose ETag changed.
+    :ivar int blobs_removed: Blobs no longer in the listing.
+    :ivar int vms_listed: VMs in the resource group listing.
+    :ivar int vms_fetched: VMs whose instance view was fetched again.
+    :ivar int rows_rebuilt: Volumes whose ``BlockDeviceVolume`` was rebuilt.
+    :ivar bool cached: Whether the previous list was returned unchanged.
+    """
+
+    def __init__(self):
+        self.blobs_listed = 0
+        self.blobs_changed = 0
+        self.blobs_removed = 0
+        self.vms_listed = 0
+        self.vms_fetched = 0
+        self.rows_rebuilt = 0
+        self.cached = False
+
+
+class _VMRow(object):
+
+    def __init__(self, fingerprint, model_disks, instance_disks, settled):
+        # disk name -> size in GiB, for flocker disks in the model
+        self.model_disks = model_disks
+        # names of flocker disks only in the instance view
+        self.instance_disks = instance_disks
+        self.fingerprint = fingerprint
+        # whether the instance view matched the model when fetched
+        self.settled = settled
+        self.fetched_at = time.time()
+
+
+class VolumeInventory(object):
+    """
+    Joins the container listing with the VMs disks are attached to, and
+    remembers the result between calls.
+
+    Each call lists the container and the VMs of the resource group, one
+    request each.  A blob is only re-examined when its ETag changes.  The
+    instance view of a VM, which needs a request per VM, is only fetched
+    again when the VM model changed, when the last instance view did not
+    match the model, or when it is older than ``max_age`` seconds.  The
+    driver tags every VM it updates with a new ``updateId``, so its own
+    attaches and detaches always change the model.  When nothing changed
+    the previous list of volumes is returned.
+    """
+
+    def __init__(self, manager, volume_factory, max_age=300):
+        """
+        :param DiskManager manager: The disk manager to list disks and VMs
+            with.
+        :param volume_factory: Called with ``(disk_name, size,
+            attached_to)`` to build a ``BlockDeviceVolume``.
+        :param float max_age: Seconds after which an instance view is
+            fetched again even if the VM model is unchanged.
+        """
+        self._manager = manager
+        self._volume_factory = volume_factory
+        self._max_age = max_age
+        self._lock = threading.Lock()
+
+        # disk name -> DiskRecord
+        self._blobs = {}
+        # vm name -> _VMRow
+        self._vms = {}
+        # disk name -> (vm name, size in bytes or None)
+        self._attached = {}
+        # disk name -> BlockDeviceVolume
+        self._rows = {}
+        self._volumes = None
+
+        self.last_refresh = None
+
+    def _fingerprint(self, vm):
+        tags = vm.tags or {}
+        return (vm.provisioning_state,
+                tags.get('updateId'),
+                tuple(sorted((d.name, d.lun, d.disk_size_gb)
+                             for d in vm.storage_profile.data_disks)))
+
+    def _fetch_vm(self, vm_name, fingerprint):
+        vm = self._manager.get_vm(vm_name, expand="instanceView")
+        model_disks = {}
+        for data_disk in vm.storage_profile.data_disks:
+            if 'flocker-' in data_disk.name:
+                model_disks[data_disk.name.replace('.vhd', '')] = \
+                    data_disk.disk_size_gb
+
+        instance_disks = set()
+        settled = True
+        if vm.instance_view is not None:
+            instance_view_disks = set()
+            for disk in vm.instance_view.disks:
+                if 'flocker-' not in disk.name:
+                    continue
+                disk_name = disk.name.replace('.vhd', '')
+                instance_view_disks.add(disk_name)
+                if disk_name not in model_disks:
+                    instance_disks.add(disk_name)
+            settled = instance_view_disks == set(model_disks)
+        return _VMRow(fingerprint, model_disks, instance_disks, settled)
+
+    def _refresh_blobs(self, refresh):
+        changed = []
+        previous = self._blobs
+        blobs = {}
+        for record in self._manager.list_disk_records():
+            blobs[record.name] = record
+            known = previous.get(record.name)
+            if known is None or known.etag != record.etag or \
+                    known.size != record.size:
+                changed.append(record.name)
+
+        removed = [name for name in previous if name not in blobs]
+        refresh.blobs_listed = len(blobs)
+        refresh.blobs_changed = len(changed)
+        refresh.blobs_removed = len(removed)
+        self._blobs = blobs
+        return set(changed) | set(removed)
+
+    def _refresh_vms(self, refresh):
+        now = time.time()
+        vms = {}
+        changed = False
+        for vm in self._manager.list_vms():
+            refresh.vms_listed += 1
+            fingerprint = self._fingerprint(vm)
+            row = self._vms.get(vm.name)
+            if row is None or row.fingerprint != fingerprint or \
+                    not row.settled or now - row.fetched_at > self._max_age:
+                row = self._fetch_vm(vm.name, fingerprint)
+                refresh.vms_fetched += 1
+                changed = True
+            vms[vm.name] = row
+        if set(vms) != set(self._vms):
+            changed = True
+        self._vms = vms
+        if not changed:
+            return set()
+
+        # disks in a model take precedence over disks only in an
+        # instance view, whichever VM is joined first
+        attached = {}
+        for vm_name, row in vms.items():
+            for disk_name, size_in_gibs in row.model_disks.items():
+                attached[disk_name] = (vm_name, size_in_gibs * _GIB)
+            for disk_name in row.instance_disks:
+                if disk_name not in attached:
+                    attached[disk_name] = (vm_name, None)
+
+        changed_disks = set(disk_name for disk_name in
+                            set(attached) | set(self._attached)
+                            if attached.get(disk_name) !=
+                            self._attached.get(disk_name))
+        self._attached = attached
+        return changed_disks
+
+    def _build_row(self, disk_name):
+        blob = self._blobs.get(disk_name)
+        if blob is None:
+            if disk_name in self._attached:
+                # We have a data disk mounted that isn't in the known
+                # list of blobs.
+                eliot.Message.new(
+                    info="Disk attached, but not known in container: " +
+                    disk_name).write(_logger)
+            return None
+
+        content_length = blob.size
+        if disk_name not in self._attached:
+            return self._volume_factory(disk_name, content_length, None)
+
+        vm_name, size = self._attached[disk_name]
+        if size is None:
+            # only in an instance view, so use the blob size without
+            # the vhd footer
+            size = content_length - (content_length % _GIB)
+        return self._volume_factory(disk_name, size, vm_name)
+
+    def list_volumes(self):
+        """
+        :returns: A ``list`` of ``BlockDeviceVolume``s.
+        """
+        with self._lock:
+            refresh = InventoryRefresh()
+            changed = self._refresh_blobs(refresh)
+            changed |= self._refresh_vms(refresh)
+
+            if self._volumes is not None and not changed:
+                refresh.cached = True
+            else:
+                for disk_name in changed:
+                    row = self._build_row(disk_name)
+                    if row is None:
+                        self._rows.pop(disk_name, None)
+                    else:
+                        self._rows[disk_name] = row
+                    refresh.rows_rebuilt += 1
+                self._volumes = list(self._rows.values())
+
+            self.last_refresh = refresh
+            eliot.Message.new(
+                message_type=u"azure_flocker_driver:inventory:refresh",
+                blobs_listed=refresh.blobs_listed,
+                blobs_changed=refresh.blobs_changed,
+                blobs_removed=refresh.blobs_removed,
+                vms_listed=refresh.vms_listed,
+                vms_fetched=refresh.vms_fetched,
+                rows_rebuilt=refresh.rows_rebuilt,
+                cached=refresh.cached).write(_logger)
+            return list(self._volumes)
@@ -0,0 +1,165 @@
+"""
+Latency breakdowns of driver operations from agent logs.
+
+The driver logs each operation as an eliot action with a nested action
+per phase (see ``azure_utils.tracing``).  The start and end messages of
+every action are paired by task and level, and each phase is assigned
+to the operation it is nested in.
+"""
+import json
+
+from azure_utils.tracing import OPERATION_ACTION, PHASE_ACTION
+
+
+class ActionTrace(object):
+    """
+    A finished operation or phase.
+    :ivar unicode name: The operation or phase name.
+    :ivar unicode task_uuid: The eliot task the action ran in.
+    :ivar tuple level: The task level shared by the start and end
+        messages, without the message index.
+    :ivar float start: The start timestamp.
+    :ivar float end: The end timestamp.
+    :ivar unicode status: ``succeeded`` or ``failed``.
+    :ivar dict fields: The fields of the start and end messages.
+    :ivar list phases: The ``ActionTrace``s of the phases of an
+        operation, in the order they started.
+    """
+
+    def __init__(self, name, task_uuid, level, start, end, status, fields):
+        self.name = name
+        self.task_uuid = task_uuid
+        self.level = level
+        self.start = start
+        self.end = end
+        self.status = status
+        self.fields = fields
+        self.phases = []
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def contains(self, other):
+        return self.task_uuid == other.task_uuid and \
+            len(other.level) > len(self.level) and \
+            other.level[:len(self.level)] == self.level
+
+
+def _parse_message(line):
+    # agent logs may prefix messages, so read from the first brace
+    start = line.find('{')
+    if start == -1:
+        return None
+    try:
+        message = json.loads(line[start:])
+    except ValueError:
+        return None
+    if not isinstance(message, dict):
+        return None
+    return message
+
+
+def parse_operations(lines):
+    """
+    :param lines: An iterable of log lines.
+    :returns: A ``list`` of the finished operations, as ``ActionTrace``s
+        with their phases.
+    """
+    started = {}
+    operations = []
+    phases = []
+    for line in lines:
+        message = _parse_message(line)
+        if message is None:
+            continue
+        action_type = message.get('action_type')
+        if action_type not in (OPERATION_ACTION, PHASE_ACTION):
+            continue
+        key = (message.get('task_uuid'),
+               tuple(message.get('task_level', [])[:-1]))
+        status = message.get('action_status')
+        if status == 'started':
+            started[key] = message
+            continue
+        start_message = started.pop(key, None)
+        if start_message is None:
+            continue
+
+        fields = dict(start_message)
+        fields.update(message)
+        if action_type == OPERATION_ACTION:
+            name = start_message.get('operation')
+        else:
+            name = start_message.get('phase')
+        trace = ActionTrace(name, key[0], key[1],
+                            start_message['timestamp'],
+                            message['timestamp'], status, fields)
+        if action_type == OPERATION_ACTION:
+            operations.append(trace)
+        else:
+            phases.append(trace)
+
+    for phase in phases:
+        owners = [operation for operation in operations
+                  if operation.contains(phase)]
+        if owners:
+            owner = max(owners, key=lambda operation: len(operation.level))
+            owner.phases.append(phase)
+    for operation in operations:
+        operation.phases.sort(key=lambda phase: phase.start)
+    return operations
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+
+def _summary_line(name, durations):
+    return '%-44s %6d %8.2fs %8.2fs %8.2fs %8.2fs\n' % (
+        name, len(durations), percentile(durations, 50),
+        percentile(durations, 95), percentile(durations, 99),
+        max(durations))
+
+
+def write_report(operations, out, slowest=5):
+    """
+    Writes the p50, p95 and p99 latency of every operation and of each
+    phase within it, then the phases of the slowest operations.
+    """
+    by_operation = {}
+    by_phase = {}
+    for operation in operations:
+        by_operation.setdefault(operation.name, []).append(
+            operation.duration)
+        for phase in operation.phases:
+            by_phase.setdefault((operation.name, phase.name), []).append(
+                phase.duration)
+
+    out.write('%-44s %6s %9s %9s %9s %9s\n' %
+              ('operation', 'count', 'p50', 'p95', 'p99', 'max'))
+    for name in sorted(by_operation):
+        out.write(_summary_line(name, by_operation[name]))
+        for (operation_name, phase_name) in sorted(by_phase):
+            if operation_name == name:
+                out.write(_summary_line(
+                    '  ' + phase_name,
+                    by_phase[(operation_name, phase_name)]))
+
+    ranked = sorted(operations, key=lambda operation: operation.duration,
+                    reverse=True)[:slowest]
+    if ranked:
+        out.write('\nslowest operations\n')
+    for operation in ranked:
+        out.write('%s %.2fs %s %s\n' %
+                  (operation.name, operation.duration, operation.status,
+                   operation.task_uuid))
+        for phase in operation.phases:
+            depth = len(phase.level) - len(operation.level)
+            counts = ''.join(' %s %s' % (name, phase.fields[name])
+                             for name in ('attempts', 'polls')
+                             if name in phase.fields)
+            out.write('%s%s %.2fs%s\n' %
+                      ('  ' * depth, phase.name, phase.duration, counts))
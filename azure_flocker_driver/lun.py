@@ -3,6 +3,14 @@ import os
 
 from twisted.python.filepath import FilePath
 
+from azure_utils.tracing import phase
+
+# the largest VM sizes take 64 data disks
+MAX_LUN = 63
+
+# made by the udev rules of the Azure Linux agent
+AZURE_LUN_LINK = '/dev/disk/azure/scsi1/lun%d'
+
 
 class Lun(object):
 
@@ -14,7 +22,7 @@ class Lun(object):
 
     @staticmethod
     def rescan_scsi():
-        with open(os.devnull, 'w') as shutup:
+        with phase(u'scsi_rescan'), open(os.devnull, 'w') as shutup:
             subprocess.call(['fdisk', '-l'], stdout=shutup, stderr=shutup)
 
     # Returns a string representing the block device path based
@@ -23,16 +31,31 @@ class Lun(object):
     def get_device_path_for_lun(lun):
         """
         Returns a FilePath representing the path of the device
-        with the sepcified LUN. TODO: Is it valid to predict the
-        path based on the LUN?
+        with the sepcified LUN.  The link the Azure udev rules make for
+        the LUN is followed when it exists, otherwise the path is
+        predicted from the LUN.
         return FilePath: The FilePath representing the attached disk
         """
         Lun.rescan_scsi()
-        if lun > 31:
-            raise Exception('valid lun parameter is 0 - 31, inclusive')
-        base = '/dev/sd'
-
-        # luns go 0-31
-        ascii_base = ord('c')
+        if not 0 <= lun <= MAX_LUN:
+            raise Exception('valid lun parameter is 0 - %d, inclusive' %
+                            (MAX_LUN,))
+        link = FilePath(AZURE_LUN_LINK % (lun,))
+        if link.exists():
+            return FilePath(os.path.realpath(link.path), False)
+        return FilePath('/dev/sd' + Lun.device_letters(lun), False)
 
-        return FilePath(base + chr(ascii_base + lun), False)
+    @staticmethod
+    def device_letters(lun):
+        """
+        Returns the letters of the sd device of a data disk LUN.  sda and
+        sdb are the OS and resource disks, and the data disks follow
+        from sdc, through sdz to sdaa and on.
+        """
+        index = lun + 2
+        letters = ''
+        while True:
+            letters = chr(ord('a') + index % 26) + letters
+            index = index // 26 - 1
+            if index < 0:
+                return letters
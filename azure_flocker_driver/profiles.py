@@ -0,0 +1,106 @@
+from azure_utils.arm_disk_manager import DiskManager
+
+STANDARD_STORAGE = DiskManager.STANDARD_STORAGE
+PREMIUM_STORAGE = DiskManager.PREMIUM_STORAGE
+
+CACHING_MODES = ('None', 'ReadOnly', 'ReadWrite')
+
+
+class UnknownStorageProfile(Exception):
+    """
+    The requested profile is not defined in the driver configuration.
+    :param unicode profile_name: The name of the requested profile.
+    """
+
+    def __init__(self, profile_name):
+        Exception.__init__(self, profile_name)
+        self.profile_name = profile_name
+
+
+class InvalidStorageProfile(Exception):
+    """
+    A profile in the driver configuration has invalid settings.
+    :param unicode profile_name: The name of the invalid profile.
+    :param str reason: What is wrong with the profile.
+    """
+
+    def __init__(self, profile_name, reason):
+        Exception.__init__(self, profile_name, reason)
+        self.profile_name = profile_name
+        self.reason = reason
+
+
+class StorageProfile(object):
+    """
+    The storage settings used for volumes created with a Flocker profile.
+    :param unicode name: The Flocker profile name.
+    :param str storage: Either ``STANDARD_STORAGE`` or ``PREMIUM_STORAGE``,
+        selecting the storage account the page blob is created in.
+    :param str caching: The host caching mode used when attaching the disk.
+    """
+
+    def __init__(self, name, storage, caching):
+        if storage not in (STANDARD_STORAGE, PREMIUM_STORAGE):
+            raise InvalidStorageProfile(
+                name, 'storage must be one of standard, premium. '
+                'Got {!r}.'.format(storage))
+        if caching not in CACHING_MODES:
+            raise InvalidStorageProfile(
+                name, 'caching must be one of ' + ', '.join(CACHING_MODES)
+                + '. Got {!r}.'.format(caching))
+        self.name = name
+        self.storage = storage
+        self.caching = caching
+
+    def __eq__(self, other):
+        if not isinstance(other, StorageProfile):
+            return NotImplemented
+        return (self.name, self.storage, self.caching) == \
+            (other.name, other.storage, other.caching)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'StorageProfile(name={!r}, storage={!r}, caching={!r})'.format(
+            self.name, self.storage, self.caching)
+
+
+DEFAULT_PROFILE_NAME = u'bronze'
+
+DEFAULT_PROFILES = {
+    u'gold': StorageProfile(u'gold', PREMIUM_STORAGE, 'ReadOnly'),
+    u'silver': StorageProfile(u'silver', STANDARD_STORAGE, 'ReadOnly'),
+    u'bronze': StorageProfile(u'bronze', STANDARD_STORAGE, 'None'),
+}
+
+
+def profiles_from_configuration(profiles_config=None):
+    """
+    Returns the profile mapping described by the ``profiles`` section of
+    the agent configuration, layered over ``DEFAULT_PROFILES``.
+
+    The configuration maps a profile name to its settings, for example:
+
+        profiles:
+          gold:
+            storage: premium
+            caching: ReadOnly
+
+    Any setting left out of a configured profile falls back to the default
+    profile of the same name, or to standard storage without caching.
+    :param dict profiles_config: The ``profiles`` section, or ``None``.
+    :returns dict: Profile names mapped to ``StorageProfile``s.
+    """
+    profiles = dict(DEFAULT_PROFILES)
+    for name, settings in (profiles_config or {}).items():
+        name = unicode(name).lower()
+        default = DEFAULT_PROFILES.get(name)
+        settings = settings or {}
+        profiles[name] = StorageProfile(
+            name,
+            settings.get('storage',
+                         default.storage if default else STANDARD_STORAGE),
+            settings.get('caching',
+                         default.caching if default else 'None'))
+    return profiles
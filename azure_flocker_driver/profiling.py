@@ -0,0 +1,220 @@
+"""
+Runtime profiling of driver calls, enabled by the ``debug`` option.
+
+Profiling is off until it is switched on, either by sending the agent
+``SIGUSR2``, which toggles it, or by creating the control file
+``azure_profiling`` in the state directory.  While on, every driver
+method records its calls, errors and cumulative wall and CPU time, and a
+background thread samples the stacks of the threads inside driver calls.
+Both are written to the state directory every ``dump_interval`` seconds:
+``azure_profile_methods.json`` and ``azure_profile_stacks.txt``, in the
+collapsed format flame graph tools read.
+"""
+from contextlib import contextmanager
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+DEFAULT_STATE_DIR = '/var/lib/flocker'
+CONTROL_FILE = 'azure_profiling'
+METHODS_FILE = 'azure_profile_methods.json'
+STACKS_FILE = 'azure_profile_stacks.txt'
+
+
+def parse_bool(value):
+    """
+    Reads a YAML option which may be a boolean or a string such as
+    ``"false"``.
+    """
+    if isinstance(value, basestring):
+        return value.strip().lower() in ('true', 'yes', 'on', '1')
+    return bool(value)
+
+
+class MethodStats(object):
+    """
+    Cumulative cost of one driver method.
+    :ivar int calls: Calls which finished.
+    :ivar int errors: Calls which raised.
+    :ivar float wall: Seconds of wall time.
+    :ivar float cpu: Seconds of process CPU time during the calls, which
+        includes other threads running at the same time.
+    :ivar float max_wall: The longest call.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.max_wall = 0.0
+
+    def as_dict(self):
+        return {'calls': self.calls,
+                'errors': self.errors,
+                'wall': self.wall,
+                'cpu': self.cpu,
+                'max_wall': self.max_wall,
+                'mean_wall': self.wall / self.calls if self.calls else 0.0}
+
+
+@contextmanager
+def unmeasured():
+    yield
+
+
+class DriverProfiler(object):
+    """
+    Measures driver methods and samples their stacks while enabled.
+    """
+
+    def __init__(self, state_dir=DEFAULT_STATE_DIR, dump_interval=60,
+                 sample_interval=0.01, signal_number=signal.SIGUSR2):
+        self._state_dir = state_dir
+        self._control_path = os.path.join(state_dir, CONTROL_FILE)
+        self._dump_interval = dump_interval
+        self._sample_interval = sample_interval
+        self._lock = threading.Lock()
+        self._methods = {}
+        self._stacks = {}
+        # thread ident -> name of the driver method it is running
+        self._active = {}
+        self._dirty = False
+        self._toggled_on = False
+        self._control_on = False
+        self._control_checked_at = 0
+        self._stopping = threading.Event()
+        self._thread = None
+
+        if signal_number is not None:
+            try:
+                signal.signal(signal_number, self._toggle)
+            except ValueError:
+                # signal handlers can only be set from the main thread
+                print("Profiling can't be toggled by signal from this "
+                      "thread, use %s" % self._control_path)
+
+    def _toggle(self, signum, frame):
+        self._toggled_on = not self._toggled_on
+        print("Driver profiling %s" %
+              ('enabled' if self._toggled_on else 'disabled'))
+
+    def is_enabled(self):
+        if self._toggled_on:
+            return True
+        # the control file is checked at most once a second
+        now = time.time()
+        if now - self._control_checked_at > 1:
+            self._control_checked_at = now
+            self._control_on = os.path.exists(self._control_path)
+        return self._control_on
+
+    @contextmanager
+    def measure(self, name):
+        if not self.is_enabled():
+            yield
+            return
+
+        ident = threading.current_thread().ident
+        with self._lock:
+            self._active[ident] = name
+        wall_start = time.time()
+        cpu_start = time.clock()
+        failed = False
+        try:
+            yield
+        except Exception:
+            failed = True
+            raise
+        finally:
+            wall = time.time() - wall_start
+            cpu = time.clock() - cpu_start
+            with self._lock:
+                del self._active[ident]
+                stats = self._methods.setdefault(name, MethodStats())
+                stats.calls += 1
+                stats.errors += failed
+                stats.wall += wall
+                stats.cpu += cpu
+                stats.max_wall = max(stats.max_wall, wall)
+                self._dirty = True
+
+    def sample(self):
+        """
+        Counts the current stack of every thread inside a driver method.
+        """
+        frames = sys._current_frames()
+        with self._lock:
+            active = dict(self._active)
+        samples = []
+        for ident, name in active.items():
+            frame = frames.get(ident)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s:%s' % (
+                    os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            stack.append(name)
+            samples.append(';'.join(reversed(stack)))
+        if samples:
+            with self._lock:
+                for stack in samples:
+                    self._stacks[stack] = self._stacks.get(stack, 0) + 1
+                self._dirty = True
+
+    def _write(self, file_name, content):
+        path = os.path.join(self._state_dir, file_name)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as profile_file:
+            profile_file.write(content)
+        os.rename(temp_path, path)
+
+    def dump(self):
+        """
+        Writes the method stats and sampled stacks gathered so far.
+        """
+        with self._lock:
+            methods = dict((name, stats.as_dict())
+                           for (name, stats) in self._methods.items())
+            stacks = sorted(self._stacks.items())
+            self._dirty = False
+        try:
+            self._write(METHODS_FILE,
+                        json.dumps(methods, indent=2, sort_keys=True))
+            self._write(STACKS_FILE,
+                        ''.join('%s %d\n' % (stack, count)
+                                for (stack, count) in stacks))
+        except (IOError, OSError) as e:
+            print("Unable to write driver profile to %s: %s" %
+                  (self._state_dir, e))
+
+    def _run(self):
+        next_dump = time.time() + self._dump_interval
+        while not self._stopping.is_set():
+            if self.is_enabled():
+                self.sample()
+                self._stopping.wait(self._sample_interval)
+            else:
+                self._stopping.wait(1)
+            if time.time() >= next_dump:
+                next_dump = time.time() + self._dump_interval
+                if self._dirty:
+                    self.dump()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='azure-driver-profiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._dirty:
+            self.dump()
@@ -0,0 +1,177 @@
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+import eliot
+import threading
+import time
+
+from azure_utils.tracing import operation, phase
+from profiling import unmeasured
+
+_logger = eliot.Logger()
+
+# Operation classes, highest priority first
+CRITICAL = 'critical'
+CREATE = 'create'
+LIST = 'list'
+BULK = 'bulk'
+PRIORITIES = (CRITICAL, CREATE, LIST, BULK)
+
+# Operations of a class which may run at once
+DEFAULT_LIMITS = {CRITICAL: 4, CREATE: 2, LIST: 2, BULK: 1}
+
+
+class UnknownOperationClass(Exception):
+
+    def __init__(self, operation_class):
+        Exception.__init__(self, operation_class)
+        self.operation_class = operation_class
+
+
+class OperationClassStats(object):
+    """
+    Counters for one operation class.
+    :ivar int queued: Operations waiting to start.
+    :ivar int running: Operations running.
+    :ivar int completed: Operations finished.
+    :ivar float total_wait: Seconds finished operations spent queued.
+    :ivar float max_wait: The longest an operation spent queued.
+    """
+
+    def __init__(self):
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def mean_wait(self):
+        if self.completed == 0:
+            return 0.0
+        return self.total_wait / self.completed
+
+
+class OperationScheduler(object):
+    """
+    Admits driver operations by priority class.
+
+    Each class has its own limit on concurrent operations, and operations
+    of a class start in the order they arrived.  An operation does not
+    start while an operation of a higher class is waiting, so a burst of
+    listing or destroying never delays an attach or detach that is queued
+    behind it.
+    """
+
+    def __init__(self, limits=None, slow_wait=1.0):
+        """
+        :param dict limits: Overrides of ``DEFAULT_LIMITS``.
+        :param float slow_wait: Seconds of waiting after which an
+            operation is logged.
+        """
+        self._limits = dict(DEFAULT_LIMITS)
+        for operation_class, limit in (limits or {}).items():
+            if operation_class not in self._limits:
+                raise UnknownOperationClass(operation_class)
+            self._limits[operation_class] = max(int(limit), 1)
+        self._slow_wait = slow_wait
+        self._condition = threading.Condition()
+        self._queues = dict((c, deque()) for c in PRIORITIES)
+        self._stats = dict((c, OperationClassStats()) for c in PRIORITIES)
+
+    def _can_start(self, operation_class, ticket):
+        if self._queues[operation_class][0] is not ticket:
+            return False
+        if self._stats[operation_class].running >= \
+                self._limits[operation_class]:
+            return False
+        for higher in PRIORITIES[:PRIORITIES.index(operation_class)]:
+            if self._queues[higher]:
+                return False
+        return True
+
+    @contextmanager
+    def slot(self, operation_class, name=None):
+        """
+        Waits until an operation of ``operation_class`` may start, and
+        counts it as running until the block exits.
+        """
+        if operation_class not in self._stats:
+            raise UnknownOperationClass(operation_class)
+        stats = self._stats[operation_class]
+        queue = self._queues[operation_class]
+        ticket = object()
+        start = time.time()
+        with phase(u'queue', operation_class=operation_class) as action, \
+                self._condition:
+            queue.append(ticket)
+            stats.queued = len(queue)
+            queue_depth = stats.queued
+            while not self._can_start(operation_class, ticket):
+                self._condition.wait()
+            queue.popleft()
+            stats.queued = len(queue)
+            stats.running += 1
+            waited = time.time() - start
+            # the next operation of this class, or of a lower class, may
+            # be able to start too
+            self._condition.notify_all()
+            action.addSuccessFields(queue_depth=queue_depth)
+
+        if waited >= self._slow_wait:
+            eliot.Message.new(
+                message_type=u"azure_flocker_driver:scheduler:slow_start",
+                operation=name,
+                operation_class=operation_class,
+                wait=waited,
+                queue_depth=queue_depth).write(_logger)
+        try:
+            yield
+        finally:
+            with self._condition:
+                stats.running -= 1
+                stats.completed += 1
+                stats.total_wait += waited
+                stats.max_wait = max(stats.max_wait, waited)
+                self._condition.notify_all()
+
+    def stats(self):
+        """
+        :returns: A ``dict`` of operation class to a ``dict`` of its queue
+            depth, running and completed operations and wait times.
+        """
+        with self._condition:
+            return dict((c, {'queued': s.queued,
+                             'running': s.running,
+                             'completed': s.completed,
+                             'mean_wait': s.mean_wait(),
+                             'max_wait': s.max_wait})
+                        for (c, s) in self._stats.items())
+
+
+def scheduled(operation_class):
+    """
+    Runs a method of an object with a ``_scheduler`` attribute in a slot
+    of ``operation_class``, as an eliot operation action.  The method is
+    measured by the object's ``_profiler`` and recorded by its
+    ``_recorder``, if it has them.
+    """
+    def decorator(method):
+        @wraps(method)
+        def scheduled_method(self, *args, **kwargs):
+            profiler = getattr(self, '_profiler', None)
+            if profiler is None:
+                measure = unmeasured()
+            else:
+                measure = profiler.measure(method.__name__)
+            recorder = getattr(self, '_recorder', None)
+            if recorder is None:
+                record = unmeasured()
+            else:
+                record = recorder.operation(method.__name__, args, kwargs)
+            with operation(method.__name__,
+                           operation_class=operation_class), \
+                    self._scheduler.slot(operation_class, method.__name__), \
+                    measure, record:
+                return method(self, *args, **kwargs)
+        return scheduled_method
+    return decorator
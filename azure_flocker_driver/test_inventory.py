@@ -0,0 +1,130 @@
+"""
+Tests for the incremental join of blobs and VMs in ``VolumeInventory``.
+"""
+from azure.mgmt.compute.models import (
+    DataDisk, DiskInstanceView, OSDisk, StorageProfile, VirtualMachine,
+    VirtualMachineInstanceView
+)
+from azure.storage.blob.models import Blob
+from twisted.trial import unittest
+
+from azure_utils.arm_disk_manager import DiskRecord
+from inventory import VolumeInventory
+
+GIB = 1024 * 1024 * 1024
+
+
+class FakeDiskManager(object):
+
+    def __init__(self):
+        self.blobs = {}
+        self.vms = {}
+        self.vm_gets = 0
+
+    def add_blob(self, name, size_in_gibs, etag='1'):
+        blob = Blob(name)
+        blob.properties.content_length = size_in_gibs * GIB + 512
+        blob.properties.etag = etag
+        self.blobs[name] = blob
+
+    def add_vm(self, name, update_id='1'):
+        vm = VirtualMachine(location='westus', tags={'updateId': update_id})
+        vm.name = name
+        vm.provisioning_state = 'Succeeded'
+        vm.storage_profile = StorageProfile(os_disk=OSDisk(name='os',
+                                                           vhd=None,
+                                                           create_option=''),
+                                            data_disks=[])
+        self.vms[name] = vm
+
+    def attach(self, vm_name, disk_name, lun, update_id):
+        vm = self.vms[vm_name]
+        size_in_gibs = self.blobs[disk_name].properties.content_length // GIB
+        vm.storage_profile.data_disks.append(
+            DataDisk(lun=lun, name=disk_name, vhd=None, create_option='',
+                     disk_size_gb=size_in_gibs))
+        vm.tags['updateId'] = update_id
+
+    def list_disk_records(self):
+        # the container is listed by the flocker- prefix
+        return [DiskRecord(blob.name, blob.properties.etag,
+                           blob.properties.content_length)
+                for blob in self.blobs.values()
+                if blob.name.startswith('flocker-')]
+
+    def list_vms(self):
+        return list(self.vms.values())
+
+    def get_vm(self, vm_name, expand=None):
+        self.vm_gets += 1
+        vm = self.vms[vm_name]
+        vm.instance_view = VirtualMachineInstanceView(disks=[
+            DiskInstanceView(name=d.name)
+            for d in vm.storage_profile.data_disks])
+        return vm
+
+
+class VolumeInventoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = FakeDiskManager()
+        self.manager.add_blob('flocker-a', 1)
+        self.manager.add_blob('flocker-b', 2)
+        self.manager.add_blob('node1-lun0_reserved', 1)
+        self.manager.add_vm('node1')
+        self.manager.add_vm('node2')
+        self.inventory = VolumeInventory(
+            self.manager,
+            lambda name, size, attached_to: (name, size, attached_to))
+
+    def test_first_list(self):
+        self.manager.attach('node1', 'flocker-a', 1, '2')
+        self.assertEqual(sorted(self.inventory.list_volumes()),
+                         [('flocker-a', GIB, 'node1'),
+                          ('flocker-b', 2 * GIB + 512, None)])
+        self.assertEqual(self.inventory.last_refresh.vms_fetched, 2)
+        self.assertEqual(self.inventory.last_refresh.rows_rebuilt, 2)
+
+    def test_unchanged_list_is_cached(self):
+        first = self.inventory.list_volumes()
+        gets = self.manager.vm_gets
+        second = self.inventory.list_volumes()
+        self.assertEqual(sorted(first), sorted(second))
+        self.assertEqual(self.manager.vm_gets, gets)
+        self.assertEqual(self.inventory.last_refresh.cached, True)
+        self.assertEqual(self.inventory.last_refresh.vms_fetched, 0)
+
+    def test_only_changed_vm_fetched(self):
+        self.inventory.list_volumes()
+        self.manager.attach('node2', 'flocker-b', 1, '2')
+        self.assertIn(('flocker-b', 2 * GIB, 'node2'),
+                      self.inventory.list_volumes())
+        self.assertEqual(self.inventory.last_refresh.vms_fetched, 1)
+        self.assertEqual(self.inventory.last_refresh.rows_rebuilt, 1)
+
+    def test_changed_and_removed_blobs(self):
+        self.inventory.list_volumes()
+        self.manager.add_blob('flocker-a', 3, etag='2')
+        del self.manager.blobs['flocker-b']
+        self.assertEqual(self.inventory.list_volumes(),
+                         [('flocker-a', 3 * GIB + 512, None)])
+        refresh = self.inventory.last_refresh
+        self.assertEqual((refresh.blobs_changed, refresh.blobs_removed,
+                          refresh.vms_fetched), (1, 1, 0))
+
+    def test_model_disk_wins_over_instance_view(self):
+        # a disk moving between VMs can be in the instance view of the
+        # old VM and the model of the new one
+        self.manager.attach('node2', 'flocker-a', 1, '2')
+        vm = self.manager.vms['node1']
+        original_get_vm = self.manager.get_vm
+
+        def get_vm(vm_name, expand=None):
+            result = original_get_vm(vm_name, expand)
+            if vm_name == 'node1':
+                vm.instance_view.disks.append(
+                    DiskInstanceView(name='flocker-a'))
+            return result
+        self.manager.get_vm = get_vm
+        self.assertIn(('flocker-a', GIB, 'node2'),
+                      self.inventory.list_volumes())
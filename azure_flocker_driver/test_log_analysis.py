@@ -0,0 +1,65 @@
+"""
+Tests for pairing eliot actions into operation latency breakdowns.
+"""
+from StringIO import StringIO
+from twisted.trial import unittest
+import eliot
+import json
+
+from azure_utils.tracing import operation, phase
+from log_analysis import parse_operations, percentile, write_report
+
+
+class ParseOperationsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.lines = ['not a log message\n']
+
+        def destination(message):
+            self.lines.append('agent: ' + json.dumps(message) + '\n')
+        eliot.add_destination(destination)
+        self.addCleanup(eliot.remove_destination, destination)
+
+    def _attach(self, polls):
+        with operation(u'attach_volume'):
+            with phase(u'get_vm'):
+                pass
+            with phase(u'update_vm') as update:
+                with phase(u'provisioning_poll') as poll:
+                    poll.addSuccessFields(polls=polls)
+                update.addSuccessFields(attempts=1)
+
+    def test_phases_assigned_to_operations(self):
+        self._attach(3)
+        self._attach(4)
+        operations = parse_operations(self.lines)
+        self.assertEqual([o.name for o in operations],
+                         [u'attach_volume', u'attach_volume'])
+        self.assertEqual([p.name for p in operations[1].phases],
+                         [u'get_vm', u'update_vm', u'provisioning_poll'])
+        self.assertEqual(operations[1].phases[2].fields['polls'], 4)
+        self.assertEqual(operations[0].status, u'succeeded')
+
+    def test_failed_operation(self):
+        try:
+            with operation(u'detach_volume'):
+                raise ValueError()
+        except ValueError:
+            pass
+        (detach,) = parse_operations(self.lines)
+        self.assertEqual(detach.status, u'failed')
+
+    def test_report(self):
+        self._attach(3)
+        out = StringIO()
+        write_report(parse_operations(self.lines), out)
+        report = out.getvalue()
+        self.assertIn('  provisioning_poll', report)
+        self.assertIn('slowest operations', report)
+        self.assertIn('\n    provisioning_poll 0.00s polls 3', report)
+        self.assertIn('attempts 1', report)
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual((percentile(values, 50), percentile(values, 99)),
+                         (51, 99))
@@ -0,0 +1,47 @@
+"""
+Tests for the mapping of Flocker storage profiles to Azure storage settings.
+"""
+from twisted.trial import unittest
+
+from profiles import (
+    DEFAULT_PROFILES, PREMIUM_STORAGE, STANDARD_STORAGE,
+    InvalidStorageProfile, StorageProfile, profiles_from_configuration
+)
+
+
+class ProfilesFromConfigurationTestCase(unittest.TestCase):
+
+    def test_defaults(self):
+        profiles = profiles_from_configuration(None)
+        self.assertEqual(profiles, DEFAULT_PROFILES)
+        self.assertEqual(profiles[u'gold'].storage, PREMIUM_STORAGE)
+        self.assertEqual(profiles[u'gold'].caching, 'ReadOnly')
+        self.assertEqual(profiles[u'silver'].storage, STANDARD_STORAGE)
+        self.assertEqual(profiles[u'silver'].caching, 'ReadOnly')
+        self.assertEqual(profiles[u'bronze'].storage, STANDARD_STORAGE)
+        self.assertEqual(profiles[u'bronze'].caching, 'None')
+
+    def test_override_keeps_unset_defaults(self):
+        profiles = profiles_from_configuration(
+            {'Gold': {'caching': 'ReadWrite'}})
+        self.assertEqual(profiles[u'gold'],
+                         StorageProfile(u'gold', PREMIUM_STORAGE,
+                                        'ReadWrite'))
+        self.assertEqual(profiles[u'bronze'], DEFAULT_PROFILES[u'bronze'])
+
+    def test_custom_profile(self):
+        profiles = profiles_from_configuration(
+            {'analytics': {'caching': 'ReadOnly'}})
+        self.assertEqual(profiles[u'analytics'],
+                         StorageProfile(u'analytics', STANDARD_STORAGE,
+                                        'ReadOnly'))
+
+    def test_invalid_caching(self):
+        self.assertRaises(InvalidStorageProfile,
+                          profiles_from_configuration,
+                          {'gold': {'caching': 'WriteBack'}})
+
+    def test_invalid_storage(self):
+        self.assertRaises(InvalidStorageProfile,
+                          profiles_from_configuration,
+                          {'gold': {'storage': 'ultra'}})
@@ -0,0 +1,78 @@
+"""
+Tests for toggling and recording driver profiles.
+"""
+from twisted.python.filepath import FilePath
+from twisted.trial import unittest
+import json
+import os
+import signal
+import threading
+
+from profiling import (
+    CONTROL_FILE, METHODS_FILE, STACKS_FILE, DriverProfiler, parse_bool
+)
+
+
+class DriverProfilerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.state_dir = FilePath(self.mktemp())
+        self.state_dir.makedirs()
+        self.profiler = DriverProfiler(self.state_dir.path,
+                                       signal_number=signal.SIGUSR2)
+        self.addCleanup(signal.signal, signal.SIGUSR2, signal.SIG_DFL)
+
+    def test_disabled_records_nothing(self):
+        with self.profiler.measure('list_volumes'):
+            pass
+        self.profiler.dump()
+        self.assertEqual(
+            json.loads(self.state_dir.child(METHODS_FILE).getContent()), {})
+
+    def test_control_file_enables(self):
+        self.state_dir.child(CONTROL_FILE).touch()
+        for i in range(2):
+            with self.profiler.measure('list_volumes'):
+                pass
+        self.assertRaises(ValueError, self._fail_attach)
+        self.profiler.dump()
+        methods = json.loads(
+            self.state_dir.child(METHODS_FILE).getContent())
+        self.assertEqual((methods['list_volumes']['calls'],
+                          methods['attach_volume']['errors']), (2, 1))
+
+    def _fail_attach(self):
+        with self.profiler.measure('attach_volume'):
+            raise ValueError()
+
+    def test_signal_toggles(self):
+        os.kill(os.getpid(), signal.SIGUSR2)
+        self.assertTrue(self.profiler.is_enabled())
+        os.kill(os.getpid(), signal.SIGUSR2)
+        self.assertFalse(self.profiler.is_enabled())
+
+    def test_sampled_stacks(self):
+        self.state_dir.child(CONTROL_FILE).touch()
+        inside = threading.Event()
+        release = threading.Event()
+
+        def attach():
+            with self.profiler.measure('attach_volume'):
+                inside.set()
+                release.wait()
+        thread = threading.Thread(target=attach)
+        thread.start()
+        inside.wait()
+        self.profiler.sample()
+        release.set()
+        thread.join()
+
+        self.profiler.dump()
+        (line,) = self.state_dir.child(STACKS_FILE).getContent().splitlines()
+        self.assertTrue(line.startswith('attach_volume;'))
+        self.assertTrue(line.endswith(' 1'))
+
+    def test_parse_bool(self):
+        self.assertEqual([parse_bool(v) for v in
+                          ("false", "true", "True", False, True, None)],
+                         [False, True, True, False, True, False])
@@ -0,0 +1,82 @@
+"""
+Tests for priority admission in ``OperationScheduler``.
+"""
+from twisted.trial import unittest
+import threading
+import time
+
+from scheduler import (
+    BULK, CRITICAL, LIST, OperationScheduler, UnknownOperationClass
+)
+
+
+class OperationSchedulerTestCase(unittest.TestCase):
+
+    def _start(self, scheduler, operation_class, started, release):
+        def run():
+            with scheduler.slot(operation_class):
+                started.append(operation_class)
+                release.wait()
+        thread = threading.Thread(target=run)
+        thread.start()
+        # cleanups run in reverse order, so the thread is released before
+        # the join
+        self.addCleanup(thread.join)
+        self.addCleanup(release.set)
+        return thread
+
+    def _wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition():
+            if time.time() > deadline:
+                self.fail('timed out')
+            time.sleep(0.01)
+
+    def test_class_limit(self):
+        scheduler = OperationScheduler({BULK: 1})
+        started = []
+        release = threading.Event()
+        self._start(scheduler, BULK, started, release)
+        self._start(scheduler, BULK, started, release)
+        self._wait_for(lambda: scheduler.stats()[BULK]['queued'] == 1)
+        self.assertEqual(started, [BULK])
+        self.assertEqual(scheduler.stats()[BULK]['running'], 1)
+
+        release.set()
+        self._wait_for(lambda: scheduler.stats()[BULK]['completed'] == 2)
+        self.assertEqual(started, [BULK, BULK])
+
+    def test_critical_not_held_by_bulk(self):
+        scheduler = OperationScheduler({BULK: 1})
+        started = []
+        bulk_release = threading.Event()
+        self._start(scheduler, BULK, started, bulk_release)
+        self._wait_for(lambda: started == [BULK])
+
+        critical_release = threading.Event()
+        critical_release.set()
+        self._start(scheduler, CRITICAL, started, critical_release)
+        self._wait_for(lambda: scheduler.stats()[CRITICAL]['completed'] == 1)
+        self.assertEqual(started, [BULK, CRITICAL])
+
+    def test_lower_class_waits_for_queued_higher_class(self):
+        scheduler = OperationScheduler({CRITICAL: 1})
+        started = []
+        critical_release = threading.Event()
+        self._start(scheduler, CRITICAL, started, critical_release)
+        self._start(scheduler, CRITICAL, started, critical_release)
+        self._wait_for(lambda: scheduler.stats()[CRITICAL]['queued'] == 1)
+
+        list_release = threading.Event()
+        list_release.set()
+        self._start(scheduler, LIST, started, list_release)
+        self._wait_for(lambda: scheduler.stats()[LIST]['queued'] == 1)
+        self.assertEqual(started, [CRITICAL])
+
+        critical_release.set()
+        self._wait_for(lambda: scheduler.stats()[LIST]['completed'] == 1)
+        self.assertEqual(started, [CRITICAL, CRITICAL, LIST])
+
+    def test_unknown_class(self):
+        self.assertRaises(UnknownOperationClass,
+                          OperationScheduler, {'urgent': 1})
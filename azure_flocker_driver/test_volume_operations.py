@@ -0,0 +1,146 @@
+"""
+Tests for the driver operations built on several ``DiskManager`` calls,
+with the disk manager replaced.
+"""
+from azure.storage.blob.models import Blob
+from flocker.node.agents.blockdevice import UnknownVolume
+from twisted.trial import unittest
+from uuid import uuid4
+
+from azure_storage_driver import azure_driver_from_configuration
+from azure_utils.arm_disk_manager import AzureAsynchronousTimeout, \
+    AzureOperationNotAllowed
+
+GIB = 1024 * 1024 * 1024
+
+
+class FakeDiskManager(object):
+
+    def __init__(self):
+        self.disks = {}
+        self.owners = {}
+        self.calls = []
+        self.errors = {}
+
+    def add_disk(self, size_in_gibs, vm_name=None, lun=None):
+        name = 'flocker-' + str(uuid4())
+        blob = Blob(name)
+        blob.storage = 'standard'
+        blob.properties.content_length = size_in_gibs * GIB + 512
+        blob.properties.lease.state = 'leased' if vm_name else 'available'
+        self.disks[name] = blob
+        if vm_name is not None:
+            self.owners[name] = (vm_name, lun)
+        return name
+
+    def _call(self, *call):
+        self.calls.append(call)
+        error = self.errors.get(call[0])
+        if error is not None:
+            raise error
+
+    def list_disks(self):
+        return list(self.disks.values())
+
+    def get_disk_owner(self, disk):
+        return self.owners.get(disk.name, (None, None))
+
+    def get_disk_lun(self, vm_name, disk_name):
+        owner, lun = self.owners.get(disk_name, (None, None))
+        return lun if owner == vm_name else None
+
+    def get_disk_caching(self, disk):
+        return 'ReadOnly'
+
+    def detach_disk(self, vm_name, disk_name, deadline=None):
+        self._call('detach', vm_name, disk_name, deadline)
+
+    def resize_disk(self, disk_name, size_in_gibs, deadline=None):
+        self._call('resize', disk_name, size_in_gibs, deadline)
+
+    def attach_disk(self, vm_name, disk_name, size_in_gibs, caching=None,
+                    storage=None, deadline=None):
+        self._call('attach', vm_name, disk_name, size_in_gibs, deadline)
+
+    def evacuate_disks(self, source_vm_name, target_vm_name, progress=None,
+                       deadline=None):
+        moved = []
+        for disk_name, (owner, lun) in sorted(self.owners.items()):
+            if owner == source_vm_name:
+                moved.append((disk_name, lun))
+        return moved
+
+    def read_disk_size(self, disk_name):
+        return 7 * GIB + 512
+
+
+class DriverOperationsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.api = azure_driver_from_configuration(
+            client_id='client', client_secret='secret', tenant_id='tenant',
+            subscription_id='subscription', storage_account_name='account',
+            storage_account_key='key', storage_account_container='vhds',
+            group_name='group', location='westus', debug=False)
+        self.manager = FakeDiskManager()
+        self.api._lazy_values['manager'] = self.manager
+        # each operation deadline is told apart by its number
+        deadlines = iter(range(1, 100))
+        self.api._deadline = lambda: next(deadlines)
+
+
+class ResizeVolumeTestCase(DriverOperationsTestCase):
+
+    def test_resizes_attached_volume(self):
+        name = self.manager.add_disk(2, 'node1', 3)
+        volume = self.api.resize_volume(name, 3 * GIB)
+        self.assertEqual(self.manager.calls,
+                         [('detach', 'node1', name, 1),
+                          ('resize', name, 3, 1),
+                          ('attach', 'node1', name, 3, 2)])
+        self.assertEqual((volume.size, volume.attached_to),
+                         (3 * GIB, u'node1'))
+
+    def test_resizes_detached_volume(self):
+        name = self.manager.add_disk(2)
+        self.api.resize_volume(name, 3 * GIB)
+        self.assertEqual(self.manager.calls, [('resize', name, 3, 1)])
+
+    def test_failed_resize_reattaches(self):
+        name = self.manager.add_disk(2, 'node1', 3)
+        self.manager.errors['resize'] = AzureOperationNotAllowed()
+        self.assertRaises(AzureOperationNotAllowed,
+                          self.api.resize_volume, name, 1 * GIB)
+        # on a deadline of its own, at the size the volume still has
+        self.assertEqual(self.manager.calls[-1],
+                         ('attach', 'node1', name, 2, 2))
+
+    def test_resize_error_not_masked(self):
+        name = self.manager.add_disk(2, 'node1', 3)
+        self.manager.errors['resize'] = AzureAsynchronousTimeout()
+        self.manager.errors['attach'] = AzureOperationNotAllowed()
+        self.assertRaises(AzureAsynchronousTimeout,
+                          self.api.resize_volume, name, 3 * GIB)
+
+    def test_volume_missing_from_listing(self):
+        name = self.manager.add_disk(2, 'node1', 3)
+        original_list_disks = self.manager.list_disks
+        listings = [original_list_disks(), []]
+        self.manager.list_disks = lambda: listings.pop(0)
+        self.assertRaises(UnknownVolume,
+                          self.api.resize_volume, name, 3 * GIB)
+        self.assertEqual(self.manager.calls, [])
+
+
+class EvacuateVolumesTestCase(DriverOperationsTestCase):
+
+    def test_sizes_of_moved_volumes(self):
+        listed = self.manager.add_disk(2, 'node1', 1)
+        unlisted = self.manager.add_disk(2, 'node1', 2)
+        del self.manager.disks[unlisted]
+        volumes = self.api.evacuate_volumes(u'node1', u'node2')
+        self.assertEqual(
+            sorted((v.blockdevice_id, v.size, v.attached_to)
+                   for v in volumes),
+            sorted([(listed, 2 * GIB, u'node2'),
+                    (unlisted, 7 * GIB, u'node2')]))
@@ -0,0 +1,169 @@
+"""
+Benchmark of the volume inventory join on large containers: the wall time
+and peak memory of the first ``list_volumes`` of a ``VolumeInventory``,
+which lists and joins every blob, and of a second, unchanged one.
+
+The disk manager is the real ``DiskManager`` over in-memory clients, which
+build SDK blob and VM objects for each listing as the SDK does, with a
+tenth of the volumes attached to VMs of 32 disks and a few non-flocker
+blobs.  Each run is a fresh interpreter, so peak memory is its own.  With
+``--ref`` the same runs are made against the driver at a git ref, such as
+the commit before a change, for comparison.
+
+    python benchmarks/bench_inventory.py --sizes 1000 10000 50000 --ref HEAD~1
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TRIAL = """
+import json
+import resource
+import sys
+import time
+from uuid import UUID, uuid4
+
+sys.path[0:0] = [sys.argv[1]]
+from azure.mgmt.compute.models import (
+    DataDisk, DiskInstanceView, HardwareProfile, StorageProfile,
+    VirtualHardDisk, VirtualMachine, VirtualMachineInstanceView
+)
+from azure.storage.blob.models import Blob
+from azure_utils.arm_disk_manager import DiskManager
+from inventory import VolumeInventory
+
+volumes = int(sys.argv[2])
+GIB = 1024 * 1024 * 1024
+names = ['flocker-%s' % uuid4() for i in range(volumes)]
+other_names = ['os-disk-%d' % i for i in range(volumes // 20)]
+vm_disks = {}
+for (index, name) in enumerate(names[:volumes // 10]):
+    vm_disks.setdefault('node%d' % (index // 32), []).append(name)
+
+
+class Storage(object):
+
+    def create_container(self, container_name):
+        pass
+
+    def list_blobs(self, container_name, prefix=None, include=None):
+        for name in other_names + names:
+            if prefix is not None and not name.startswith(prefix):
+                continue
+            blob = Blob(name + '.vhd')
+            blob.properties.etag = '0x8D3' + name[-12:]
+            blob.properties.content_length = GIB + 512
+            blob.properties.lease.state = 'available'
+            if include is not None:
+                blob.metadata = {'flocker_profile': 'default'}
+            yield blob
+
+
+class VirtualMachines(object):
+
+    def _vm(self, vm_name, expand=None):
+        vm = VirtualMachine(location='westus', tags={'flocker-node': 'true',
+                                                     'updateId': '1'})
+        vm.name = vm_name
+        vm.provisioning_state = 'Succeeded'
+        vm.hardware_profile = HardwareProfile(vm_size='Standard_D14')
+        vm.storage_profile = StorageProfile(data_disks=[
+            DataDisk(lun=lun, name=name, create_option='attach',
+                     vhd=VirtualHardDisk('https://account/vhds/' + name),
+                     disk_size_gb=1)
+            for (lun, name) in enumerate(vm_disks[vm_name])])
+        if expand:
+            vm.instance_view = VirtualMachineInstanceView(disks=[
+                DiskInstanceView(name=name) for name in vm_disks[vm_name]])
+        return vm
+
+    def list(self, resource_group_name):
+        return [self._vm(vm_name) for vm_name in sorted(vm_disks)]
+
+    def get(self, resource_group_name, vm_name, expand=None):
+        return self._vm(vm_name, expand)
+
+
+class Compute(object):
+    virtual_machines = VirtualMachines()
+
+
+manager = DiskManager(None, Compute(), Storage(), 'vhds', 'group', 'westus')
+inventory = VolumeInventory(
+    manager, lambda name, size, attached_to: (
+        UUID(name[len('flocker-'):]), name, size, attached_to))
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+start = time.time()
+listed = inventory.list_volumes()
+first = time.time() - start
+start = time.time()
+inventory.list_volumes()
+second = time.time() - start
+assert len(listed) == volumes
+
+print(json.dumps({
+    'first': first,
+    'second': second,
+    'peak_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before,
+}))
+"""
+
+
+def run(driver_dir, volumes):
+    output = subprocess.check_output(
+        [sys.executable, '-c', TRIAL, driver_dir, str(volumes)])
+    return json.loads(output.decode('utf-8').splitlines()[-1])
+
+
+def export_ref(ref):
+    """
+    Extracts the driver at ``ref`` to a temporary directory.
+    """
+    directory = tempfile.mkdtemp()
+    archive = subprocess.Popen(
+        ['git', 'archive', ref, 'azure_flocker_driver'],
+        cwd=REPO_ROOT, stdout=subprocess.PIPE)
+    subprocess.check_call(['tar', '-x', '-C', directory],
+                          stdin=archive.stdout)
+    if archive.wait() != 0:
+        raise ValueError('Unable to export %s' % ref)
+    return directory
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 50000])
+    parser.add_argument('--ref',
+                        help='Git ref of the driver to compare against.')
+    args = parser.parse_args()
+
+    trees = [('current', os.path.join(REPO_ROOT, 'azure_flocker_driver'))]
+    exported = None
+    if args.ref is not None:
+        exported = export_ref(args.ref)
+        trees.append((args.ref,
+                      os.path.join(exported, 'azure_flocker_driver')))
+    try:
+        print('%-10s %8s %10s %10s %12s' %
+              ('driver', 'volumes', 'first', 'unchanged', 'peak memory'))
+        for volumes in args.sizes:
+            for (name, driver_dir) in trees:
+                result = run(driver_dir, volumes)
+                print('%-10s %8d %9.3fs %9.3fs %9.1f MiB' %
+                      (name, volumes, result['first'], result['second'],
+                       result['peak_kib'] / 1024.0))
+    finally:
+        if exported is not None:
+            shutil.rmtree(exported)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Benchmark of driver startup: importing the backend module and building the
+driver with ``api_factory``, the work the dataset agent does before it
+reports the node ready.
+
+Each trial runs in a fresh interpreter so module imports are not cached.
+The driver builds its Azure clients on first use, so startup should make no
+network requests; placeholder credentials are used unless ``--config``
+names a Flocker agent configuration.  With ``--first-use`` the time of the
+first ``list_volumes`` call, which builds the clients, is reported too and
+a real configuration is required.
+
+    python benchmarks/bench_startup.py --trials 10
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PLACEHOLDER_CONFIG = {
+    'client_id': 'client-id',
+    'client_secret': 'client-secret',
+    'tenant_id': 'tenant-id',
+    'subscription_id': 'subscription-id',
+    'storage_account_name': 'account',
+    'storage_account_key': 'a2V5',
+    'storage_account_container': 'vhds',
+    'group_name': 'group',
+    'location': 'westus',
+    'debug': False,
+}
+
+TRIAL = """
+import json
+import sys
+import time
+
+config = json.loads(sys.argv[1])
+first_use = sys.argv[2] == 'true'
+
+start = time.time()
+import azure_flocker_driver
+imported = time.time()
+api = azure_flocker_driver.api_factory(**config)
+created = time.time()
+if first_use:
+    api.list_volumes()
+used = time.time()
+
+print(json.dumps({
+    'import': imported - start,
+    'api_factory': created - imported,
+    'first_use': used - created,
+}))
+"""
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+
+def run_trials(config, trials, first_use):
+    results = []
+    for i in range(trials):
+        output = subprocess.check_output(
+            [sys.executable, '-c', TRIAL, json.dumps(config),
+             'true' if first_use else 'false'],
+            cwd=REPO_ROOT)
+        results.append(json.loads(output.decode('utf-8').splitlines()[-1]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--trials', type=int, default=5)
+    parser.add_argument('--config',
+                        help='Flocker agent configuration to build the '
+                             'driver from.')
+    parser.add_argument('--first-use', action='store_true')
+    args = parser.parse_args()
+
+    config = PLACEHOLDER_CONFIG
+    if args.config is not None:
+        import yaml
+        with open(args.config) as config_file:
+            config = yaml.safe_load(config_file.read())['dataset']
+        config.pop('backend', None)
+    elif args.first_use:
+        parser.error('--first-use needs --config')
+
+    results = run_trials(config, args.trials, args.first_use)
+    phases = ['import', 'api_factory']
+    if args.first_use:
+        phases.append('first_use')
+    for phase in phases:
+        values = [r[phase] for r in results]
+        print('%-12s min %8.4fs p50 %8.4fs max %8.4fs' %
+              (phase, min(values), _percentile(values, 50), max(values)))
+
+
+if __name__ == '__main__':
+    main()
@@ -36,5 +36,10 @@ setup(
     keywords='backend, plugin, flocker, docker, python',
     packages=find_packages(exclude=['test*']),
     install_requires=install_requires,
+    entry_points={
+        'console_scripts': [
+            'azure-flocker = azure_flocker_driver.cli:main',
+        ],
+    },
     data_files=[('/etc/flocker', ['example.azure_agent.yml'])]
 )